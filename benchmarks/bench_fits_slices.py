@@ -0,0 +1,134 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Latency of reading image slices and spectra from uncompressed, tile-compressed
+and gzip'd FITS cubes through `~cubeviz.data_factories.lazy.LazyFITSArray`.
+
+Run with::
+
+    python benchmarks/bench_fits_slices.py --shape 500 200 200
+
+A synthetic cube is written in each format to a temporary directory (or the
+given FITS file is used as the uncompressed input) and, for each format, the
+time to open the file, to read random slices and spectra and to read the
+whole cube is reported.
+"""
+import os
+import gzip
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from cubeviz.data_factories.lazy import LazyFITSArray
+
+
+def make_cube(shape, seed=0):
+    """
+    A smooth cube with noise, so that it compresses like real data.
+    """
+    rng = np.random.RandomState(seed)
+    nz, ny, nx = shape
+    z, y, x = np.ogrid[:nz, :ny, :nx]
+    cube = np.exp(-((y - ny / 2) ** 2 + (x - nx / 2) ** 2) / (0.1 * nx * ny)) * (1 + np.sin(z / 10.))
+    return (cube + 0.01 * rng.randn(*shape)).astype(np.float32)
+
+
+def write_inputs(data, directory):
+    """
+    Write ``data`` uncompressed, tile compressed (one tile per slice and the
+    astropy default of one tile per row) and gzip'd.
+
+    :return: list of (label, filename, extension)
+    """
+    inputs = []
+
+    filename = os.path.join(directory, 'cube.fits')
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data, name='FLUX')]).writeto(filename)
+    inputs.append(('uncompressed', filename, 'FLUX'))
+
+    for label, tile_shape in [('rice, slice tiles', (1,) + data.shape[1:]),
+                              ('rice, row tiles', None)]:
+        name = os.path.join(directory, 'cube_{}.fits'.format(len(inputs)))
+        hdu = fits.CompImageHDU(data, name='FLUX', compression_type='RICE_1',
+                                tile_shape=tile_shape, quantize_level=64)
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(name)
+        inputs.append((label, name, 'FLUX'))
+
+    name = filename + '.gz'
+    with open(filename, 'rb') as fin:
+        with gzip.open(name, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+    inputs.append(('gzip', name, 'FLUX'))
+
+    return inputs
+
+
+def _time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def benchmark(filename, extension, repeat=20, seed=0):
+    """
+    Time the access patterns of the viewers on one file.
+
+    :return: dict of median times in seconds
+    """
+    rng = np.random.RandomState(seed)
+    results = {}
+
+    start = time.perf_counter()
+    hdulist = fits.open(filename, memmap=True, do_not_scale_image_data=True)
+    array = LazyFITSArray(hdulist[extension])
+    results['open'] = time.perf_counter() - start
+
+    try:
+        nz, ny, nx = array.shape
+        results['slice'] = _time(lambda: array[rng.randint(nz)], repeat)
+        results['spectrum'] = _time(lambda: array[:, rng.randint(ny), rng.randint(nx)], repeat)
+        results['cube'] = _time(lambda: np.asarray(array), 1)
+    finally:
+        hdulist.close()
+
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--shape', type=int, nargs=3, default=[200, 100, 100], metavar=('NZ', 'NY', 'NX'),
+                        help='shape of the synthetic cube')
+    parser.add_argument('--file', default=None,
+                        help='FITS file to use instead of a synthetic cube (its first 3D extension is used)')
+    parser.add_argument('--repeat', type=int, default=20, help='number of slices and spectra to read')
+    args = parser.parse_args(args)
+
+    directory = tempfile.mkdtemp(prefix='cubeviz_bench_')
+    try:
+        if args.file is None:
+            data = make_cube(tuple(args.shape))
+        else:
+            with fits.open(args.file) as hdulist:
+                data = next(hdu.data for hdu in hdulist if hdu.header.get('NAXIS', 0) == 3)
+
+        print('Cube of shape {} ({:.1f} MB)'.format(data.shape, data.nbytes / 1e6))
+        print('{:<20s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+            'format', 'size (MB)', 'open (ms)', 'slice (ms)', 'spec (ms)', 'cube (ms)'))
+
+        for label, filename, extension in write_inputs(data, directory):
+            results = benchmark(filename, extension, repeat=args.repeat)
+            print('{:<20s} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                label, os.path.getsize(filename) / 1e6,
+                *[1e3 * results[key] for key in ['open', 'slice', 'spectrum', 'cube']]))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
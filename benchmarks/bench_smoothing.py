@@ -0,0 +1,113 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Throughput of the smoothing of cubes (see `~cubeviz.tools.smoothing_engine`)
+for every kernel of the `~cubeviz.tools.smoothing.SmoothCube` registry, on
+each of its axes.
+
+Run with::
+
+    python benchmarks/bench_smoothing.py --sizes 32 64 128 --workers 1 4
+
+Synthetic cubes of shape (N, N, N) are smoothed for each size N, and the
+wall time, the peak memory allocated in this process (by numpy and Python,
+as traced by `tracemalloc`, so not that of the worker processes nor of the
+memory mapped files) and the number of voxels smoothed per second are
+reported. No window is opened.
+"""
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from cubeviz.tools.smoothing import SmoothCube
+from cubeviz.tools.smoothing_engine import select_method, smooth_array
+
+
+def make_cube(shape, masked=0., seed=0):
+    """
+    A smooth cube with noise and, if ``masked`` > 0, that fraction of its
+    voxels masked.
+
+    :return: (data, mask or None)
+    """
+    rng = np.random.RandomState(seed)
+    nz, ny, nx = shape
+    z, y, x = np.ogrid[:nz, :ny, :nx]
+    cube = np.exp(-((y - ny / 2) ** 2 + (x - nx / 2) ** 2) / (0.1 * nx * ny)) * (1 + np.sin(z / 10.))
+    cube = cube + 0.01 * rng.randn(*shape)
+    mask = rng.rand(*shape) >= masked if masked > 0 else None
+    return cube, mask
+
+
+def smoothings(kernel_size, kernel_types=None):
+    """
+    The kernels of the SmoothCube registry, on each of their axes.
+
+    :return: list of (kernel_type, smoothing_axis, SmoothingSpec)
+    """
+    smooth_cube = SmoothCube(kernel_size=kernel_size)
+    registry = smooth_cube.get_kernel_registry()
+    result = []
+    for kernel_type in sorted(registry):
+        if kernel_types and kernel_type not in kernel_types:
+            continue
+        for axis in registry[kernel_type]["axis"]:
+            spec = smooth_cube.get_smoothing_spec(axis, kernel_type, kernel_size)
+            result.append((kernel_type, axis, spec))
+    return result
+
+
+def benchmark(data, spec, mask=None, n_workers=1, memmap=False):
+    """
+    Smooth ``data`` once.
+
+    :return: dict with the wall time (s), the peak memory (bytes) and the
+             voxels smoothed per second
+    """
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = smooth_array(data, spec, mask=mask, n_workers=n_workers, memmap=memmap)
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {'wall': wall, 'peak': peak, 'rate': data.size / wall}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 64, 128],
+                        help='sizes N of the synthetic cubes of shape (N, N, N)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1],
+                        help='numbers of worker processes to compare')
+    parser.add_argument('--kernel-size', type=float, default=3,
+                        help='size of the kernels (width, radius or sigma, see the registry)')
+    parser.add_argument('--kernels', nargs='+', default=None,
+                        help='kernel types to run (default: all those of the registry)')
+    parser.add_argument('--masked', type=float, default=0.,
+                        help='fraction of masked voxels')
+    parser.add_argument('--memmap', action='store_true',
+                        help='memory map the outputs to temporary files')
+    args = parser.parse_args(args)
+
+    print('{:<14s} {:<9s} {:<10s} {:>16s} {:>8s} {:>10s} {:>10s} {:>12s}'.format(
+        'kernel', 'axis', 'method', 'shape', 'workers', 'wall (s)', 'peak (MB)', 'Mvoxel/s'))
+
+    for size in args.sizes:
+        shape = (size, size, size)
+        data, mask = make_cube(shape, masked=args.masked)
+        for kernel_type, axis, spec in smoothings(args.kernel_size, args.kernels):
+            method = select_method(spec, shape).method
+            for n_workers in args.workers:
+                results = benchmark(data, spec, mask=mask, n_workers=n_workers, memmap=args.memmap)
+                print('{:<14s} {:<9s} {:<10s} {:>16s} {:>8d} {:>10.3f} {:>10.1f} {:>12.2f}'.format(
+                    kernel_type, axis, method, 'x'.join(str(n) for n in shape), n_workers,
+                    results['wall'], results['peak'] / 1e6, results['rate'] / 1e6))
+
+
+if __name__ == '__main__':
+    main()
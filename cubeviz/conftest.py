@@ -61,6 +61,9 @@ try:
 except NameError:   # Needed to support Astropy <= 1.0.0
     pass
 
+# Keep the test runs from writing the data configuration cache to ~/.cubeviz
+os.environ.setdefault('CUBEVIZ_CACHE_DIR', '')
+
 
 import pytest
 from .tests.helpers import (toggle_viewer, select_viewer, create_glue_app,
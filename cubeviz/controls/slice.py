@@ -1,11 +1,9 @@
-import numpy as np
-
 from glue.core import HubListener
 from glue.utils.array import format_minimal
 
 from ..messages import (SliceIndexUpdateMessage, WavelengthUpdateMessage,
                         WavelengthUnitUpdateMessage, RedshiftUpdateMessage)
-from .wavelengths import REST_WAVELENGTH_TEXT, OBS_WAVELENGTH_TEXT
+from .wavelengths import REST_WAVELENGTH_TEXT, OBS_WAVELENGTH_TEXT, WavelengthIndex
 
 RED_BACKGROUND = "background-color: rgba(255, 0, 0, 128);"
 
@@ -51,6 +49,7 @@ class SliceController(HubListener):
         self._wavelength_format = '{:.4e}'
         self._wavelength_units = None
         self._wavelengths = None
+        self._wavelength_index = None
 
         # Tracks the index of the synced viewers
         self.synced_index = None
@@ -92,6 +91,9 @@ class SliceController(HubListener):
 
         # Grab the wavelengths so they can be displayed in the text box
         self._wavelengths = message.wavelengths
+        self._wavelength_index = message.wavelength_index
+        if self._wavelength_index is None:
+            self._wavelength_index = WavelengthIndex(self._wavelengths)
         self._wavelength_format = format_minimal(self._wavelengths)[0]
         self._slice_slider.setMaximum(len(self._wavelengths) - 1)
 
@@ -134,13 +136,6 @@ class SliceController(HubListener):
         if tb_index != index:
             self._slice_textbox.setText(str(index))
 
-        try:
-            wavelength = float(self._wavelength_textbox.text())
-            wv_index = np.argsort(abs(self._wavelengths - wavelength))[0]
-        except ValueError:
-            wavelength = -1
-            wv_index = -1
-
         self._wavelength_textbox.setText(self.format_wavelength(self._wavelengths[index]))
 
         slider_index = self._slice_slider.value()
@@ -260,7 +255,7 @@ class SliceController(HubListener):
         try:
             # Find the closest real wavelength and use the index of it
             wavelength = pos if pos is not None else float(self._wavelength_textbox.text())
-            index = np.argsort(abs(self._wavelengths - wavelength))[0]
+            index = self._wavelength_index.nearest(wavelength)
             self._wavelength_textbox.setStyleSheet("")
         except ValueError:
             self._wavelength_textbox.setStyleSheet(RED_BACKGROUND)
@@ -286,7 +281,7 @@ class SliceController(HubListener):
         # then we need to convert the pos to the rest wavelength position.
         if self._cv_layout._wavelength_controller and not self._cv_layout._wavelength_controller.redshift_z == 0.0:
             rest_wavelength = pos / (1 + self._cv_layout._wavelength_controller.redshift_z)
-            pos = np.argsort(abs(self._wavelengths - rest_wavelength))[0]
+            pos = self._wavelength_index.nearest(rest_wavelength)
 
             # Pos is a wavelength and not an index for the call back for specviz
             pos = self._wavelengths[pos]
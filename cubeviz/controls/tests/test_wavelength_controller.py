@@ -1,3 +1,9 @@
+import pytest
+import numpy as np
+
+from ..wavelengths import WavelengthIndex
+
+
 def test_update_specviz(cubeviz_layout):
     """
     Make sure wavelength unit update is reflected in specviz.
@@ -10,3 +16,54 @@ def test_update_specviz(cubeviz_layout):
 
     cubeviz_layout._wavelength_controller.update_units(current_units)
     assert specviz.hub.plot_widget.spectral_axis_unit == current_units
+
+
+def find_nearest_slice(wavelengths, value):
+    return np.argsort(abs(wavelengths - value), kind='stable')[0]
+
+
+@pytest.mark.parametrize('order', ['increasing', 'decreasing', 'tabular'])
+def test_wavelength_index(order):
+    wavelengths = np.linspace(1e-6, 2e-6, 50)
+    if order == 'decreasing':
+        wavelengths = wavelengths[::-1]
+    elif order == 'tabular':
+        wavelengths = np.random.RandomState(0).permutation(wavelengths)
+        wavelengths[10] = wavelengths[20]
+
+    index = WavelengthIndex(wavelengths)
+    queries = np.concatenate([np.linspace(0.5e-6, 2.5e-6, 301), wavelengths,
+                              (wavelengths[:-1] + wavelengths[1:]) / 2])
+    expected = [find_nearest_slice(wavelengths, value) for value in queries]
+
+    assert [index.nearest(value) for value in queries] == expected
+    np.testing.assert_array_equal(index.nearest(queries), expected)
+    assert WavelengthIndex(wavelengths[:1]).nearest(1.) == 0
+
+
+@pytest.mark.parametrize('wavelengths', [[1., 2., 3., 3.], [3., 3., 2., 1.], [1., 1., 2., 3.],
+                                         [3., 1., 3., 2., 1.]])
+def test_wavelength_index_ties(wavelengths):
+    # Outside of the range the first of the slices with the same wavelength is used
+    wavelengths = np.array(wavelengths)
+    index = WavelengthIndex(wavelengths)
+    queries = np.array([-10., 0., 1., 1.5, 2.5, 3., 3.5, 10.])
+    expected = [find_nearest_slice(wavelengths, value) for value in queries]
+
+    assert [index.nearest(value) for value in queries] == expected
+    np.testing.assert_array_equal(index.nearest(queries), expected)
+
+
+def test_wavelength_index_update(cubeviz_layout):
+    """
+    Make sure the wavelength index follows the unit changes.
+    """
+    controller = cubeviz_layout._wavelength_controller
+    current_units = str(controller.current_units)
+    wavelength = controller.wavelengths[100]
+
+    controller.update_units('Angstrom')
+    assert controller.wavelength_index.nearest(controller.wavelengths[100]) == 100
+
+    controller.update_units(current_units)
+    assert controller.wavelength_index.nearest(wavelength) == 100
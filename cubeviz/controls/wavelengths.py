@@ -1,3 +1,4 @@
+import numpy as np
 from astropy import units as u
 
 from ..messages import WavelengthUpdateMessage, WavelengthUnitUpdateMessage, RedshiftUpdateMessage
@@ -7,12 +8,68 @@ OBS_WAVELENGTH_TEXT = 'Obs Wavelength'
 REST_WAVELENGTH_TEXT = 'Rest Wavelength'
 
 
+class WavelengthIndex(object):
+    """
+    Nearest slice lookups in the wavelengths of a cube, in O(log n) with
+    `numpy.searchsorted` rather than sorting the distances to every
+    wavelength at each lookup.
+
+    The wavelengths are usually increasing; those of other spectral axes
+    (decreasing, or not monotonic such as tabular axes) are sorted once,
+    keeping the slice index of each.
+
+    :param wavelengths: array-like (or Quantity), the wavelength of each slice
+    """
+
+    def __init__(self, wavelengths):
+        values = np.asarray(getattr(wavelengths, 'value', wavelengths), dtype=float).ravel()
+
+        # Slice index of each sorted wavelength, None if already sorted
+        self._order = None if np.all(np.diff(values) >= 0) else np.argsort(values, kind='stable')
+        self._sorted = values if self._order is None else values[self._order]
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def _slice_index(self, position):
+        return position if self._order is None else self._order[position]
+
+    def nearest(self, wavelength):
+        """
+        Index of the slice whose wavelength is the nearest to ``wavelength``
+        (the first slice of those as near).
+
+        :param wavelength: float, or array-like for several lookups at once
+        :return: int, or numpy.ndarray of int
+        """
+        query = np.asarray(getattr(wavelength, 'value', wavelength), dtype=float)
+        if len(self._sorted) < 2:
+            index = np.zeros(query.shape, dtype=int)
+        else:
+            # The nearest wavelength is one of those around the query
+            right = np.clip(np.searchsorted(self._sorted, query), 1, len(self._sorted) - 1)
+            # The first of the slices with the same wavelength (outside of
+            # the range, both can be in the same group)
+            left = np.searchsorted(self._sorted, self._sorted[right - 1])
+            right = np.searchsorted(self._sorted, self._sorted[right])
+            left_distance = np.abs(query - self._sorted[left])
+            right_distance = np.abs(self._sorted[right] - query)
+
+            left, right = self._slice_index(left), self._slice_index(right)
+            use_right = ((right_distance < left_distance) |
+                         ((right_distance == left_distance) & (right < left)))
+            index = np.where(use_right, right, left)
+
+        return int(index) if index.ndim == 0 else index
+
+
 class WavelengthController:
     def __init__(self, cubeviz_layout):
         self._cv_layout = cubeviz_layout
         self._hub = cubeviz_layout.session.hub
         ui = cubeviz_layout.ui
         self._wavelengths = []
+        self._wavelength_index = None
         self._original_wavelengths = []
         self._original_units = u.m
         self._current_units = self._original_units
@@ -28,7 +85,7 @@ class WavelengthController:
         self._wavelength_textbox_label = ui.wavelength_textbox_label.text()
 
     def enable(self, units, wavelength):
-        self._wavelengths = wavelength
+        self._set_wavelengths(wavelength)
         self._original_wavelengths = wavelength
         self._send_wavelength_message(wavelength)
         self._send_wavelength_unit_message(units)
@@ -37,6 +94,14 @@ class WavelengthController:
     def wavelengths(self):
         return self._wavelengths
 
+    @property
+    def wavelength_index(self):
+        """
+        The `WavelengthIndex` of the current wavelengths (in the current
+        units and at the current redshift).
+        """
+        return self._wavelength_index
+
     @property
     def wavelength_label(self):
         return self._wavelength_textbox_label
@@ -77,7 +142,7 @@ class WavelengthController:
 
     def update_units(self, units):
 
-        self._wavelengths = (self._wavelengths * self._current_units).to(units) / units
+        self._set_wavelengths((self._wavelengths * self._current_units).to(units) / units)
 
         self._current_units = units
 
@@ -100,7 +165,7 @@ class WavelengthController:
             self._wavelength_textbox_label = OBS_WAVELENGTH_TEXT
 
         orig_redshift = (1.0 / (1 + redshift)) * self._original_wavelengths * self._original_units
-        self._wavelengths = orig_redshift.to(self._current_units)/ self._current_units
+        self._set_wavelengths(orig_redshift.to(self._current_units)/ self._current_units)
 
         # This calls the setter above, so really, the magic is there.
         self._redshift_z = redshift
@@ -108,8 +173,12 @@ class WavelengthController:
         self._send_redshift_message(redshift)
         self._send_wavelength_message(self._wavelengths)
 
+    def _set_wavelengths(self, wavelengths):
+        self._wavelengths = wavelengths
+        self._wavelength_index = WavelengthIndex(wavelengths)
+
     def _send_wavelength_message(self, wavelengths):
-        msg = WavelengthUpdateMessage(self, wavelengths)
+        msg = WavelengthUpdateMessage(self, wavelengths, wavelength_index=self._wavelength_index)
         self._hub.broadcast(msg)
 
     def _send_wavelength_unit_message(self, units):
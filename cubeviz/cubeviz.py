@@ -64,7 +64,7 @@ def _create_glue_app(data_collection, hub):
 
 
 def create_app(datafiles=[], data_configs=[], data_configs_show=False,
-               interactive=True):
+               interactive=True, lazy=None, config_cache=None):
     """
     Create and initialize a cubeviz application instance
 
@@ -78,6 +78,13 @@ def create_app(datafiles=[], data_configs=[], data_configs_show=False,
         Display matching info about data configuration files
     interactive : `bool`
         Flag to indicate whether session is interactive or not (i.e. for testing)
+    lazy : `bool`
+        Force (or disable) lazy, memory-mapped loading of the data cubes. If
+        `None`, the setting of each data configuration file is used.
+    config_cache : `str` or `bool`
+        File the parsed data configuration files are cached in. If `None`,
+        the default one in the cubeviz cache directory is used, and if `False`
+        they are parsed every time and nothing is written to disk.
     """
     app = get_qapp()
 
@@ -94,7 +101,8 @@ def create_app(datafiles=[], data_configs=[], data_configs_show=False,
     # plugins.
     load_plugins(splash=splash)
 
-    dfc_kwargs = dict(remove_defaults=True, check_ifu_valid=interactive)
+    dfc_kwargs = dict(remove_defaults=True, check_ifu_valid=interactive, lazy=lazy,
+                      config_cache=config_cache)
     DataFactoryConfiguration(data_configs, data_configs_show, **dfc_kwargs)
 
     # Check to make sure each file exists and raise an Exception
@@ -146,6 +154,9 @@ def main(argv=sys.argv):
     parser.add_argument(
         "--data-configs-show", help="Show the matching info",
         action="store_true", default=False)
+    parser.add_argument(
+        "--lazy", help="Memory map the data cubes and only read the slices that are displayed",
+        action="store_true", default=None)
     parser.add_argument('data_files', nargs=argparse.REMAINDER)
     args = parser.parse_known_args(argv[1:])
 
@@ -153,6 +164,7 @@ def main(argv=sys.argv):
     # Store the args for each ' --data-configs' found on the commandline
     data_configs = args[0].data_configs
     data_configs_show = args[0].data_configs_show
+    lazy = args[0].lazy
 
-    app = create_app(datafiles, data_configs, data_configs_show)
+    app = create_app(datafiles, data_configs, data_configs_show, lazy=lazy)
     app.start(maximized=True)
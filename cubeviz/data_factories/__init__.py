@@ -1,10 +1,12 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from os.path import basename, splitext
-import yaml
 import os
 import sys
 import glob
 import logging
+import weakref
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 from glue.core import Data, Subset
 from glue.core.coordinates import coordinates_from_header
@@ -14,6 +16,13 @@ from astropy.io import fits
 import numpy as np
 
 from cubeviz.data_factories.ifucube import IFUCube
+from cubeviz.data_factories.lazy import LazyFITSComponent, scale_raw_data, native_dtype, is_compressed
+from cubeviz.data_factories.fits_cache import HDULIST_CACHE
+from cubeviz.data_factories.fits_export import FITSPlan, write_fits, can_copy_from
+from cubeviz.data_factories.matching import ConfigurationMatcher, header_index
+from cubeviz.data_factories.asdf_files import (ASDF_CACHE, LazyASDFArray, is_asdf, asdf_value,
+                                               asdf_arrays, asdf_coordinates)
+from cubeviz.data_factories.config_cache import ConfigurationCache, read_configuration
 from ..listener import CUBEVIZ_LAYOUT
 
 from glue.utils.qt import load_ui
@@ -28,6 +37,12 @@ logger.setLevel(logging.INFO)
 DEFAULT_DATA_CONFIGS = os.path.join(os.path.dirname(__file__), 'configurations')
 CUBEVIZ_DATA_CONFIGS = 'CUBEVIZ_DATA_CONFIGS'
 
+# Maximum number of files of a mosaic that are loaded at the same time
+MAX_LOADER_THREADS = 8
+
+# Extensions that hold bitmasks and are kept as integers
+BITMASK_EXTNAMES = ['DQ', 'MASK', 'QUALITY', 'BPM']
+
 
 class DataConfiguration:
     """
@@ -35,38 +50,59 @@ class DataConfiguration:
 
     """
 
-    def __init__(self, config_file, check_ifu_valid=True):
+    def __init__(self, config_file, check_ifu_valid=True, lazy=None, configuration_matcher=None, cfg=None):
         """
         Given the configuration file, save it and grab the name and priority
         :param config_file:
+        :param lazy: If set, overrides the ``lazy`` setting of the configuration file
+        :param configuration_matcher: ConfigurationMatcher shared by all the configurations
+        :param cfg: The already parsed configuration file, if available
         """
         self._config_file = config_file
         self._check_ifu_valid = check_ifu_valid
 
-        # If we are testing, then don't display the popup
-        if self._check_ifu_valid:
-            self.popup_ui = load_ui('ifucube_popup.ui', None, directory=os.path.dirname(__file__))
+        # The popup is only loaded the first time it is needed (see popup_ui)
+        self._popup_ui = None
 
-        with open(self._config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
+        if cfg is None:
+            cfg = read_configuration(self._config_file)
 
-            self._name = cfg['name']
-            self._type = cfg['type']
+        self._name = cfg['name']
+        self._type = cfg['type']
+        self._priority = cfg['priority']
 
+        self._configuration = cfg['match']
 
-            try:
-                self._priority = int(cfg.get('priority', 0))
-            except Exception:
-                self._priority = 0
+        # Compile the match criteria once, collecting the header keys they use.
+        self._header_keys = set()
+        self._matcher = self._compile('all', self._configuration['all'])
+        self._configuration_matcher = configuration_matcher
 
-            self._configuration = cfg['match']
+        self._data = cfg.get('data', None)
 
-            self._data = cfg.get('data', None)
+        # How the components are stored: 'native', 'float32' or 'float64'
+        self._dtype = cfg.get('dtype', 'float64')
+        self._extension_dtypes = {}
+        self._bitmask_extensions = set(BITMASK_EXTNAMES)
 
-            if 'flux_unit_replacements' in cfg:
-                self.flux_unit_replacements = cfg['flux_unit_replacements']
-            else:
-                self.flux_unit_replacements = {}
+        # The entries of the data section are either an extension name or a
+        # mapping with the extension name and the dtype to store it as.
+        for role, extension in (self._data or {}).items():
+            if isinstance(extension, dict):
+                if 'dtype' in extension:
+                    self._extension_dtypes[str(extension['extension']).upper()] = extension['dtype']
+                extension = extension['extension']
+            if str(role).upper() == 'DQ':
+                self._bitmask_extensions.add(str(extension).upper())
+
+        # In lazy mode the cubes are only read (and converted to their
+        # dtype) one slice at a time from the memory mapped file.
+        self._lazy = bool(cfg.get('lazy', False)) if lazy is None else lazy
+
+        if 'flux_unit_replacements' in cfg:
+            self.flux_unit_replacements = cfg['flux_unit_replacements']
+        else:
+            self.flux_unit_replacements = {}
 
     @property
     def name(self):
@@ -76,6 +112,23 @@ class DataConfiguration:
     def type(self):
         return self._type
 
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def lazy(self):
+        return self._lazy
+
+    @property
+    def popup_ui(self):
+        """
+        The popup shown when the file fails the IFUCube checks.
+        """
+        if self._popup_ui is None:
+            self._popup_ui = load_ui('ifucube_popup.ui', None, directory=os.path.dirname(__file__))
+        return self._popup_ui
+
     def get_units(self, header):
         """
         Extract BUNIT from header.
@@ -127,6 +180,9 @@ class DataConfiguration:
         Load the data based on the extensions defined in the matching YAML file.  THen
         create the datacube and return it.
 
+        When several (comma separated) files are given they are opened, checked and
+        converted concurrently, and the components are then added in the order of the files.
+
         :param data_filename:
         :return:
         """
@@ -134,58 +190,231 @@ class DataConfiguration:
         label = None
         data = None
 
-        ifucube = IFUCube()
+        data_filenames = data_filenames.split(',')
 
-        for data_filename in data_filenames.split(','):
+        if len(data_filenames) > 1:
+            max_workers = min(len(data_filenames), MAX_LOADER_THREADS, os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(self._read_file, filename) for filename in data_filenames]
 
-            hdulist = ifucube.open(data_filename, fix=self._check_ifu_valid)
+            try:
+                results = [future.result() for future in futures]
+            except Exception:
+                # Give back the files that were opened before re-raising
+                for filename, future in zip(data_filenames, futures):
+                    if future.exception() is None:
+                        self._file_cache(filename).release(future.result()[0])
+                raise
+        else:
+            results = [self._read_file(data_filenames[0])]
+
+        # Number of the files whose reference is owned by the data
+        owned = 0
+        try:
+            for data_filename, (handle, ifucube, coords, components) in zip(data_filenames, results):
+
+                # Good in this case means the file has 3D data and can be loaded by SpectralCube.read
+                if self._check_ifu_valid and ifucube is not None and not ifucube.get_good():
+                    # Popup takes precedence and accepting continues operation and canceling closes the program
+                    self.popup_ui.ifucube_log.setText(ifucube.get_log_output())
+                    self.popup_ui.setModal(True)
+                    self.popup_ui.show()
+
+                    self.popup_ui.button_accept.clicked.connect(self._accept_button_click)
+                    self.popup_ui.button_cancel.clicked.connect(self._reject_button_click)
+
+                if not label:
+                    label = "{}: {}".format(self._name, splitext(basename(data_filename))[0])
+                    data = Data(label=label)
+
+                    # this attribute is used to indicate to the cubeviz layout that
+                    # this is a cubeviz-specific data component.
+                    data.meta[CUBEVIZ_LAYOUT] = self._name
+
+                # Set the coords based on the first 3D HDU
+                if coords is not None:
+                    data.coords = coords
+
+                for component_name, component, units in components:
+                    data.add_component(component=component, label=component_name)
+
+                    if units is not None:
+                        c = data.get_component(component_name)
+                        c.units = units
+
+                # For the purposes of exporting, we keep a reference to the original HDUList object
+                if not is_asdf(data_filename):
+                    data._cubeviz_hdulist = handle
+                    data._cubeviz_header_edits = ifucube.get_header_edits()
+                    data._cubeviz_loaded = dict((name, data.get_component(name).data) for name, _, _ in components)
+                else:
+                    data._cubeviz_asdffile = handle
+
+                # The data owns the reference to the file (the lazy components
+                # and the exporter read from it), so it is released with the data.
+                weakref.finalize(data, self._file_cache(data_filename).release, handle)
+                owned += 1
+        except Exception:
+            # Give back the files not owned by the data before re-raising
+            for data_filename, result in list(zip(data_filenames, results))[owned:]:
+                self._file_cache(data_filename).release(result[0])
+            raise
+
+        return data
 
-            # Good in this case means the file has 3D data and can be loaded by SpectralCube.read
-            if self._check_ifu_valid and not ifucube.get_good():
-                # Popup takes precedence and accepting continues operation and canceling closes the program
-                self.popup_ui.ifucube_log.setText(ifucube.get_log_output())
-                self.popup_ui.setModal(True)
-                self.popup_ui.show()
+    @staticmethod
+    def _file_cache(data_filename):
+        return ASDF_CACHE if is_asdf(data_filename) else HDULIST_CACHE
 
-                self.popup_ui.button_accept.clicked.connect(self._accept_button_click)
-                self.popup_ui.button_cancel.clicked.connect(self._reject_button_click)
+    def _read_file(self, data_filename):
+        """
+        Open and check a file and convert each of its 3D HDUs to a component. This
+        does not touch the glue Data or the UI so it can run on the loader threads.
+
+        :param data_filename:
+        :return: HDUList, IFUCube, coordinates and list of (component name, component, units)
+        """
+        if is_asdf(data_filename):
+            return self._read_asdf_file(data_filename)
 
-            if not label:
-                label = "{}: {}".format(self._name, splitext(basename(data_filename))[0])
-                data = Data(label=label)
+        ifucube = IFUCube()
+        hdulist = ifucube.open(data_filename, fix=self._check_ifu_valid)
 
-                # this attribute is used to indicate to the cubeviz layout that
-                # this is a cubeviz-specific data component.
-                data.meta[CUBEVIZ_LAYOUT] = self._name
+        # The caller owns the reference to the file only if this returns
+        try:
+            # The checked (and fixed) copies of the headers, the HDUList is shared
+            headers = ifucube.get_headers()
 
-            data_coords_set = False
+            coords = None
+            components = []
             for ii, hdu in enumerate(hdulist):
-                if 'NAXIS' in hdu.header and hdu.header['NAXIS'] == 3:
+                header = headers[ii]
+                if 'NAXIS' in header and header['NAXIS'] == 3:
+
+                    if coords is None:
+                        coords = coordinates_from_header(header)
+
+                    # Creates a unique component name if there is no EXTNAME
+                    component_name = header.get('EXTNAME', str(ii))
+
+                    units = None
+                    if 'EXTNAME' in header and 'BUNIT' in header:
+                        units = self.get_units(header)
+
+                    components.append((component_name, self._make_component(hdu), units))
+
+            return hdulist, ifucube, coords, components
+        except Exception:
+            if hdulist is not None:
+                HDULIST_CACHE.release(hdulist)
+            raise
+
+    def _read_asdf_file(self, data_filename):
+        """
+        Open an ASDF file and wrap each of its 3D arrays in a component. The
+        arrays are memory mapped and only copied if they have to be converted
+        to another dtype. The IFUCube checks only apply to FITS headers and are
+        not run.
+
+        :param data_filename:
+        :return: AsdfFile, None, coordinates and list of (component name, component, units)
+        """
+        asdffile = ASDF_CACHE.acquire(data_filename)
+
+        # The caller owns the reference to the file only if this returns
+        try:
+            tree = asdffile.tree
+
+            coords = None
+            components = []
+            for name, array in asdf_arrays(tree):
+                if len(array.shape) == 3:
 
-                    # Set the coords based on the first 3D HDU
-                    if not data_coords_set:
-                        data.coords = coordinates_from_header(hdu.header)
-                        data_coords_set = True
+                    # The coordinates are the same for all the arrays
+                    if coords is None:
+                        coords = asdf_coordinates(tree)
 
-                    component_name = str(ii)
-                    if 'EXTNAME' in hdu.header:
-                        component_name = hdu.header['EXTNAME']
+                    # The JWST data models keep the units in meta.bunit_<name>
+                    units = asdf_value(tree, 'bunit_{}'.format(name))
+                    if units is not None:
+                        units = self.get_units({'BUNIT': units})
 
-                        # The data must be floating point as spectralcube is expecting floating point data
-                        data.add_component(component=hdu.data.astype(np.float), label=component_name)
+                    file_dtype = np.dtype(array.dtype).newbyteorder('=')
+                    dtype = self._component_dtype(name, file_dtype)
 
-                        if 'BUNIT' in hdu.header:
-                            c = data.get_component(component_name)
-                            c.units = self.get_units(hdu.header)
+                    # The memory mapped array is used as is (whatever its byte order)
+                    if file_dtype == dtype:
+                        component = np.asarray(array)
+                    elif self._lazy:
+                        component = LazyASDFArray(array, dtype=dtype)
                     else:
-                        # Creates a unique component name
-                        component_name = str(ii)
-                        data.add_component(component=hdu.data.astype(np.float), label=component_name)
+                        component = np.asarray(array).astype(dtype)
 
-            # For the purposes of exporting, we keep a reference to the original HDUList object
-            data._cubeviz_hdulist = hdulist
+                    components.append((name, component, units))
 
-        return data
+            return asdffile, None, coords, components
+        except Exception:
+            ASDF_CACHE.release(asdffile)
+            raise
+
+    def _make_component(self, hdu):
+        """
+        Create the component for the cube in the HDU.
+
+        Tile-compressed cubes are always loaded lazily so that only the tiles
+        that are looked at are decompressed.
+
+        :param hdu: 3D HDU
+        :return: LazyFITSComponent in lazy mode, numpy array otherwise
+        """
+        dtype = self._component_dtype(hdu.name, native_dtype(hdu.header))
+
+        if self._lazy or is_compressed(hdu):
+            return LazyFITSComponent(hdu, dtype=dtype)
+        else:
+            return scale_raw_data(hdu.data, hdu.header, dtype)
+
+    def _component_dtype(self, extname, dtype):
+        """
+        The dtype a component is stored as, following the dtype policy of the
+        extension (from the ``data`` section) or of the configuration.
+
+        Bitmask extensions (DQ) stored as integers are always kept as integers
+        unless a dtype is given for the extension itself. The tools convert
+        the data they work on to floating point as needed.
+
+        :param extname: name of the extension
+        :param dtype: dtype of the values in the file
+        :return: numpy.dtype
+        """
+        extname = extname.upper()
+
+        if extname in self._extension_dtypes:
+            policy = self._extension_dtypes[extname]
+        elif extname in self._bitmask_extensions and dtype.kind in 'iu':
+            policy = 'native'
+        else:
+            policy = self._dtype
+
+        if policy == 'native':
+            return dtype
+        return np.dtype(policy)
+
+    @property
+    def header_keys(self):
+        """
+        The primary header keys used by the match criteria.
+        """
+        return self._header_keys
+
+    def match(self, header_index):
+        """
+        Evaluate the compiled match criteria against the headers of a file.
+
+        :param header_index: HeaderIndex of the file
+        :return: bool
+        """
+        return self._matcher(header_index)
 
     def matches(self, filename):
         """
@@ -197,10 +426,12 @@ class DataConfiguration:
         """
         # Check the "first filename in the list" which might be the "only filename" in the list.
         filename = filename.split(',')[0]
-        self._fits = fits.open(filename)
 
-        # Now call the internal processing.
-        matches = self._process('all', self._configuration['all'])
+        # The shared matcher evaluates all the configurations in one pass over the headers.
+        if self._configuration_matcher is not None:
+            matches = self._configuration_matcher.matches(self, filename)
+        else:
+            matches = self.match(header_index(filename, self._header_keys))
 
         if matches:
             logger.debug('{} matches {}'.format(self._config_file, filename))
@@ -209,13 +440,14 @@ class DataConfiguration:
 
         return matches
 
-    def _process(self, key, conditional):
+    def _compile(self, key, conditional):
         """
-        Internal processing. This will get called numerous times recursively.
+        Internal compilation of the match criteria into a function of a
+        HeaderIndex. This will get called numerous times recursively.
 
         :param key: The type of check we want to do
         :param conditional: The thing we are checking
-        :return:
+        :return: function
         """
 
         if 'all' == key:
@@ -231,6 +463,8 @@ class DataConfiguration:
         elif 'has_data' == key:
             return self._has_data()
 
+        raise ValueError('Unknown match criteria {} in {}'.format(key, self._config_file))
+
     #
     # Branch processing
     #
@@ -242,12 +476,8 @@ class DataConfiguration:
         :param conditionals:
         :return:
         """
-        logger.debug('\tall: {}'.format(conditionals))
-        for key, conditional in conditionals.items():
-            ret = self._process(key, conditional)
-            if not ret:
-                return False
-        return True
+        checks = [self._compile(key, conditional) for key, conditional in conditionals.items()]
+        return lambda index: all(check(index) for check in checks)
 
     def _any(self, conditionals):
         """
@@ -256,15 +486,8 @@ class DataConfiguration:
         :param conditionals:
         :return:
         """
-
-        logger.debug('\tany: {}'.format(conditionals))
-        for key, conditional in conditionals.items():
-            # process conditional
-            ret = self._process(key, conditional)
-            if ret:
-                return ret
-
-        return False
+        checks = [self._compile(key, conditional) for key, conditional in conditionals.items()]
+        return lambda index: any(check(index) for check in checks)
 
     #
     # Leaf processing
@@ -276,10 +499,7 @@ class DataConfiguration:
         is currently only in use in the default.yaml file
         :return:
         """
-        for hdu in self._fits:
-            if hasattr(hdu, 'data') and hdu.data is not None and hasattr(hdu.data, 'shape') and len(hdu.data.shape) == 3:
-                return True
-        return False
+        return lambda index: index.has_3d_data
 
     def _equal(self, value):
         """
@@ -288,8 +508,9 @@ class DataConfiguration:
         :param value:
         :return:
         """
-        logger.debug('\tequality: {} = {} ?'.format(self._fits[0].header.get(value['header_key'], False), value['value']))
-        return self._fits[0].header.get(value['header_key'], False) == value['value']
+        header_key, expected = value['header_key'], value['value']
+        self._header_keys.add(header_key)
+        return lambda index: index.get(header_key, False) == expected
 
     def _startswith(self, value):
         """
@@ -298,8 +519,9 @@ class DataConfiguration:
         :param value:
         :return:
         """
-        logger.debug('\tstartswith: {} starswith {} ?'.format(self._fits[0].header.get(value['header_key'], False), value['value']))
-        return self._fits[0].header.get(value['header_key'], '').startswith(value['value'])
+        header_key, expected = value['header_key'], value['value']
+        self._header_keys.add(header_key)
+        return lambda index: str(index.get(header_key, '')).startswith(expected)
 
     def _extension_names(self, value):
         """
@@ -308,13 +530,9 @@ class DataConfiguration:
         :param value:
         :return:
         """
-        logger.debug('\tcontains extension: {} in {} ?'.format(value,
-                                                               [x.header['EXTNAME'] for x in self._fits if 'EXTNAME' in x.header]))
-
         if isinstance(value, str):
-            return value in self._fits
-        else:
-            return all([v in self._fits for v in value])
+            value = [value]
+        return lambda index: all(index.has_extension(v) for v in value)
 
     def summarize(self):
         """
@@ -373,12 +591,16 @@ class DataFactoryConfiguration:
        2. from the command line "--data-configs <file-or-directory>"
        3. from the environment variable CUBEVIZ_DATA_CONFIGS=<files-or-directories>
     """
-    def __init__(self, in_configs=[], show_only=False, remove_defaults=False, check_ifu_valid=True):
+    def __init__(self, in_configs=[], show_only=False, remove_defaults=False, check_ifu_valid=True, lazy=None,
+                 config_cache=None):
         """
         The IFC takes either a directory (that contains YAML files), a list of directories (each of which contain
         YAML files) or a list of YAML files.  Each YAML file defines requirements
 
         :param in_configs: Directory, list of directories, or list of files.
+        :param lazy: If set, force (True) or disable (False) lazy loading for all the configurations.
+        :param config_cache: File the parsed YAML files are cached in, the default one (see ConfigurationCache)
+                             if None, or False to not cache them on disk.
         """
 
         # Remove all pre-defined data configuration loaders in Glue. Then, if a user tries to open an IFU FITS
@@ -408,29 +630,24 @@ class DataFactoryConfiguration:
         logger.debug(
             'YAML data configuration files: {}'.format('\n'.join(self._config_files)))
 
-        for config_file in self._config_files:
+        # All the configurations are matched against a file in one pass over its headers
+        self._configuration_matcher = ConfigurationMatcher()
 
-            # Load the YAML file and get the name, priority and create the data factory wrapper
-            with open(config_file, 'r') as yamlfile:
-                cfg = yaml.load(yamlfile)
+        # Load the YAML files, or their cached parsed version if they did not change
+        cfgs = ConfigurationCache(config_cache).load(self._config_files)
 
-            name = cfg['name']
-
-            try:
-                priority = int(cfg.get('priority', 0))
-            except:
-                priority = 0
+        for config_file, cfg in zip(self._config_files, cfgs):
 
             # The code below instantiates a data configuration object based on the config file and is
             # therefore dependent on the type of data file.  The data configuration object defines two functions
             # 'matches' and 'load_data' that are used.  We needed a way to call Glue's data_factory and be able
             # to pass in functions that have state information.
-            dc = DataConfiguration(config_file, check_ifu_valid=check_ifu_valid)
-            wrapper = data_factory(name, dc.matches, priority=priority)
+            dc = DataConfiguration(config_file, check_ifu_valid=check_ifu_valid, lazy=lazy,
+                                   configuration_matcher=self._configuration_matcher, cfg=cfg)
+            self._configuration_matcher.register(dc)
+            wrapper = data_factory(dc.name, dc.matches, priority=dc.priority)
             wrapper(dc.load_data)
 
-
-
     def _find_yaml_files(self, files_or_directories):
         """
         Given the files_or_directories, create a list of all relevant YAML files.
@@ -469,18 +686,98 @@ class DataFactoryConfiguration:
 
 @data_exporter('CubeViz FITS exporter', extension=['fits', 'fit'])
 def cubeviz_fits_exporter(filename, data, components=None):
+    """
+    Export the data to a FITS file with the HDUs of the file it was loaded from.
+
+    The HDUs of the original file are copied from it byte for byte and only
+    the new (or modified) components are written, a block at a time. Files
+    named ``.gz`` (or ``.bz2``, ``.xz``) are compressed.
+
+    Data loaded from ASDF files is written as a new FITS file of its
+    components (with a warning), without the rest of the ASDF tree.
+    """
 
     if isinstance(data, Subset):
         raise NotImplementedError("Can't export subsets yet")
 
     if not hasattr(data, '_cubeviz_hdulist'):
+        if hasattr(data, '_cubeviz_asdffile'):
+            warnings.warn('{} was loaded from an ASDF file: only its components and coordinates '
+                          'are exported to {}, not the metadata of the file'.format(data.label, filename))
         return fits_writer(filename, data, components=components)
 
     if components is None:
         components = data.visible_components
 
+    hdulist = data._cubeviz_hdulist
+
+    if HDULIST_CACHE.is_stale(hdulist) or not can_copy_from(hdulist):
+        return _cubeviz_fits_exporter_copy(filename, data, components)
+
+    component_labels = [cid.label for cid in components]
+
+    # The arrays the components were loaded with, to find the modified ones
+    loaded = getattr(data, '_cubeviz_loaded', {})
+
+    # The header values set by the IFU cube checks, for each HDU index
+    header_edits = getattr(data, '_cubeviz_header_edits', {})
+
+    plan = FITSPlan(hdulist)
+    written = set()
+
+    # Remove any HDUs with data that don't have a matching component
+    for ii, hdu in enumerate(hdulist):
+        edits = header_edits.get(ii)
+        name = edits.get('EXTNAME', hdu.name) if edits else hdu.name
+        if hdu.header.get('NAXIS', 0) == 0:
+            plan.copy(hdu, edits)
+        elif name in component_labels:
+            comp = data.get_component(name)
+            if name in loaded and comp.data is not loaded[name]:
+                plan.array(name, comp.data, _edited_header(hdu.header, edits))
+            else:
+                plan.copy(hdu, edits)
+            written.add(name)
+
+    # Add any other components
+    for cid in components:
+
+        if cid.label in written:
+            continue
+
+        comp = data.get_component(cid)
+
+        if comp.categorical:
+            raise NotImplementedError()
+
+        plan.array(cid.label, comp.data, data.coords.wcs.to_header())
+
+    write_fits(filename, plan)
+
+
+def _edited_header(header, edits):
+    if not edits:
+        return header
+    header = header.copy()
+    for key, value in edits.items():
+        header[key] = value
+    return header
+
+
+def _cubeviz_fits_exporter_copy(filename, data, components):
+    """
+    Export by copying the HDUList in memory, for files the HDUs can not be
+    copied from (e.g. files that changed on disk since they were loaded).
+    """
     hdulist = fits.HDUList(data._cubeviz_hdulist.copy())
 
+    # The HDUs are shared with the cache of open files, those with header
+    # values set by the IFU cube checks are copied before setting them.
+    for ii, edits in getattr(data, '_cubeviz_header_edits', {}).items():
+        hdulist[ii] = hdulist[ii].copy()
+        for key, value in edits.items():
+            hdulist[ii].header[key] = value
+
     component_labels = [cid.label for cid in components]
 
     # Remove any HDUs with data that don't have a matching component
@@ -499,7 +796,7 @@ def cubeviz_fits_exporter(filename, data, components=None):
         if comp.categorical:
             raise NotImplementedError()
 
-        hdu = fits.ImageHDU(comp.data, data.coords.wcs.to_header(), name=cid.label)
+        hdu = fits.ImageHDU(np.asarray(comp.data), data.coords.wcs.to_header(), name=cid.label)
         hdulist.append(hdu)
 
     try:
@@ -0,0 +1,169 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Native loading of the cubes stored in ASDF files (e.g. the JWST IFU cubes).
+
+The files are opened with the block arrays memory mapped, so nothing is read
+until it is used and nothing is copied when the arrays are stored with the
+dtype they have in the file. For the data configurations the ``meta``
+entries of the tree play the role of the primary header and the arrays of
+the tree the role of the extensions.
+"""
+import atexit
+import logging
+
+import asdf
+import numpy as np
+from astropy.io import fits
+
+from glue.core.coordinates import coordinates_from_header
+
+from .fits_cache import HDUListCache
+from .lazy import LazyArray
+
+__all__ = ['is_asdf', 'open_asdf', 'asdf_value', 'asdf_arrays', 'asdf_coordinates',
+           'LazyASDFArray', 'ASDF_CACHE']
+
+log = logging.getLogger('cubeviz_asdf_files')
+log.setLevel(logging.WARNING)
+
+ASDF_MAGIC = b'#ASDF'
+
+# Where the JWST data models store the equivalent of these FITS keywords
+ASDF_KEYWORDS = {
+    'TELESCOP': ('meta', 'telescope'),
+    'INSTRUME': ('meta', 'instrument', 'name'),
+    'DETECTOR': ('meta', 'instrument', 'detector'),
+    'DATAMODL': ('meta', 'model_type'),
+    'EXP_TYPE': ('meta', 'exposure', 'type'),
+    'FILENAME': ('meta', 'filename'),
+}
+
+# The FITS WCS keywords (lower case) that can be found in meta.wcsinfo
+WCSINFO_KEYWORDS = ['wcsaxes', 'radesys', 'specsys', 'equinox', 'velosys']
+for _axis in range(1, 4):
+    WCSINFO_KEYWORDS += ['{}{}'.format(k, _axis) for k in ['crpix', 'crval', 'cdelt', 'ctype', 'cunit']]
+    WCSINFO_KEYWORDS += ['pc{}_{}'.format(_axis, ii) for ii in range(1, 4)]
+
+
+def is_asdf(filename):
+    """
+    Whether the file is an ASDF file, from its first bytes.
+
+    :param filename: path of the file
+    :return: bool
+    """
+    try:
+        with open(filename, 'rb') as fp:
+            return fp.read(len(ASDF_MAGIC)) == ASDF_MAGIC
+    except OSError:
+        return False
+
+
+def open_asdf(filename):
+    """
+    Open an ASDF file with its block arrays memory mapped.
+
+    :param filename: path of the file
+    :return: asdf.AsdfFile
+    """
+    try:
+        return asdf.open(filename, lazy_load=True, memmap=True)
+    except TypeError:
+        # Versions of asdf before 3.1
+        return asdf.open(filename, lazy_load=True, copy_arrays=False)
+
+
+def _lookup(tree, path):
+    for key in path:
+        try:
+            tree = tree[key]
+        except (KeyError, TypeError, IndexError):
+            return None
+    return tree
+
+
+def asdf_value(tree, key):
+    """
+    The value in the ASDF tree standing for the FITS keyword ``key``.
+
+    The known keywords (see ``ASDF_KEYWORDS``) are looked up where the JWST
+    data models store them, the others in ``meta`` and then at the top of
+    the tree. Only scalar values are returned.
+
+    :param tree: ASDF tree
+    :param key: keyword
+    :return: the value, or None
+    """
+    paths = []
+    if str(key).upper() in ASDF_KEYWORDS:
+        paths.append(ASDF_KEYWORDS[str(key).upper()])
+    paths += [('meta', key), ('meta', str(key).lower()), (key,)]
+
+    for path in paths:
+        value = _lookup(tree, path)
+        if isinstance(value, (str, bool, int, float)):
+            return value
+
+    return None
+
+
+def asdf_arrays(tree):
+    """
+    The arrays at the top of the ASDF tree, without reading them.
+
+    :param tree: ASDF tree
+    :return: list of (name, array)
+    """
+    return [(name, value) for name, value in tree.items()
+            if hasattr(value, 'shape') and hasattr(value, 'dtype')]
+
+
+def asdf_coordinates(tree):
+    """
+    The glue coordinates of the cube in the ASDF tree.
+
+    These come from the FITS WCS the JWST data models keep in
+    ``meta.wcsinfo`` or, failing that, from the FITS approximation of the
+    gwcs in ``meta.wcs``. This is done once per file, for all the arrays.
+
+    :param tree: ASDF tree
+    :return: glue.core.coordinates.Coordinates
+    """
+    header = fits.Header()
+
+    wcsinfo = _lookup(tree, ('meta', 'wcsinfo'))
+    if isinstance(wcsinfo, dict):
+        for key in WCSINFO_KEYWORDS:
+            if wcsinfo.get(key, None) is not None:
+                header[key.upper()] = wcsinfo[key]
+
+    if 'CTYPE1' not in header:
+        gwcs = _lookup(tree, ('meta', 'wcs'))
+        try:
+            header = gwcs.to_fits()[0]
+        except Exception as e:
+            log.debug('Could not convert the gwcs to FITS: {}'.format(e))
+
+    return coordinates_from_header(header)
+
+
+class LazyASDFArray(LazyArray):
+    """
+    Read-only array-like view of an ASDF block array stored with another
+    dtype, only converting the slices that are requested.
+    """
+
+    def __init__(self, array, dtype=np.float64):
+        super(LazyASDFArray, self).__init__(array.shape, dtype=dtype)
+        self._array = array
+
+    def __repr__(self):
+        return '<LazyASDFArray shape={} dtype={}>'.format(self._shape, self._dtype)
+
+    def _read(self, key):
+        return np.asarray(self._array[key]).astype(self._dtype)
+
+
+ASDF_CACHE = HDUListCache(opener=open_asdf)
+
+atexit.register(ASDF_CACHE.clear)
@@ -0,0 +1,166 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Parsing, validation and on-disk caching of the YAML data configuration files.
+
+The parsed configurations are pickled in the cubeviz cache directory (by
+default ``~/.cubeviz/cache``, or ``CUBEVIZ_CACHE_DIR`` if set) together with
+the modification time and size of each YAML file, so a YAML file is only
+parsed again when it changes. Only the files of the last load are kept in
+the cache, and setting ``CUBEVIZ_CACHE_DIR`` to an empty string turns the
+cache off.
+"""
+import os
+import pickle
+import logging
+import tempfile
+
+import yaml
+
+from .lazy import DTYPE_POLICIES
+
+__all__ = ['read_configuration', 'validate_configuration', 'ConfigurationCache',
+           'CUBEVIZ_CACHE_DIR']
+
+log = logging.getLogger('cubeviz_config_cache')
+log.setLevel(logging.WARNING)
+
+CUBEVIZ_CACHE_DIR = 'CUBEVIZ_CACHE_DIR'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cubeviz', 'cache')
+
+# Increase this when the format of the parsed configurations changes
+CACHE_VERSION = 2
+
+
+def validate_configuration(cfg, config_file):
+    """
+    Check the required entries of a parsed configuration and normalize the
+    optional ones.
+
+    :param cfg: dict parsed from the YAML file
+    :param config_file: name of the YAML file, used in the error messages
+    :return: dict
+    :raises: ValueError if the configuration is not valid
+    """
+    if not isinstance(cfg, dict):
+        raise ValueError('Data configuration {} is not a mapping'.format(config_file))
+
+    for key in ['name', 'type', 'match']:
+        if key not in cfg:
+            raise ValueError('Data configuration {} has no "{}" entry'.format(config_file, key))
+
+    if not isinstance(cfg['match'], dict) or 'all' not in cfg['match']:
+        raise ValueError('Data configuration {} must have an "all" match criteria'.format(config_file))
+
+    try:
+        cfg['priority'] = int(cfg.get('priority', 0))
+    except Exception:
+        cfg['priority'] = 0
+
+    dtypes = [cfg.get('dtype', 'float64')]
+    for extension in (cfg.get('data') or {}).values():
+        if isinstance(extension, dict):
+            if 'extension' not in extension:
+                raise ValueError('Data configuration {} has a data entry without an extension'.format(config_file))
+            dtypes.append(extension.get('dtype', 'float64'))
+
+    for dtype in dtypes:
+        if dtype not in DTYPE_POLICIES:
+            raise ValueError('Data configuration {} has an unknown dtype {}, must be one of {}'.format(
+                config_file, dtype, ', '.join(DTYPE_POLICIES)))
+
+    return cfg
+
+
+def read_configuration(config_file):
+    """
+    Parse and validate a YAML data configuration file.
+
+    :param config_file: path of the YAML file
+    :return: dict
+    """
+    with open(config_file, 'r') as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+
+    return validate_configuration(cfg, config_file)
+
+
+class ConfigurationCache(object):
+    """
+    On-disk cache of the parsed data configurations.
+
+    :param cache_file: path of the pickle file, by default
+                       ``data_configurations.pkl`` in the cubeviz cache
+                       directory, or False to parse the files every time
+                       without writing anything to disk
+    """
+
+    def __init__(self, cache_file=None):
+        if cache_file is None:
+            cache_dir = os.environ.get(CUBEVIZ_CACHE_DIR, DEFAULT_CACHE_DIR)
+            cache_file = cache_dir and os.path.join(cache_dir, 'data_configurations.pkl')
+        self._cache_file = cache_file or False
+
+    def _read(self):
+        try:
+            with open(self._cache_file, 'rb') as fp:
+                cache = pickle.load(fp)
+            if cache.get('version') == CACHE_VERSION:
+                return cache['configurations']
+        except Exception as e:
+            log.debug('Could not read {}: {}'.format(self._cache_file, e))
+        return {}
+
+    def _write(self, configurations):
+        cache = {'version': CACHE_VERSION, 'configurations': configurations}
+        try:
+            cache_dir = os.path.dirname(self._cache_file)
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Write to a temporary file first so that concurrent cubeviz
+            # processes never see a partially written cache.
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    pickle.dump(cache, fp)
+                os.replace(tmp_file, self._cache_file)
+            except Exception:
+                os.unlink(tmp_file)
+                raise
+        except Exception as e:
+            log.debug('Could not write {}: {}'.format(self._cache_file, e))
+
+    def load(self, config_files):
+        """
+        Return the parsed configurations of ``config_files``, only parsing
+        the files that are not cached or that changed since they were cached.
+
+        :param config_files: list of YAML file paths
+        :return: list of dict, in the order of config_files
+        """
+        if self._cache_file is False:
+            return [read_configuration(config_file) for config_file in config_files]
+
+        cached = self._read()
+        configurations = {}
+        updated = False
+
+        cfgs = []
+        for config_file in config_files:
+            path = os.path.abspath(config_file)
+            stat = os.stat(path)
+            key = (stat.st_mtime_ns, stat.st_size)
+
+            if path in cached and cached[path][0] == key:
+                configurations[path] = cached[path]
+            else:
+                log.debug('Parsing {}'.format(path))
+                configurations[path] = (key, read_configuration(path))
+                updated = True
+
+            cfgs.append(configurations[path][1])
+
+        # Parsed files are added, and those no longer used (e.g. deleted) dropped
+        if updated or set(configurations) != set(cached):
+            self._write(configurations)
+
+        return cfgs
@@ -0,0 +1,180 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Shared, reference-counted cache of open FITS files.
+
+Matching a file against every data configuration, validating it and loading
+it all go through the same `~astropy.io.fits.HDUList`, so each file is only
+opened (and its headers parsed) once.
+"""
+import os
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from astropy.io import fits
+
+__all__ = ['HDUListCache', 'HDULIST_CACHE']
+
+log = logging.getLogger('cubeviz_fits_cache')
+log.setLevel(logging.WARNING)
+
+
+class HDUListCache(object):
+    """
+    Cache of open HDULists keyed by the path, modification time and size of
+    the file.
+
+    Each `acquire` must be matched by a `release`. An HDUList that is no
+    longer used is kept open (for the next configuration, or the loader, to
+    pick up) until more than ``max_idle`` unused files are cached, at which
+    point the least recently used one is closed. A file that changed on disk
+    is re-opened and the stale handle is closed as soon as it is released.
+
+    The files are memory mapped and opened with ``do_not_scale_image_data``
+    so that nothing is read from the cubes until it is needed; the
+    BSCALE/BZERO scaling is applied by the loaders (see
+    `~cubeviz.data_factories.lazy.scale_raw_data`).
+
+    :param max_idle: number of unused files kept open
+    :param opener: function opening a file, for caches of other kinds of
+                   files (the objects returned must have a ``close`` method)
+    """
+
+    def __init__(self, max_idle=8, opener=None):
+        self._max_idle = max_idle
+        self._opener = opener or self._open_fits
+        self._lock = threading.RLock()
+
+        # key -> [hdulist, reference count]
+        self._entries = {}
+
+        # key -> hdulist for the entries with a reference count of zero, in
+        # least recently used order.
+        self._idle = OrderedDict()
+
+    @staticmethod
+    def _open_fits(filename):
+        return fits.open(filename, memmap=True, do_not_scale_image_data=True)
+
+    @staticmethod
+    def _key(filename):
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        return filename, stat.st_mtime_ns, stat.st_size
+
+    def _find_key(self, hdulist):
+        for key, entry in self._entries.items():
+            if entry[0] is hdulist:
+                return key
+        raise ValueError('HDUList is not managed by this cache')
+
+    def _close(self, key):
+        hdulist, _ = self._entries.pop(key)
+        self._idle.pop(key, None)
+        log.debug('Closing {}'.format(key[0]))
+        hdulist.close()
+
+    def _is_stale(self, key):
+        try:
+            return self._key(key[0]) != key
+        except OSError:
+            return True
+
+    def acquire(self, filename):
+        """
+        Return the open HDUList for ``filename``, opening it if needed, and
+        increase its reference count.
+
+        :param filename: path of the FITS file
+        :return: astropy.io.fits.HDUList
+        """
+        key = self._key(filename)
+
+        with self._lock:
+            # Close any idle handle on an older version of the same file
+            for other in list(self._idle):
+                if other[0] == key[0] and other != key:
+                    self._close(other)
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] += 1
+                self._idle.pop(key, None)
+                return entry[0]
+
+        # Open the file without holding the lock so that several files can
+        # be opened at the same time by the loader threads.
+        log.debug('Opening {}'.format(key[0]))
+        hdulist = self._opener(filename)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [hdulist, 0]
+            else:
+                # Another thread opened the same file in the meantime
+                hdulist.close()
+
+            entry[1] += 1
+            self._idle.pop(key, None)
+
+            return entry[0]
+
+    def release(self, hdulist):
+        """
+        Decrease the reference count of an HDUList returned by `acquire`.
+
+        :param hdulist: astropy.io.fits.HDUList
+        """
+        with self._lock:
+            key = self._find_key(hdulist)
+            entry = self._entries[key]
+            entry[1] -= 1
+
+            if entry[1] > 0:
+                return
+
+            if self._is_stale(key):
+                self._close(key)
+                return
+
+            self._idle[key] = hdulist
+            while len(self._idle) > self._max_idle:
+                self._close(next(iter(self._idle)))
+
+    def is_stale(self, hdulist):
+        """
+        Whether the file of an HDUList returned by `acquire` changed on disk
+        since it was opened.
+
+        :param hdulist: astropy.io.fits.HDUList
+        :return: bool
+        """
+        with self._lock:
+            return self._is_stale(self._find_key(hdulist))
+
+    @contextmanager
+    def open(self, filename):
+        """
+        Context manager around `acquire` and `release`.
+        """
+        hdulist = self.acquire(filename)
+        try:
+            yield hdulist
+        finally:
+            self.release(hdulist)
+
+    def clear(self):
+        """
+        Close all the HDULists that are not in use.
+        """
+        with self._lock:
+            for key in list(self._idle):
+                self._close(key)
+
+
+HDULIST_CACHE = HDUListCache()
+
+atexit.register(HDULIST_CACHE.clear)
@@ -0,0 +1,261 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Streaming export of cubeviz data to FITS.
+
+The HDUs of the file the data was loaded from are copied byte for byte from
+that file (only their header is written again, from the file, with the
+values set by the IFU cube checks if any), so their data is never loaded. New (or modified)
+components are written a block of slices at a time, so exporting a cube with
+an added component needs little more memory than one block.
+"""
+import os
+import bz2
+import gzip
+import lzma
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+from astropy.io import fits
+
+from .lazy import BLOCK_BYTES
+
+__all__ = ['FITSPlan', 'write_fits', 'can_copy_from']
+
+log = logging.getLogger('cubeviz_fits_export')
+log.setLevel(logging.WARNING)
+
+BLOCK_SIZE = 2880
+
+# The dtypes FITS stores directly (with their BITPIX), and what the others are stored as
+FITS_DTYPES = {'uint8': 8, 'int16': 16, 'int32': 32, 'int64': 64, 'float32': -32, 'float64': -64}
+STORED_DTYPES = {'bool': 'uint8', 'int8': 'int16', 'uint16': 'int32', 'uint32': 'int64',
+                 'uint64': 'float64', 'float16': 'float32'}
+
+# Keywords that describe how the data is stored, which are set from the array
+# written rather than copied from the original header.
+DATA_KEYWORDS = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND', 'PCOUNT', 'GCOUNT',
+                 'BSCALE', 'BZERO', 'BLANK', 'CHECKSUM', 'DATASUM']
+
+# How to read the source file for each compression astropy reports
+SOURCE_OPENERS = {None: open, 'gzip': gzip.open, 'bzip2': bz2.open, 'lzma': lzma.open}
+
+# How to write the output file for each extension of its name (as astropy
+# compresses the files it writes)
+OUTPUT_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def _stored_dtype(dtype):
+    dtype = np.dtype(dtype)
+    name = STORED_DTYPES.get(dtype.name, dtype.name)
+    if name not in FITS_DTYPES:
+        raise NotImplementedError('Can not write arrays of type {} to FITS'.format(dtype))
+    return np.dtype(name)
+
+
+def _image_header(shape, dtype, header=None, name=None):
+    """
+    Header of an image extension for an array of ``shape`` and ``dtype``,
+    with the other (e.g. WCS) keywords of ``header``.
+    """
+    new = fits.Header()
+    new['XTENSION'] = 'IMAGE'
+    new['BITPIX'] = FITS_DTYPES[dtype.name]
+    new['NAXIS'] = len(shape)
+    for ii, n in enumerate(shape[::-1], 1):
+        new['NAXIS{}'.format(ii)] = n
+    new['PCOUNT'] = 0
+    new['GCOUNT'] = 1
+
+    if header is not None:
+        for card in header.cards:
+            keyword = card.keyword
+            if keyword in DATA_KEYWORDS or (keyword.startswith('NAXIS') and keyword[5:].isdigit()):
+                continue
+            new.append(card, end=True)
+
+    if name is not None:
+        new['EXTNAME'] = name
+
+    return new
+
+
+def _header_bytes(header):
+    return header.tostring().encode('ascii')
+
+
+def _source_filename(hdulist):
+    fileinfo = hdulist.fileinfo(0)
+    if fileinfo is None:
+        return None, None
+    return hdulist.filename(), getattr(fileinfo['file'], 'compression', None)
+
+
+def can_copy_from(hdulist):
+    """
+    Whether the HDUs of ``hdulist`` can be copied from its file, i.e. it was
+    read from a file that is either not compressed or compressed in a way
+    that can be read as a stream.
+
+    :param hdulist: astropy.io.fits.HDUList
+    :return: bool
+    """
+    filename, compression = _source_filename(hdulist)
+    return filename is not None and compression in SOURCE_OPENERS and os.path.isfile(filename)
+
+
+class FITSPlan(object):
+    """
+    The HDUs of the file to write, in order, and where their contents come
+    from.
+
+    :param source: the HDUList the copied HDUs come from, opened from a file
+                   for which `can_copy_from` is True
+    """
+
+    def __init__(self, source=None):
+        self._source = source
+        self._items = []
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def items(self):
+        return self._items
+
+    def copy(self, hdu, header_edits=None):
+        """
+        Copy an HDU of the source file.
+
+        :param hdu: HDU of the source HDUList
+        :param header_edits: dict of header key -> value to set in the header
+                             of the copy (e.g. the fixes of the IFU cube checks)
+        """
+        self._items.append(('copy', (hdu, header_edits)))
+
+    def array(self, name, array, header=None):
+        """
+        Write an array as a new image extension.
+
+        :param name: EXTNAME of the HDU
+        :param array: the data, any array-like that can be sliced along its first axis
+        :param header: header to take the other keywords (e.g. the WCS) from
+        """
+        self._items.append(('array', (name, array, header)))
+
+
+@contextmanager
+def _open_source(hdulist):
+    if hdulist is None:
+        yield None
+        return
+
+    filename, compression = _source_filename(hdulist)
+    with SOURCE_OPENERS[compression](filename, 'rb') as fp:
+        yield fp
+
+
+def _copy_bytes(source, destination, start, nbytes):
+    source.seek(start)
+    while nbytes > 0:
+        buf = source.read(min(BLOCK_BYTES, nbytes))
+        if not buf:
+            raise IOError('Unexpected end of the source file')
+        destination.write(buf)
+        nbytes -= len(buf)
+
+
+def _write_copied(fp, source_fp, hdu, header_edits=None):
+    """
+    Copy an HDU from the source file. With ``header_edits``, its header is
+    read from the file (that of the binary table for compressed HDUs), the
+    values are set in it and it is written again before the data.
+    """
+    fileinfo = hdu.fileinfo()
+    header_start, data_start, data_span = fileinfo['hdrLoc'], fileinfo['datLoc'], fileinfo['datSpan']
+    data_span += -data_span % BLOCK_SIZE
+
+    if not header_edits:
+        _copy_bytes(source_fp, fp, header_start, data_start - header_start + data_span)
+        return
+
+    source_fp.seek(header_start)
+    header = fits.Header.fromstring(source_fp.read(data_start - header_start).decode('ascii'))
+    for key, value in header_edits.items():
+        header[key] = value
+    for keyword in ['CHECKSUM', 'DATASUM']:
+        header.remove(keyword, ignore_missing=True)
+
+    fp.write(_header_bytes(header))
+    _copy_bytes(source_fp, fp, data_start, data_span)
+
+
+def _write_array(fp, name, array, header):
+    """
+    Write an array as an image extension, a block of slices at a time.
+    """
+    shape = tuple(array.shape)
+    dtype = _stored_dtype(array.dtype)
+
+    fp.write(_header_bytes(_image_header(shape, dtype, header, name=name)))
+
+    nbytes = 0
+    if len(shape) > 0 and shape[0] > 0:
+        plane_bytes = max(int(np.prod(shape[1:])) * dtype.itemsize, 1)
+        step = max(BLOCK_BYTES // plane_bytes, 1)
+        for start in range(0, shape[0], step):
+            block = np.asarray(array[start:start + step]).astype(dtype.newbyteorder('>'), copy=False)
+            fp.write(block.tobytes())
+            nbytes += block.nbytes
+
+    fp.write(b'\0' * (-nbytes % BLOCK_SIZE))
+
+
+def write_fits(filename, plan):
+    """
+    Write the HDUs of ``plan`` to ``filename``, overwriting it if it exists.
+
+    An empty primary HDU is added if the first HDU is not the primary HDU of
+    the source. When the output is the source file itself, it is written to
+    a temporary file that replaces the source at the end. Files named
+    ``.gz``, ``.bz2`` or ``.xz`` are compressed.
+
+    :param filename: output file name
+    :param plan: FITSPlan
+    """
+    items = plan.items
+
+    in_place = False
+    if plan.source is not None:
+        source_filename, _ = _source_filename(plan.source)
+        in_place = os.path.exists(filename) and os.path.samefile(filename, source_filename)
+
+    output = filename
+    if in_place:
+        fd, output = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.fits')
+        os.close(fd)
+        shutil.copymode(filename, output)
+
+    try:
+        opener = OUTPUT_OPENERS.get(os.path.splitext(filename)[1].lower(), open)
+        with opener(output, 'wb') as fp, _open_source(plan.source) as source_fp:
+
+            if not items or items[0][0] != 'copy' or not isinstance(items[0][1][0], fits.PrimaryHDU):
+                fp.write(_header_bytes(fits.PrimaryHDU().header))
+
+            for kind, item in items:
+                if kind == 'copy':
+                    _write_copied(fp, source_fp, *item)
+                else:
+                    _write_array(fp, *item)
+
+        if in_place:
+            os.replace(output, filename)
+    except Exception:
+        if in_place and os.path.exists(output):
+            os.remove(output)
+        raise
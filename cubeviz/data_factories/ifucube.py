@@ -1,10 +1,12 @@
 import os
 import logging
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
 
-from astropy.io import fits
 from astropy import units as u
 
+from .fits_cache import HDULIST_CACHE
+from .lazy import header_shape
+
 logging.basicConfig(level=logging.DEBUG, format="%(filename)s: %(levelname)8s %(message)s")
 log = logging.getLogger('ifcube')
 log.setLevel(logging.WARNING)
@@ -19,6 +21,50 @@ PROJECTIONS = ["AZP", "SZP", "TAN", "STG", "SIN", "ARC", "ZPN", "ZEA", "AIR", "C
                "PAR", "MOL", "AIT", "COP", "COE", "COD", "COO", "BON", "PCO", "CSC", "TSC", "QCS", "HPX", "XPH", \
                "TPV", "TUV"]
 
+# The zeroth index of each 'correct' array should contain the default value (S_C_T_C[0] == '[WAVE]')
+VALID_CTYPE1S = ['RA---TAN'] + ['{}{}{}'.format(c, (8-len(a)-len(c))*'-', a) for c in COORD_TYPES for a in PROJECTIONS]
+VALID_CTYPE2S = ['DEC--TAN'] + ['{}{}{}'.format(c, (8-len(a)-len(c))*'-', a) for c in COORD_TYPES for a in PROJECTIONS]
+VALID_CTYPE3S = SPECTRAL_COORD_TYPE_CODES + ['{}{}{}'.format(c, (8-len(a)-len(c))*'-', a) for c in SPECTRAL_COORD_TYPE_CODES for a in NON_LINEAR_ALGORITHM_CODES]
+
+# The header keys checked by IFUCube.check, in the order they are checked
+CHECKED_KEYS = ['CTYPE1', 'CTYPE2', 'CTYPE3', 'CUNIT1', 'CUNIT2', 'CUNIT3']
+
+# A 3D HDU found by the checks, shape is in numpy (z, y, x) order
+CubeInfo = namedtuple('CubeInfo', ['index', 'name', 'shape'])
+
+# A header value that was wrong (and possibly fixed)
+ValidationIssue = namedtuple('ValidationIssue', ['index', 'name', 'key', 'value', 'expected', 'fixed'])
+
+
+class ValidationReport(object):
+    """
+    Result of the IFUCube checks of a file.
+
+    :param filename: name of the file checked
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.good = True
+
+        # CubeInfo of each 3D HDU
+        self.cubes = []
+
+        # ValidationIssue for each header value that was wrong
+        self.issues = []
+
+    @property
+    def has_data(self):
+        return len(self.cubes) > 0
+
+    @property
+    def consistent_shapes(self):
+        return len(set(cube.shape for cube in self.cubes)) <= 1
+
+    def __repr__(self):
+        return '<ValidationReport filename={} good={} cubes={} issues={}>'.format(
+            self.filename, self.good, len(self.cubes), len(self.issues))
+
 
 class IFUCube(object):
     """
@@ -26,9 +72,12 @@ class IFUCube(object):
     """
     def __init__(self):
         self._fits = None
+        self._headers = None
+        self._header_edits = {}
         self._filename = None
         self._good = True
         self._log_text = defaultdict(lambda: dict())
+        self._report = ValidationReport(None)
 
         self._units = [u.m, u.cm, u.mm, u.um, u.nm, u.AA]
         self._units_titles = list(x.name for x in self._units)
@@ -36,6 +85,12 @@ class IFUCube(object):
     def open(self, filename, fix=False):
         """
         Check all checkers
+
+        The file is opened through the shared HDULIST_CACHE and the caller
+        owns the returned reference, i.e. it must call HDULIST_CACHE.release
+        on it once it is no longer needed. The headers of the shared HDUList
+        are left as read: the checks (and fixes) are done on copies of them,
+        see get_headers.
         """
         self._filename = filename
 
@@ -50,10 +105,11 @@ class IFUCube(object):
 
         # Open the file
         try:
-            self._fits = fits.open(filename)
+            self._fits = HDULIST_CACHE.acquire(filename)
         except:
             log.warning('Could not open {} '.format(filename))
             return
+        self._headers = None
 
         self.check(fix)
 
@@ -62,86 +118,138 @@ class IFUCube(object):
     def check(self, fix=False):
         """
         Check all checkers
+
+        Only the headers are looked at (the 3D HDUs are found from their NAXIS
+        cards), in a single pass over the HDUs.
         """
         log.debug('In check with filename {} and fix {}'.format(self._filename, fix))
         self._log_text['>front'] = 'Checking filename {}\n'.format(self._filename)
+        self._report = ValidationReport(self._filename)
+        self._headers = None
+        self._header_edits = {}
 
-        self.check_data(fix)
-
-        self.check_ctype1(fix)
-
-        self.check_ctype2(fix)
-
-        self.check_ctype3(fix)
-
-        self.check_cunit1(fix)
+        hdus = self._scan(fix)
 
-        self.check_cunit2(fix)
+        self._check_cubes()
 
-        self.check_cunit3(fix)
+        for key in CHECKED_KEYS:
+            self._check_key(key, self._correct_values(key), hdus, fix)
 
         return self._fits
 
-    def check_data(self, fix=False):
+    def _scan(self, fix=False):
         """
-        Check CTYPE and make sure it is the correct value
+        Go through the HDUs once, checking the EXTNAME field of each and finding
+        the ones with 3D data.
 
-        :param: fits_file: The open fits file
         :param: fix: boolean whether to fix it or not
-        :return: boolean whether it is good or not
+        :return: list of (index, hdu, has 3D data)
         """
-        log.debug('In check_data')
-        good = False
-        data_shape = []
+        hdus = []
 
         for ii, hdu in enumerate(self._fits):
+            header = self._header(ii)
 
             # Check the EXTNAME field for this HDU
-            if 'EXTNAME' not in self._fits[ii].header:
+            if 'EXTNAME' not in header:
                 log.warning(' HDU {} has no EXTNAME field'.format(ii))
                 extname = '{}_{}'.format(self._filename, ii)
                 if fix:
-                    self._fits[ii].header['EXTNAME'] = extname
+                    self._set_header(ii, 'EXTNAME', extname)
                     log.info(' Setting HDU {} EXTNAME field to {}'.format(ii, extname))
                     self._log_text[hdu.name]['data'] = 'Setting HDU {} EXTNAME field to {}\n'.format(ii, extname)
             else:
-                extname = self._fits[ii].header['EXTNAME']
+                extname = header['EXTNAME']
 
-            if hasattr(hdu, 'data') and hdu.data is not None and len(hdu.data.shape) == 3:
-                good = True
-                self.good_check(good)
+            has_data = header.get('NAXIS', 0) == 3
+            if has_data:
+                self._report.cubes.append(CubeInfo(ii, extname, header_shape(header)))
 
-                log.info('  data exists in HDU ({}, {}) and is of shape {}'.format(
-                    ii, extname, hdu.data.shape))
+            hdus.append((ii, hdu, has_data))
 
-                # Check to see if the same size as the others
-                if data_shape and not data_shape == hdu.data.shape:
-                    log.warning('  Data are of different shapes (previous was {} and this is {})'.format(data_shape,
-                                                                                                         hdu.data.shape))
+        return hdus
 
-                data_shape = hdu.data.shape
+    def _header(self, ii):
+        # The copy of the header of HDU ii that is checked and fixed
+        if self._headers is None:
+            self._headers = [hdu.header.copy() for hdu in self._fits]
+        return self._headers[ii]
 
-        if not good:
+    def _set_header(self, ii, key, value):
+        self._header(ii)[key] = value
+        self._header_edits.setdefault(ii, OrderedDict())[key] = value
+
+    def get_headers(self):
+        """
+        The headers of the HDUs, with the fixes of the last check.
+
+        :return: list of astropy.io.fits.Header (copies, one per HDU)
+        """
+        return [self._header(ii) for ii in range(len(self._fits))]
+
+    def get_header_edits(self):
+        """
+        The header values set by the last check (e.g. for the exporter to
+        write them to the copied HDUs).
+
+        :return: dict of HDU index -> OrderedDict of key -> value
+        """
+        return self._header_edits
+
+    def _correct_values(self, key):
+        if key == 'CTYPE1':
+            return VALID_CTYPE1S
+        elif key == 'CTYPE2':
+            return VALID_CTYPE2S
+        elif key == 'CTYPE3':
+            return VALID_CTYPE3S
+        elif key == 'CUNIT3':
+            return self._units_titles
+        else:
+            return 'deg'
+
+    def check_data(self, fix=False):
+        """
+        Check there is 3D data in the file, from the headers only
+
+        :param: fits_file: The open fits file
+        :param: fix: boolean whether to fix it or not
+        :return: boolean whether it is good or not
+        """
+        log.debug('In check_data')
+        self._scan(fix)
+        return self._check_cubes()
+
+    def _check_cubes(self):
+        data_shape = None
+
+        for cube in self._report.cubes:
+            log.info('  data exists in HDU ({}, {}) and is of shape {}'.format(
+                cube.index, cube.name, cube.shape))
+
+            # Check to see if the same size as the others
+            if data_shape is not None and not data_shape == cube.shape:
+                log.warning('  Data are of different shapes (previous was {} and this is {})'.format(data_shape,
+                                                                                                     cube.shape))
+
+            data_shape = cube.shape
+
+        if not self._report.has_data:
             self.good_check(False)
             log.error('  Can\'t fix lack of data')
             return False
 
-        return good
+        self.good_check(True)
+        return True
 
     def check_ctype1(self, fix=False):
-        # The zeroth index of each 'correct' array should contain the default value
-        all_valid_ctype1s = ['RA---TAN'] + ['{}{}{}'.format(c, (8-len(a)-len(c))*'-', a) for c in COORD_TYPES for a in PROJECTIONS]
-        self._check_ctype(key='CTYPE1', correct=all_valid_ctype1s, fix=fix)
+        self._check_ctype(key='CTYPE1', correct=VALID_CTYPE1S, fix=fix)
 
     def check_ctype2(self, fix=False):
-        # The zeroth index of each 'correct' array should contain the default value
-        all_valid_ctype2s = ['DEC--TAN'] + ['{}{}{}'.format(c, (8-len(a)-len(c))*'-', a) for c in COORD_TYPES for a in PROJECTIONS]
-        self._check_ctype(key='CTYPE2', correct=all_valid_ctype2s, fix=fix)
+        self._check_ctype(key='CTYPE2', correct=VALID_CTYPE2S, fix=fix)
 
     def check_ctype3(self, fix=False):
-        # The zeroth index of each 'correct' array should contain the default value (S_C_T_C[0] == '[WAVE]')
-        all_valid_ctype3s = SPECTRAL_COORD_TYPE_CODES + ['{}{}{}'.format(c, (8-len(a)-len(c))*'-', a) for c in SPECTRAL_COORD_TYPE_CODES for a in NON_LINEAR_ALGORITHM_CODES]
-        self._check_ctype(key='CTYPE3', correct=all_valid_ctype3s, fix=fix)
+        self._check_ctype(key='CTYPE3', correct=VALID_CTYPE3S, fix=fix)
 
     def check_cunit1(self, fix=False):
         self._check_ctype(key='CUNIT1', correct='deg', fix=fix)
@@ -160,66 +268,69 @@ class IFUCube(object):
         :param: fix: boolean whether to fix it or not
         :return: boolean whether it is good or not
         """
-        log.debug('In check for {}'.format(key))
+        hdus = [(ii, hdu, self._header(ii).get('NAXIS', 0) == 3) for ii, hdu in enumerate(self._fits)]
+        self._check_key(key, correct, hdus, fix)
 
-        # Creates a list of tuples (originals only), which have the shape: (hdu.header[key], if hdu has 3D data)
-        all_hdu_values = list(set([(hdu.header[key], (hasattr(hdu, 'data') and hdu.data is not None and\
-                                              len(hdu.data.shape) == 3)) for hdu in self._fits if hasattr(hdu, "header") and key in hdu.header]))
+    def _check_key(self, key, correct, hdus, fix=False):
+        log.debug('In check for {}'.format(key))
 
-        # Sort by has_data and now you have the hdu.header[key] values which have corresponding data in the first (or
-        # first few) indices
-        all_hdu_values.sort(key=lambda tup: tup[1], reverse=True)
+        # The (original) hdu.header[key] values, those of the HDUs which have 3D data first
+        all_hdu_values = []
+        for ii, hdu, has_data in sorted(hdus, key=lambda hdu: not hdu[2]):
+            header = self._header(ii)
+            if key in header and header[key] not in all_hdu_values:
+                all_hdu_values.append(header[key])
         log.debug("All hdu values for {}: {}".format(key, all_hdu_values))
 
         # Check if any of of the hdu.header[key] values are in correct
-        all_correct_values = [value for value, has_data in all_hdu_values if value in correct]
+        all_correct_values = [value for value in all_hdu_values if value in correct]
         log.debug("All correct values: {}".format(all_correct_values))
 
         # If there are more than one correct hdu.header[key] values that have corresponding 3D data, use the first one
         correct = all_correct_values[0] if len(all_correct_values) > 0 else correct
         log.debug("Correct value(s) to be used: {}".format(correct))
 
-        for ii, hdu in enumerate(self._fits):
-            if ii == 0 or (hasattr(hdu, 'data') and hdu.data is not None and len(hdu.data.shape) == 3):
-                if key not in hdu.header:
-                    hdu.header[key] = "NONE"
-                    self.good_and_fix(hdu, key, correct, fix, ii)
-                else:
-                    self.good_and_fix(hdu, key, correct, fix, ii)
+        for ii, hdu, has_data in hdus:
+            if ii == 0 or has_data:
+                if key not in self._header(ii):
+                    self._set_header(ii, key, "NONE")
+                self.good_and_fix(hdu, key, correct, fix, ii)
 
     def good_and_fix(self, hdu, key, correct, fix, ii):
         """
         Does as the name implies, checks to see if the hdu.header[key] equals the correct value, if it does not
         and fix is True, the correct value is inserted and passed back to CubeViz
-        :param hdu: One of the headers from the original FITS file
+        :param hdu: One of the HDUs of the original FITS file (the copy of its
+                    header is checked and fixed, see get_headers)
         :param key: The header keyword to be checked
         :param correct: The correct value of the header keyword
         :param fix: Whether or not to fix the header to the correct value
         :param ii: The index of the hdu within the FITS file
         :return:
         """
+        value = self._header(ii)[key]
+        expected = correct[0] if isinstance(correct, list) else correct
+
         # (i.e. Angstroms instead of Angstrom will be corrected and added)
-        if hdu.header[key] not in correct and len(hdu.header[key]) > 0 and hdu.header[key][:-1] in correct:
+        if value not in correct and len(value) > 0 and value[:-1] in correct:
             self.good_check(False)
-            self._log_text[hdu.name][key] = "{} is {}, setting to {}\n".format(key, hdu.header[key], hdu.header[key][:-1])
-            log.info("{} is {}, setting to {} in header[{}]".format(key, hdu.header[key], hdu.header[key][:-1], ii))
-            hdu.header[key] = hdu.header[key][:-1]
+            self._log_text[hdu.name][key] = "{} is {}, setting to {}\n".format(key, value, value[:-1])
+            log.info("{} is {}, setting to {} in header[{}]".format(key, value, value[:-1], ii))
+            self._set_header(ii, key, value[:-1])
+            self._report.issues.append(ValidationIssue(ii, hdu.name, key, value, value[:-1], True))
 
-        elif not hdu.header[key] in correct and fix:
+        elif not value in correct and fix:
             self.good_check(False)
-            if isinstance(correct, list):
-                self._log_text[hdu.name][key] = "{} is {}, setting to {}\n".format(key, hdu.header[key], correct[0])
-                log.info("{} is {}, setting to {} in header[{}]".format(key, hdu.header[key], correct[0], ii))
-                hdu.header[key] = correct[0]
-            else:
-                self._log_text[hdu.name][key] = "{} is {}, setting to {}\n".format(key, hdu.header[key], correct)
-                log.info("{} is {}, setting to {} in header[{}]".format(key, hdu.header[key], correct, ii))
-                hdu.header[key] = correct
+            self._log_text[hdu.name][key] = "{} is {}, setting to {}\n".format(key, value, expected)
+            log.info("{} is {}, setting to {} in header[{}]".format(key, value, expected, ii))
+            self._set_header(ii, key, expected)
+            self._report.issues.append(ValidationIssue(ii, hdu.name, key, value, expected, True))
 
-        elif not hdu.header[key] in correct and not fix:
+        elif not value in correct and not fix:
             self.good_check(False)
-            log.info("{} is {}, should equal {} in header[{}]".format(key, hdu.header[key], correct[0], ii))
-            self._log_text[hdu.name][key] = "{} is {}, should equal {}".format(key, hdu.header[key], correct[0])
+            log.info("{} is {}, should equal {} in header[{}]".format(key, value, correct[0], ii))
+            self._log_text[hdu.name][key] = "{} is {}, should equal {}".format(key, value, correct[0])
+            self._report.issues.append(ValidationIssue(ii, hdu.name, key, value, expected, False))
 
     def get_log_output(self):
 
@@ -247,6 +358,13 @@ class IFUCube(object):
             self._good = True
         if not good:
             self._good = False
+        self._report.good = self._good
 
     def get_good(self):
         return self._good
+
+    def get_report(self):
+        """
+        The ValidationReport of the last check.
+        """
+        return self._report
@@ -0,0 +1,334 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Lazy, slice-at-a-time access to the cubes stored in FITS HDUs (and, with
+`LazyArray`, to other on-disk arrays).
+
+The HDUs are expected to come from a file opened with ``memmap=True`` and
+``do_not_scale_image_data=True`` so that nothing is read (or scaled) until a
+slice is actually requested by a viewer or a tool.
+
+Tile-compressed HDUs (`~astropy.io.fits.CompImageHDU`) are read the same way:
+only the tiles that intersect the requested slice or spectrum are
+decompressed. Files compressed as a whole (e.g. gzip'd FITS) cannot be read
+at random, so those are decompressed once, on the first access.
+"""
+import weakref
+import threading
+
+import numpy as np
+
+from astropy.io import fits
+from glue.core import Component
+
+__all__ = ['LazyArray', 'LazyFITSArray', 'LazyFITSComponent', 'scale_raw_data', 'native_dtype',
+           'header_shape', 'is_compressed', 'DTYPE_POLICIES']
+
+# The dtypes the loaded components can be stored as. 'native' keeps the
+# type of the values in the file (after scaling).
+DTYPE_POLICIES = ['native', 'float32', 'float64']
+
+# Size of the blocks the whole cube is read in when converted to an array
+BLOCK_BYTES = 32 * 2 ** 20
+
+# Locks of the files the HDUs are read from, shared by the arrays of all
+# their HDUs: the astropy file objects can not be seeked and read from
+# several threads (the collapse tiles and the preview prefetch) at once
+_FILE_LOCKS = weakref.WeakKeyDictionary()
+_FILE_LOCKS_LOCK = threading.Lock()
+
+BITPIX_DTYPES = {8: 'uint8', 16: 'int16', 32: 'int32', 64: 'int64',
+                 -32: 'float32', -64: 'float64'}
+
+
+def header_shape(header):
+    """
+    The shape (in numpy order) of the data of an HDU, from the NAXIS and NAXISn
+    cards only so that the data is never read.
+
+    :param header: header of the HDU
+    :return: tuple
+    """
+    naxis = header.get('NAXIS', 0)
+    return tuple(header.get('NAXIS{}'.format(ii), 0) for ii in range(naxis, 0, -1))
+
+
+def is_compressed(hdu):
+    """
+    Whether the data of the HDU is tile compressed.
+
+    :param hdu: HDU
+    :return: bool
+    """
+    return isinstance(hdu, fits.CompImageHDU)
+
+
+def file_lock(hdu):
+    """
+    The lock the reads from the file of an HDU are made with, the same for
+    all the HDUs of a file (a new one for HDUs not read from a file).
+
+    :param hdu: HDU
+    :return: threading.Lock
+    """
+    fileinfo = hdu.fileinfo()
+    if fileinfo is None:
+        return threading.Lock()
+    with _FILE_LOCKS_LOCK:
+        return _FILE_LOCKS.setdefault(fileinfo['file'], threading.Lock())
+
+
+def is_stream_compressed(hdu):
+    """
+    Whether the HDU comes from a file that is compressed as a whole (gzip,
+    bzip2, ...), which can only be read sequentially.
+
+    :param hdu: HDU
+    :return: bool
+    """
+    fileinfo = hdu.fileinfo()
+    return fileinfo is not None and getattr(fileinfo['file'], 'compression', None) is not None
+
+
+def native_dtype(header):
+    """
+    The (native byte order) dtype of the values of an HDU once BSCALE and
+    BZERO are applied, following the same rules as astropy.io.fits.
+
+    :param header: header of the HDU
+    :return: numpy.dtype
+    """
+    bitpix = header['BITPIX']
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+
+    dtype = np.dtype(BITPIX_DTYPES[bitpix])
+
+    if bscale == 1 and bzero == 0:
+        return dtype
+
+    # Unsigned (or, for BITPIX = 8, signed) integers are stored with an offset
+    if bscale == 1 and dtype.kind in 'iu':
+        nbits = 8 * dtype.itemsize
+        if bitpix == 8 and bzero == -128:
+            return np.dtype('int8')
+        if bitpix != 8 and bzero == 2 ** (nbits - 1):
+            return np.dtype('uint{}'.format(nbits))
+
+    if bitpix in (8, 16, -32):
+        return np.dtype('float32')
+    return np.dtype('float64')
+
+
+def scale_raw_data(raw, header, dtype=np.float64):
+    """
+    Convert a chunk of raw (unscaled) FITS data to ``dtype``, applying the
+    BLANK, BSCALE and BZERO keywords of ``header``.
+
+    :param raw: numpy array of raw values read from the file
+    :param header: header of the HDU the values come from
+    :param dtype: output dtype
+    :return: numpy array
+    """
+    dtype = np.dtype(dtype)
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    blank = header.get('BLANK', None)
+
+    raw = np.asarray(raw)
+    data = raw.astype(dtype)
+
+    # For integer output the offset wraps around, which is exactly what is
+    # needed for the unsigned integer convention (e.g. BZERO = 32768).
+    if bscale != 1:
+        data *= bscale
+    if bzero != 0:
+        data += bzero
+
+    # BLANK only applies to integer data and can only be represented in
+    # floating point output.
+    if blank is not None and raw.dtype.kind in 'iu' and dtype.kind == 'f':
+        data[raw == blank] = np.nan
+
+    return data
+
+
+def _is_basic(key):
+    """
+    Whether an index is an integer or a slice, which can be read from disk.
+    """
+    return isinstance(key, (int, np.integer, slice)) and not isinstance(key, (bool, np.bool_))
+
+
+class LazyArray(object):
+    """
+    Read-only array-like object that only reads (and converts) the part of
+    an array that is requested.
+
+    Converting the whole object to a numpy array is done a block of chunks at
+    a time so that the raw and converted copies of the array are never both
+    in memory, and so are boolean masks of the whole array applied. Index
+    arrays (or masks) after integers and slices are applied to the part of
+    the array these select. Subclasses implement ``_read``.
+
+    :param shape: shape of the array
+    :param dtype: dtype of the values returned
+    :param chunks: shape of the blocks the data is stored in, single slices
+                   along the first axis by default
+    """
+
+    def __init__(self, shape, dtype=np.float64, chunks=None):
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self._chunks = tuple(chunks) if chunks is not None else (1,) + self._shape[1:]
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def chunks(self):
+        """
+        Shape of the blocks the data is stored (and best read) in.
+        """
+        return self._chunks
+
+    @property
+    def ndim(self):
+        return len(self._shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self._shape))
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __len__(self):
+        return self._shape[0]
+
+    def _read(self, key):
+        """
+        Read the values for the basic index ``key``, converted to ``dtype``.
+        """
+        raise NotImplementedError()
+
+    def _block_length(self):
+        """
+        Number of slices along the first axis read at once: whole chunks, as
+        many as fit in BLOCK_BYTES.
+        """
+        plane_bytes = max(int(np.prod(self._shape[1:])) * self._dtype.itemsize, 1)
+        return self._chunks[0] * max(BLOCK_BYTES // (plane_bytes * self._chunks[0]), 1)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        # Only integers and slices can be passed on to ``_read``, which reads
+        # the requested region from disk.
+        if all(_is_basic(k) for k in key) and len(key) <= self.ndim:
+            return self._read(key)
+
+        if len(key) > self.ndim or any(k is Ellipsis or k is None for k in key):
+            return np.asarray(self)[key]
+
+        # A boolean mask of the leading axes (e.g. of the whole cube) is
+        # applied a block of slices at a time, in the order numpy gives.
+        if not _is_basic(key[0]) and all(isinstance(k, slice) for k in key[1:]):
+            mask = np.asarray(key[0])
+            if mask.dtype == bool and mask.ndim >= 1 and self._shape[0] > 0:
+                if mask.shape != self._shape[:mask.ndim]:
+                    raise IndexError('boolean index of shape {} does not match the array '
+                                     'of shape {}'.format(mask.shape, self._shape))
+                step = self._block_length()
+                return np.concatenate([self._read(slice(start, start + step))[(mask[start:start + step],) + key[1:]]
+                                       for start in range(0, self._shape[0], step)])
+
+        # Otherwise only the part selected by the integers and slices before
+        # the first array (or mask) is read. The integers are read as slices
+        # of one value, so the rest of the key is applied as on the array.
+        read_key, rest = [], []
+        for axis, k in enumerate(key):
+            if not _is_basic(k):
+                break
+            if isinstance(k, slice):
+                read_key.append(k)
+                rest.append(slice(None))
+            else:
+                index = range(self._shape[axis])[k]
+                read_key.append(slice(index, index + 1))
+                rest.append(0)
+
+        if not read_key:
+            return np.asarray(self)[key]
+        return self._read(tuple(read_key))[tuple(rest) + key[len(rest):]]
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.empty(self._shape, dtype=self._dtype)
+
+        step = self._block_length()
+        for start in range(0, self._shape[0], step):
+            out[start:start + step] = self._read(slice(start, start + step))
+        if dtype is not None:
+            out = out.astype(dtype, copy=False)
+        return out
+
+
+class LazyFITSArray(LazyArray):
+    """
+    Read-only array-like view of a 3D FITS HDU.
+
+    The chunks are the compression tiles for tile-compressed HDUs, so each
+    tile is decompressed once, and single slices otherwise.
+    """
+
+    def __init__(self, hdu, dtype=np.float64):
+        shape = header_shape(hdu.header)
+
+        chunks = None
+        if is_compressed(hdu) and getattr(hdu, 'tile_shape', None):
+            chunks = tuple(int(n) for n in hdu.tile_shape)
+
+        super(LazyFITSArray, self).__init__(shape, dtype=dtype, chunks=chunks)
+
+        self._hdu = hdu
+        self._header = hdu.header
+        self._source = None
+        self._lock = file_lock(hdu)
+
+    @property
+    def hdu(self):
+        return self._hdu
+
+    def __repr__(self):
+        return '<LazyFITSArray name={} shape={} dtype={}>'.format(
+            self._hdu.name, self._shape, self._dtype)
+
+    def _read(self, key):
+        """
+        Read the raw values for the basic index ``key`` and convert them.
+        """
+        # The file is shared with the other arrays of the HDUList, and read
+        # from several threads
+        with self._lock:
+            if self._source is None:
+                # Older versions of astropy have no section for compressed HDUs, in
+                # which case the whole cube is decompressed as for gzip'd files.
+                if is_stream_compressed(self._hdu) or not hasattr(self._hdu, 'section'):
+                    self._source = self._hdu.data
+                else:
+                    self._source = self._hdu.section
+            raw = self._source[key]
+
+        return scale_raw_data(raw, self._header, self._dtype)
+
+
+class LazyFITSComponent(Component):
+    """
+    glue Component backed by a `LazyFITSArray`, so only the slices that are
+    looked at are read from the file.
+    """
+
+    def __init__(self, hdu, units=None, dtype=np.float64):
+        super(LazyFITSComponent, self).__init__(LazyFITSArray(hdu, dtype=dtype), units=units)
@@ -0,0 +1,163 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Header-only matching of FITS files against the data configurations.
+
+The headers of a file are summarized once in a `HeaderIndex` (only the keys
+the configurations look at, the extension names and whether there is a 3D
+HDU) and every registered configuration is evaluated against it in a single
+pass. The result is remembered, so the ``matches`` call glue makes for each
+configuration is a dictionary lookup.
+
+ASDF files are indexed from their tree (see `HeaderIndex.from_asdf`).
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from .fits_cache import HDULIST_CACHE
+from .asdf_files import ASDF_CACHE, ASDF_KEYWORDS, is_asdf, asdf_value, asdf_arrays
+
+__all__ = ['HeaderIndex', 'ConfigurationMatcher', 'header_index']
+
+
+class HeaderIndex(object):
+    """
+    Summary of the FITS headers used by the data configuration matchers.
+
+    :param primary: dict of the primary header values
+    :param extension_names: names of all the HDUs
+    :param has_3d_data: True if any HDU has NAXIS == 3
+    """
+
+    def __init__(self, primary, extension_names, has_3d_data):
+        self._primary = primary
+        self._extension_names = set(name.upper() for name in extension_names)
+        self._has_3d_data = has_3d_data
+
+    @classmethod
+    def from_hdulist(cls, hdulist, header_keys=None):
+        """
+        Build the index from the headers of ``hdulist``. The data of the HDUs
+        is never accessed.
+
+        :param hdulist: astropy.io.fits.HDUList
+        :param header_keys: primary header keys to keep, all of them if None
+        :return: HeaderIndex
+        """
+        header = hdulist[0].header
+        if header_keys is None:
+            header_keys = header.keys()
+        primary = dict((key, header[key]) for key in header_keys if key in header)
+
+        extension_names = []
+        has_3d_data = False
+        for hdu in hdulist:
+            extension_names.append(hdu.name)
+            has_3d_data = has_3d_data or hdu.header.get('NAXIS', 0) == 3
+
+        return cls(primary, extension_names, has_3d_data)
+
+    @classmethod
+    def from_asdf(cls, tree, header_keys=None):
+        """
+        Build the index from an ASDF tree: the keys are looked up with
+        `~cubeviz.data_factories.asdf_files.asdf_value` and the arrays of the
+        tree are the extensions. The arrays are never read.
+
+        :param tree: ASDF tree
+        :param header_keys: keys to keep, the known FITS keywords if None
+        :return: HeaderIndex
+        """
+        if header_keys is None:
+            header_keys = ASDF_KEYWORDS.keys()
+
+        primary = {}
+        for key in header_keys:
+            value = asdf_value(tree, key)
+            if value is not None:
+                primary[key] = value
+
+        arrays = asdf_arrays(tree)
+        extension_names = [name for name, _ in arrays]
+        has_3d_data = any(len(array.shape) == 3 for _, array in arrays)
+
+        return cls(primary, extension_names, has_3d_data)
+
+    @property
+    def extension_names(self):
+        return self._extension_names
+
+    @property
+    def has_3d_data(self):
+        return self._has_3d_data
+
+    def get(self, key, default=None):
+        return self._primary.get(key, default)
+
+    def has_extension(self, name):
+        return str(name).upper() in self._extension_names
+
+
+class ConfigurationMatcher(object):
+    """
+    Evaluate all the registered data configurations against a file at once.
+
+    The configurations must provide ``header_keys`` (the primary header keys
+    they use) and ``match(header_index)``.
+
+    :param max_files: number of files for which the results are remembered
+    """
+
+    def __init__(self, max_files=128):
+        self._configurations = []
+        self._header_keys = set()
+        self._max_files = max_files
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, configuration):
+        self._configurations.append(configuration)
+        self._header_keys.update(configuration.header_keys)
+        self._results.clear()
+
+    def index(self, filename):
+        """
+        Return the HeaderIndex of the file with the header keys that the
+        registered configurations use.
+        """
+        return header_index(filename, self._header_keys)
+
+    def matches(self, configuration, filename):
+        """
+        Return whether ``configuration`` matches the file, evaluating all the
+        registered configurations the first time the file is seen.
+        """
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+            else:
+                index = self.index(filename)
+                self._results[key] = dict((id(c), c.match(index)) for c in self._configurations)
+                while len(self._results) > self._max_files:
+                    self._results.popitem(last=False)
+
+            return self._results[key][id(configuration)]
+
+
+def header_index(filename, header_keys=None):
+    """
+    Return the HeaderIndex of a FITS or ASDF file.
+
+    :param filename: path of the file
+    :param header_keys: primary header keys to keep, all of them if None
+    :return: HeaderIndex
+    """
+    if is_asdf(filename):
+        with ASDF_CACHE.open(filename) as asdffile:
+            return HeaderIndex.from_asdf(asdffile.tree, header_keys)
+
+    with HDULIST_CACHE.open(filename) as hdulist:
+        return HeaderIndex.from_hdulist(hdulist, header_keys)
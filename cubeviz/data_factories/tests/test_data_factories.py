@@ -1,8 +1,21 @@
 import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+import numpy as np
+from astropy.io import fits
 from glue.core.data_factories import load_data, find_factory
 from glue.config import data_factory
 from ...listener import CUBEVIZ_LAYOUT
+from ..lazy import LazyFITSArray
+from ... import data_factories as data_factories_module
+from .. import ifucube as ifucube_module
+from ..ifucube import IFUCube
+from ..fits_cache import HDULIST_CACHE, HDUListCache
+from ..matching import HeaderIndex
+from ..config_cache import ConfigurationCache, read_configuration, CUBEVIZ_CACHE_DIR
+from .. import DEFAULT_DATA_CONFIGS, cubeviz_fits_exporter
 
 DATA = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -39,3 +52,293 @@ def test_basic(filename, factory_name, shape):
     data = load_data(filename)
     assert data.meta[CUBEVIZ_LAYOUT] == factory_name
     assert data.shape == shape
+
+
+@pytest.mark.parametrize(('filename', 'factory_name', 'shape'), TEST_CASES)
+def test_lazy(filename, factory_name, shape, monkeypatch):
+
+    # Loading lazily should give the same components as loading the whole
+    # cube in memory, but backed by LazyFITSArray objects.
+
+    filename = os.path.join(DATA, filename)
+    factory = find_factory(filename)
+    config = factory.__self__
+
+    data = config.load_data(filename)
+
+    monkeypatch.setattr(config, '_lazy', True)
+    lazy_data = config.load_data(filename)
+
+    assert lazy_data.shape == shape
+    for cid in data.main_components:
+        component = lazy_data.get_component(cid.label)
+        assert isinstance(component.data, LazyFITSArray)
+        np.testing.assert_allclose(lazy_data[cid.label, 1], data[cid][1], equal_nan=True)
+        np.testing.assert_allclose(np.asarray(component.data), data[cid], equal_nan=True)
+
+        # Masks and index arrays are applied to the part of the cube read
+        mask = np.random.RandomState(0).rand(*shape) > 0.5
+        for key in [mask, (mask[:, 0], slice(2, 5)), (1, [0, 2]), (slice(2, 8), 3, [1, 4]),
+                    (-1, slice(None), mask[0, 0])]:
+            np.testing.assert_allclose(component.data[key], data[cid][key], equal_nan=True)
+
+
+@pytest.mark.parametrize('extension', ['fits', 'fits.gz'])
+def test_lazy_threads(tmpdir, extension):
+
+    # The arrays of the HDUs of a file are read from several threads at once
+    # (e.g. the collapse tiles and the preview prefetch) through the same
+    # file object.
+
+    cube = np.random.RandomState(0).rand(100, 30, 40).astype(np.float32)
+    filename = tmpdir.join('cube.{}'.format(extension)).strpath
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(cube, name='SCI'),
+                  fits.ImageHDU(2 * cube, name='ERR')]).writeto(filename)
+
+    # Without memory mapping the sections are read with seek and read
+    for _ in range(3):
+        with fits.open(filename, memmap=False, do_not_scale_image_data=True) as hdulist:
+            arrays = [LazyFITSArray(hdulist['SCI']), LazyFITSArray(hdulist['ERR'])]
+            keys = [(ii % 2, slice(ii, ii + 3)) for ii in range(98)]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda key: arrays[key[0]][key[1]], keys))
+
+        for (ii, key), result in zip(keys, results):
+            np.testing.assert_array_equal(result, (ii + 1) * cube[key])
+
+
+def test_compressed(tmpdir):
+
+    # Tile-compressed cubes are always read lazily, one tile at a time
+
+    filename = os.path.join(DATA, TEST_CASES[0][0])
+    compressed = tmpdir.join('compressed.fits').strpath
+
+    with fits.open(filename) as hdulist:
+        hdus = [hdulist[0].copy()]
+        for hdu in hdulist[1:]:
+            if hdu.header.get('NAXIS', 0) == 3:
+                hdu = fits.CompImageHDU(hdu.data, header=hdu.header, compression_type='GZIP_1', quantize_level=0)
+            hdus.append(hdu)
+        fits.HDUList(hdus).writeto(compressed)
+
+    data = find_factory(filename)(filename)
+    compressed_data = find_factory(compressed)(compressed)
+
+    for cid in data.main_components:
+        component = compressed_data.get_component(cid.label)
+        assert isinstance(component.data, LazyFITSArray)
+        np.testing.assert_allclose(compressed_data[cid.label, 1], data[cid][1], equal_nan=True)
+        np.testing.assert_allclose(np.asarray(component.data), data[cid], equal_nan=True)
+
+
+def test_asdf(tmpdir):
+
+    # JWST cubes stored as ASDF are loaded from the memory mapped arrays
+    # with the coordinates from meta.wcsinfo
+
+    asdf = pytest.importorskip('asdf')
+
+    shape = (10, 5, 6)
+    wcsinfo = {'wcsaxes': 3}
+    for axis, (ctype, cunit, cdelt) in enumerate([('RA---TAN', 'deg', 1e-4), ('DEC--TAN', 'deg', 1e-4),
+                                                  ('WAVE', 'um', 1e-3)], 1):
+        wcsinfo.update({'crpix{}'.format(axis): 1., 'crval{}'.format(axis): 1., 'cdelt{}'.format(axis): cdelt,
+                        'ctype{}'.format(axis): ctype, 'cunit{}'.format(axis): cunit})
+
+    tree = {'data': np.random.random(shape).astype(np.float32),
+            'err': np.random.random(shape).astype(np.float32),
+            'dq': np.zeros(shape, dtype=np.uint32),
+            'meta': {'telescope': 'JWST', 'model_type': 'IFUCubeModel',
+                     'bunit_data': 'MJy/sr', 'wcsinfo': wcsinfo}}
+
+    filename = tmpdir.join('cube.asdf').strpath
+    asdf.AsdfFile(tree).write_to(filename)
+
+    factory = find_factory(filename)
+    assert factory_label(factory) == 'jwst-asdf'
+
+    data = factory(filename)
+    assert data.shape == shape
+    assert data.coords.wcs.wcs.ctype[2] == 'WAVE'
+    assert data.get_component('data').units == 'MJy/sr'
+
+    for name in ['data', 'err', 'dq']:
+        assert data[name].dtype == tree[name].dtype
+        np.testing.assert_array_equal(data[name], tree[name])
+
+    # Only the components are exported to FITS
+    exported = tmpdir.join('cube.fits').strpath
+    with pytest.warns(UserWarning, match='ASDF'):
+        cubeviz_fits_exporter(exported, data)
+    with fits.open(exported) as hdulist:
+        np.testing.assert_array_equal(hdulist['DATA'].data, tree['data'])
+
+
+def test_single_open():
+
+    # Matching and loading should both use the HDUList from the shared cache
+    # rather than opening the file again.
+
+    filename = os.path.join(DATA, TEST_CASES[0][0])
+
+    with HDULIST_CACHE.open(filename) as hdulist:
+        factory = find_factory(filename)
+        data = factory(filename)
+        assert data._cubeviz_hdulist is hdulist
+
+
+def test_multiple_files():
+
+    # Comma separated files are loaded concurrently but the components must
+    # be the same as when loading the file on its own.
+
+    filename = os.path.join(DATA, TEST_CASES[0][0])
+
+    factory = find_factory(filename)
+    single = factory(filename)
+    multiple = factory(','.join([filename, filename]))
+
+    assert multiple.label == single.label
+    for component in single.component_ids():
+        np.testing.assert_array_equal(multiple[component.label], single[component.label])
+
+
+@pytest.mark.parametrize('failure', ['read', 'assembly'])
+@pytest.mark.parametrize('n_files', [1, 2])
+def test_release_on_failure(monkeypatch, failure, n_files):
+
+    # The files are given back to the cache when converting them, or adding
+    # them to the data, fails.
+
+    cache = HDUListCache()
+    monkeypatch.setattr(ifucube_module, 'HDULIST_CACHE', cache)
+    monkeypatch.setattr(data_factories_module, 'HDULIST_CACHE', cache)
+
+    def fail(*args):
+        raise ValueError('failed')
+
+    if failure == 'read':
+        monkeypatch.setattr(data_factories_module, 'coordinates_from_header', fail)
+    else:
+        monkeypatch.setattr(IFUCube, 'get_header_edits', fail)
+
+    filename = os.path.join(DATA, 'manga-7495-12704-LOGCUBE.fits')
+    config = find_factory(filename).__self__
+    monkeypatch.setattr(config, '_check_ifu_valid', False)
+
+    try:
+        with pytest.raises(ValueError):
+            config.load_data(','.join([filename] * n_files))
+        assert all(entry[1] == 0 for entry in cache._entries.values())
+        assert len(cache._idle) == 1
+    finally:
+        cache.clear()
+
+
+@pytest.mark.parametrize(('filename', 'factory_name', 'shape'), TEST_CASES)
+def test_header_index(filename, factory_name, shape):
+
+    # The header index used for matching should never read the data
+
+    filename = os.path.join(DATA, filename)
+
+    with fits.open(filename) as hdulist:
+        index = HeaderIndex.from_hdulist(hdulist)
+        assert index.has_3d_data
+        assert all(index.has_extension(hdu.name.lower()) for hdu in hdulist)
+        assert not any('data' in hdu.__dict__ for hdu in hdulist)
+
+
+@pytest.mark.parametrize(('filename', 'factory_name', 'shape'), TEST_CASES)
+def test_ifucube_headers_only(monkeypatch, filename, factory_name, shape):
+
+    # The IFU cube checks should only look at the headers. The other tests
+    # leave the files open in the shared cache with their data read, so the
+    # checks open the file in a cache of their own.
+
+    cache = HDUListCache()
+    monkeypatch.setattr(ifucube_module, 'HDULIST_CACHE', cache)
+
+    ifucube = IFUCube()
+    hdulist = ifucube.open(os.path.join(DATA, filename))
+
+    try:
+        report = ifucube.get_report()
+        assert report.good == ifucube.get_good()
+        assert report.has_data
+        assert all(cube.shape == shape for cube in report.cubes)
+        assert not any('data' in hdu.__dict__ for hdu in hdulist)
+    finally:
+        cache.release(hdulist)
+        cache.clear()
+
+
+@pytest.mark.parametrize(('filename', 'factory_name', 'shape'), TEST_CASES)
+def test_ifucube_fixes_copies(filename, factory_name, shape):
+
+    # The fixes are made to copies of the headers, so the HDUList shared
+    # through the cache keeps the headers of the file and checking the file
+    # again gives the same result.
+
+    filename = os.path.join(DATA, filename)
+    with fits.open(filename) as original:
+        original_headers = [hdu.header.tostring() for hdu in original]
+
+    results = []
+    for _ in range(2):
+        ifucube = IFUCube()
+        hdulist = ifucube.open(filename, fix=True)
+        try:
+            assert [hdu.header.tostring() for hdu in hdulist] == original_headers
+            edits = ifucube.get_header_edits()
+            headers = ifucube.get_headers()
+            for ii, values in edits.items():
+                assert all(headers[ii][key] == value for key, value in values.items())
+            results.append((ifucube.get_good(), ifucube.get_report().issues, edits))
+        finally:
+            HDULIST_CACHE.release(hdulist)
+
+    assert results[0] == results[1]
+
+
+def test_configuration_cache(tmpdir, monkeypatch):
+
+    config_files = glob.glob(os.path.join(DEFAULT_DATA_CONFIGS, '*.yaml'))
+    cache_file = tmpdir.join('data_configurations.pkl').strpath
+
+    cfgs = ConfigurationCache(cache_file).load(config_files)
+    assert [cfg['name'] for cfg in cfgs] == [read_configuration(f)['name'] for f in config_files]
+
+    # The second time around the configurations come from the cache file
+    assert os.path.exists(cache_file)
+    assert ConfigurationCache(cache_file).load(config_files) == cfgs
+
+    # Files that are no longer loaded are dropped from the cache
+    ConfigurationCache(cache_file).load(config_files[:1])
+    assert list(ConfigurationCache(cache_file)._read()) == [os.path.abspath(config_files[0])]
+
+    # Nothing is written when the cache is turned off
+    monkeypatch.setenv(CUBEVIZ_CACHE_DIR, '')
+    assert ConfigurationCache().load(config_files) == cfgs
+    assert ConfigurationCache(False).load(config_files) == cfgs
+    assert tmpdir.listdir() == [tmpdir.join('data_configurations.pkl')]
+
+
+def test_dtype_policy(monkeypatch):
+
+    # Science extensions follow the dtype policy of the configuration while
+    # the integer bitmask extensions keep their dtype.
+
+    filename = os.path.join(DATA, 'manga-7495-12704-LOGCUBE.fits')
+    config = find_factory(filename).__self__
+
+    data = config.load_data(filename)
+    assert data['FLUX'].dtype == np.float64
+    assert data['MASK'].dtype.kind == 'i'
+
+    monkeypatch.setattr(config, '_dtype', 'float32')
+    data = config.load_data(filename)
+
+    assert data['FLUX'].dtype == np.float32
+    assert data['MASK'].dtype.kind == 'i'
@@ -15,7 +15,7 @@ from astropy.coordinates import BaseRADecFrame
 
 from qtpy.QtWidgets import (QLabel, QMessageBox)
 
-from glue.core.message import SettingsChangeMessage
+from glue.core.message import SettingsChangeMessage, NumericalDataChangedMessage
 
 from glue.utils.qt import pick_item, get_text
 
@@ -31,7 +31,9 @@ from qtpy.QtGui import QCursor
 
 from .messages import (SliceIndexUpdateMessage, WavelengthUpdateMessage,
                        WavelengthUnitUpdateMessage, FluxUnitsUpdateMessage)
+from .utils.arrays import SubsetMask
 from .utils.contour import ContourSettings
+from .utils.preview_cache import PreviewCache, PREVIEW_PREFETCH
 
 CONTOUR_DEFAULT_NUMBER_OF_LEVELS = 8
 CONTOUR_MAX_NUMBER_OF_LEVELS = 1000
@@ -131,13 +133,76 @@ class CubevizImageLayerState(ImageLayerState):
     """
     Sub-class of ImageLayerState that includes the ability to include smoothing
     on-the-fly.
+
+    The previewed slices are kept in a PreviewCache, so that going back to a
+    slice, panning or zooming does not compute the preview again. With
+    preview_prefetch > 0, the slices on either side of the one shown are
+    computed ahead of time in a background thread.
     """
 
     preview_function = None
+    preview_prefetch = 0  # Number of slices prefetched on each side of the current one
+
+    _preview_cache = None
 
     # Override glue default
     global_sync = DDCProperty(False)
 
+    @property
+    def preview_cache(self):
+        if self._preview_cache is None:
+            self._preview_cache = PreviewCache()
+        return self._preview_cache
+
+    def reset_preview_cache(self):
+        """Drop the cached preview slices, e.g. when the preview or data change"""
+        if self._preview_cache is not None:
+            self._preview_cache.clear()
+
+    def close_preview_cache(self):
+        """Drop the cached preview slices and stop the prefetching thread"""
+        if self._preview_cache is not None:
+            self._preview_cache.close()
+
+    def _preview_key(self, slices, agg_func, transpose):
+        """
+        Key of a previewed slice: the preview parameters, the component
+        (and its array, which changes when the component is updated) and the
+        slice index. None if the slice can not be cached.
+        """
+        if agg_func is not None and any(func is not None for func in agg_func):
+            return None
+        try:
+            component = self.layer.get_component(self.attribute)
+        except Exception:
+            return None
+        # Functions with a cache_key (see SmoothCube.get_preview_function)
+        # are identified by the parameters they apply
+        preview = getattr(self.preview_function, 'cache_key', self.preview_function)
+        index = tuple(s if isinstance(s, (int, np.integer)) else None for s in slices)
+        return preview, component, id(component.data), index, bool(transpose)
+
+    def _slice_preview(self, slices, transpose, preview_function):
+        image = self.layer[self.attribute, tuple(slices)]
+        if transpose:
+            image = image.transpose()
+        return preview_function(image)
+
+    def _prefetch_previews(self, slices, transpose):
+        indices = [axis for axis, s in enumerate(slices) if isinstance(s, (int, np.integer))]
+        if len(indices) != 1:
+            return
+        axis = indices[0]
+        preview_function = self.preview_function
+        for offset in range(1, self.preview_prefetch + 1):
+            for index in [slices[axis] + offset, slices[axis] - offset]:
+                if 0 <= index < self.layer.shape[axis]:
+                    neighbour = list(slices)
+                    neighbour[axis] = index
+                    key = self._preview_key(neighbour, None, transpose)
+                    self.preview_cache.prefetch(
+                        key, lambda n=neighbour: self._slice_preview(n, transpose, preview_function))
+
     def get_sliced_data(self, view=None, bounds=None):
         """
         Override and modify ImageLayerState.get_sliced_data so that if
@@ -148,8 +213,19 @@ class CubevizImageLayerState(ImageLayerState):
         if self.preview_function is None:
             return super(CubevizImageLayerState, self).get_sliced_data(view=view)
         else:
-            image = super(CubevizImageLayerState, self).get_sliced_data()
-            image = self.preview_function(image)
+            slices, agg_func, transpose = self.viewer_state.numpy_slice_aggregation_transpose
+            key = self._preview_key(slices, agg_func, transpose)
+
+            image = None if key is None else self.preview_cache.get(key)
+            if image is None:
+                image = super(CubevizImageLayerState, self).get_sliced_data()
+                image = self.preview_function(image)
+                if key is not None:
+                    self.preview_cache.put(key, image)
+
+            if key is not None and self.preview_prefetch > 0:
+                self._prefetch_previews(slices, transpose)
+
             if view is not None:
                 image = image[view]
             return image
@@ -169,6 +245,10 @@ class CubevizImageLayerArtist(ImageLayerArtist):
     _state_cls = CubevizImageViewerState
     _layer_state_cls = CubevizImageLayerState
 
+    def remove(self):
+        self.state.close_preview_cache()
+        super(CubevizImageLayerArtist, self).remove()
+
 
 class CubevizImageViewer(ImageViewer):
 
@@ -244,6 +324,7 @@ class CubevizImageViewer(ImageViewer):
         self._hub.subscribe(self, WavelengthUpdateMessage, handler=self._update_wavelengths)
         self._hub.subscribe(self, WavelengthUnitUpdateMessage, handler=self._update_wavelength_units)
         self._hub.subscribe(self, FluxUnitsUpdateMessage, handler=self._update_flux_units)
+        self._hub.subscribe(self, NumericalDataChangedMessage, handler=self._reset_preview_caches)
 
     @property
     def cubeviz_unit(self):
@@ -292,7 +373,7 @@ class CubevizImageViewer(ImageViewer):
 
         self._subset = subset
 
-        mask = subset.to_mask()[self._slice_index]
+        mask = SubsetMask(subset)[self._slice_index]
         data = self._data[0][component][self._slice_index][mask]
 
         results = self._calculate_stats(data)
@@ -383,11 +464,13 @@ class CubevizImageViewer(ImageViewer):
         else:
             self.update_axes_title()
 
-    def set_smoothing_preview(self, preview_function, preview_title=None):
+    def set_smoothing_preview(self, preview_function, preview_title=None, prefetch=PREVIEW_PREFETCH):
         """
         Sets up on the fly smoothing and displays smoothing preview title.
         :param preview_function: function: Single-slice smoothing function
         :param preview_title: str: Title displayed when previewing
+        :param prefetch: int: Number of slices smoothed ahead of time on each
+                         side of the current slice
         """
         self.is_smoothing_preview_active = True
 
@@ -399,6 +482,8 @@ class CubevizImageViewer(ImageViewer):
 
         for layer in self.layers:
             if isinstance(layer, CubevizImageLayerArtist):
+                layer.state.reset_preview_cache()
+                layer.state.preview_prefetch = prefetch
                 layer.state.preview_function = preview_function
         self.axes._composite_image.invalidate_cache()
         if self.is_contour_active:
@@ -406,6 +491,12 @@ class CubevizImageViewer(ImageViewer):
         else:
             self.axes.figure.canvas.draw()
 
+    def _reset_preview_caches(self, message):
+        # The values changed in place: the cached preview slices are stale
+        for layer in self.layers:
+            if isinstance(layer, CubevizImageLayerArtist):
+                layer.state.reset_preview_cache()
+
     def end_smoothing_preview(self):
         """
         Ends on the fly smoothing.
@@ -418,6 +509,7 @@ class CubevizImageViewer(ImageViewer):
         for layer in self.layers:
             if isinstance(layer, CubevizImageLayerArtist):
                 layer.state.preview_function = None
+                layer.state.close_preview_cache()
         self.axes._composite_image.invalidate_cache()
         if self.is_contour_active:
             self.draw_contour()
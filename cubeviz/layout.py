@@ -27,6 +27,7 @@ from .messages import FluxUnitsUpdateMessage
 from .toolbar import CubevizToolbar
 from .tools import collapse_cube, moment_maps, smoothing
 from .tools.wavelengths_ui import WavelengthUI
+from .utils.preview_cache import PREVIEW_PREFETCH
 
 DEFAULT_NUM_SPLIT_VIEWERS = 3
 DEFAULT_TOOLBAR_ICON_SIZE = 18
@@ -788,7 +789,8 @@ class CubeVizLayout(QtWidgets.QWidget):
                 view._widget.update_slice_index(index)
         self._slice_controller.update_index(index)
 
-    def start_smoothing_preview(self, preview_function, component_id, preview_title=None):
+    def start_smoothing_preview(self, preview_function, component_id, preview_title=None,
+                                prefetch=PREVIEW_PREFETCH):
         """
         Starts smoothing preview. This function preforms the following steps
         1) SelectSmoothing passes parameters.
@@ -797,6 +799,8 @@ class CubeVizLayout(QtWidgets.QWidget):
         :param preview_function: function: Single-slice smoothing function
         :param component_id: int: Which component to preview
         :param preview_title: str: Title displayed when previewing
+        :param prefetch: int: Number of slices smoothed ahead of time on each
+                         side of the current slice
         """
         # For single and first viewer:
         self._original_components = {}
@@ -805,7 +809,7 @@ class CubeVizLayout(QtWidgets.QWidget):
             self._original_components[view_index] = combo.currentData()
             view = self.cube_views[view_index].widget()
             self.change_viewer_component(view_index, component_id, force=True)
-            view.set_smoothing_preview(preview_function, preview_title)
+            view.set_smoothing_preview(preview_function, preview_title, prefetch=prefetch)
 
     def end_smoothing_preview(self):
         """
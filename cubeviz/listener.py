@@ -1,11 +1,14 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 
 from glue.core import Hub, HubListener, Data, DataCollection
+from glue.core.component import CoordinateComponent, DerivedComponent
 from glue.core.message import (DataCollectionAddMessage, SettingsChangeMessage,
                                DataRemoveComponentMessage, SubsetMessage,
-                               EditSubsetMessage, DataAddComponentMessage)
+                               EditSubsetMessage, DataAddComponentMessage,
+                               NumericalDataChangedMessage)
 from .layout import CubeVizLayout
 from .messages import FluxUnitsUpdateMessage
+from .tools.collapse_engine import PREFIX_SUMS
 
 
 CUBEVIZ_LAYOUT = 'cubeviz_layout'
@@ -39,6 +42,8 @@ class CubevizManager(HubListener):
             self, EditSubsetMessage, handler=self.handle_subset_message)
         self._hub.subscribe(
             self, FluxUnitsUpdateMessage, handler=self.handle_flux_units_update)
+        self._hub.subscribe(
+            self, NumericalDataChangedMessage, handler=self.handle_data_changed)
 
         # Look for any cube data files that were loaded from the command line
         for data in session.data_collection:
@@ -86,6 +91,15 @@ class CubevizManager(HubListener):
         if self._layout is not None:
             self._layout.refresh_flux_units(message)
 
+    def handle_data_changed(self, message):
+        # The values of the components of the data changed: their prefix
+        # sums are stale. Derived components are computed anew when read.
+        data = message.data
+        for component_id in data.component_ids():
+            component = data.get_component(component_id)
+            if not isinstance(component, (DerivedComponent, CoordinateComponent)):
+                PREFIX_SUMS.invalidate(component.data)
+
     def hide_sidebar(self):
         self._app._ui.main_splitter.setSizes([0, 300])
 
@@ -23,9 +23,10 @@ class SliceIndexUpdateMessage(Message):
 
 class WavelengthUpdateMessage(Message):
 
-    def __init__(self, sender, wavelengths, tag=None):
+    def __init__(self, sender, wavelengths, wavelength_index=None, tag=None):
         super(WavelengthUpdateMessage, self).__init__(sender, tag=tag)
         self.wavelengths = wavelengths
+        self.wavelength_index = wavelength_index
 
 
 class WavelengthUnitUpdateMessage(Message):
@@ -1,8 +1,12 @@
 import os
+import gzip
 
-from glue.core.data_factories import find_factory
+import numpy as np
+from astropy.io import fits
+from glue.core.data_factories import find_factory, load_data
 
 from ..data_factories import DataFactoryConfiguration, cubeviz_fits_exporter
+from ..data_factories.fits_export import FITSPlan, write_fits
 
 TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'data_cube.fits.gz')
 
@@ -30,3 +34,74 @@ def test_export_roundtrip(tmpdir):
     # And check that we identify the file correctly again
     factory = find_factory(filename)
     assert factory.__self__.name == 'kmos'
+
+
+def test_export_streaming(tmpdir):
+
+    # The HDUs of the original file are copied and the added components are
+    # written after them.
+
+    DataFactoryConfiguration(check_ifu_valid=False)
+
+    data = load_data(TEST_DATA_PATH)
+    smoothed = np.asarray(data[data.main_components[0]]) * 2
+    data.add_component(smoothed, 'SMOOTHED')
+
+    filename = tmpdir.join('test.fits').strpath
+    cubeviz_fits_exporter(filename, data)
+
+    with fits.open(TEST_DATA_PATH) as original, fits.open(filename) as exported:
+        exported.verify('exception')
+        for hdu in original:
+            assert exported[hdu.name].header == hdu.header
+            np.testing.assert_array_equal(exported[hdu.name].data, hdu.data)
+        np.testing.assert_array_equal(exported['SMOOTHED'].data, smoothed)
+
+
+def test_export_compressed(tmpdir):
+
+    # Files named .gz are written compressed
+
+    DataFactoryConfiguration(check_ifu_valid=False)
+
+    data = load_data(TEST_DATA_PATH)
+    smoothed = np.asarray(data[data.main_components[0]]) * 2
+    data.add_component(smoothed, 'SMOOTHED')
+
+    filename = tmpdir.join('test.fits.gz').strpath
+    cubeviz_fits_exporter(filename, data)
+
+    with gzip.open(filename) as fp:
+        assert fp.read(6) == b'SIMPLE'
+
+    with fits.open(TEST_DATA_PATH) as original, fits.open(filename) as exported:
+        exported.verify('exception')
+        for hdu in original:
+            np.testing.assert_array_equal(exported[hdu.name].data, hdu.data)
+        np.testing.assert_array_equal(exported['SMOOTHED'].data, smoothed)
+
+
+def test_export_header_edits(tmpdir):
+
+    # The header values set by the IFU cube checks are written to the copied
+    # HDUs, without changing the headers of the source HDUList.
+
+    filename = tmpdir.join('test.fits').strpath
+
+    with fits.open(TEST_DATA_PATH) as original:
+        headers = [hdu.header.copy() for hdu in original]
+
+        plan = FITSPlan(original)
+        for ii, hdu in enumerate(original):
+            plan.copy(hdu, {'CUNIT3': 'um', 'EXTNAME': 'EDITED{}'.format(ii)} if ii > 0 else None)
+        write_fits(filename, plan)
+
+        assert [hdu.header for hdu in original] == headers
+
+        with fits.open(filename) as exported:
+            exported.verify('exception')
+            assert exported[0].header == headers[0]
+            for ii, hdu in enumerate(original[1:], 1):
+                assert exported[ii].header['CUNIT3'] == 'um'
+                assert exported[ii].name == 'EDITED{}'.format(ii)
+                np.testing.assert_array_equal(exported[ii].data, hdu.data)
@@ -9,9 +9,13 @@ from qtpy.QtWidgets import (QDialog, QApplication, QPushButton, QLabel, QWidget,
                             QHBoxLayout, QVBoxLayout, QLineEdit, QComboBox)
 from glue.utils.qt import load_ui
 
-from astropy.stats import sigma_clip
+from astropy import units as u
+from astropy.wcs import WCSSUB_SPECTRAL
 
 from .common import add_to_2d_container, show_error_message
+from .collapse_engine import collapse_array, nanmedian, PREFIX_SUMS
+from ..utils.arrays import SubsetMask, is_spatial_subset
+from ..controls.wavelengths import WavelengthIndex
 
 import logging
 logging.basicConfig(format='%(levelname)-6s: %(name)-10s %(asctime)-15s  %(message)s')
@@ -28,7 +32,7 @@ operations = OrderedDict([
     ('Minimum', np.min),
     ('Sum (ignore NaNs)', np.nansum),
     ('Mean (ignore NaNs)', np.nanmean),
-    ('Median (ignore NaNs)', np.nanmedian),
+    ('Median (ignore NaNs)', nanmedian),
     ('Standard Deviation (ignore NaNs)', np.nanstd),
     ('Maximum (ignore NaNs)', np.nanmax),
     ('Minimum (ignore NaNs)', np.nanmin)
@@ -36,7 +40,7 @@ operations = OrderedDict([
 
 class CollapseCube(QDialog):
     def __init__(self, wavelengths, wavelength_units, data, data_collection=[],
-                 allow_preview=False, parent=None):
+                 allow_preview=False, parent=None, prefix_sums=True):
 
         super(CollapseCube,self).__init__(parent)
 
@@ -50,6 +54,7 @@ class CollapseCube(QDialog):
         self.title = "Cube Collapse"
 
         self.wavelengths = wavelengths
+        self.wavelength_index = WavelengthIndex(wavelengths)
         self.wavelength_units = wavelength_units
         self.data = data
         self.data_collection = data_collection
@@ -63,6 +68,11 @@ class CollapseCube(QDialog):
         self.currentAxes = None
         self.currentKernel = None
 
+        # Take the sums and means of the whole image from the cumulative sums
+        # of the component, built the first time it is collapsed (see
+        # collapse_engine.PrefixSumCache)
+        self.prefix_sums = prefix_sums
+
         self.createUI()
 
     def createUI(self):
@@ -149,7 +159,7 @@ class CollapseCube(QDialog):
             start = self.ui.start_input.text().strip()
             log.debug('    start = {}'.format(start))
             try:
-                ind = np.argsort(abs(float(start) - self.wavelengths))[0]
+                ind = self.wavelength_index.nearest(float(start))
                 self.ui.start_input.setText('{}'.format(ind))
             except:
                 self.ui.start_input.setText('')
@@ -158,7 +168,7 @@ class CollapseCube(QDialog):
             end = self.ui.end_input.text().strip()
             log.debug('    end = {}'.format(end))
             try:
-                ind = np.argsort(abs(float(end) - self.wavelengths))[0]
+                ind = self.wavelength_index.nearest(float(end))
                 self.ui.end_input.setText('{}'.format(ind))
             except:
                 self.ui.end_input.setText('')
@@ -310,10 +320,9 @@ class CollapseCube(QDialog):
             self.ui.error_label.setText('End wavelength is out of range.')
             self.ui.error_label.setVisible(True)
 
-            end_wavelength = None
+            return None, None
 
-        start_index = np.argsort(abs(self.wavelengths - start_wavelength))[0]
-        end_index = np.argsort(abs(self.wavelengths - end_wavelength))[0]
+        start_index, end_index = self.wavelength_index.nearest([start_wavelength, end_wavelength])
 
         log.debug('  returning with start_index {} and end_index {}'.format(
             start_index, end_index))
@@ -494,10 +503,20 @@ class CollapseCube(QDialog):
         # Setup the input_data (and apply the spatial mask based on
         # the selection in the spatial_region_combobox
         input_data = self.data[data_name]
+        prefix_sums = (self.prefix_sums and spatial_region == 'Image' and
+                       'Simple' not in sigma_selection and 'Advanced' not in sigma_selection)
         log.debug('    spatial region is {}'.format(spatial_region))
+        region_mask = None
         if not spatial_region == 'Image':
-            subset = [x.to_mask() for x in self.data.subsets if x.label == spatial_region][0]
-            input_data = input_data * subset
+            subset = [x for x in self.data.subsets if x.label == spatial_region][0]
+            if is_spatial_subset(subset):
+                # The mask of a spatial region is the same in every slice:
+                # only the spectra inside it are collapsed, the others are NaN.
+                region_mask = SubsetMask(subset)[start_index]
+            else:
+                # Other subsets (e.g. of a spectral range or of values)
+                # select voxels: the others are ignored, a tile at a time.
+                region_mask = SubsetMask(subset)
 
         # Apply sigma clipping
         if 'Simple' in sigma_selection:
@@ -506,7 +525,7 @@ class CollapseCube(QDialog):
             if sigma is None:
                 return
 
-            input_data = sigma_clip(input_data, sigma=sigma, axis=0)
+            sigma_clip = {'sigma': sigma}
             label += ' sigma={}'.format(sigma)
 
         elif 'Advanced' in sigma_selection:
@@ -517,8 +536,8 @@ class CollapseCube(QDialog):
             if sigma is None:
                 return
 
-            input_data = sigma_clip(input_data, sigma=sigma, sigma_lower=sigma_lower,
-                                       sigma_upper=sigma_upper, iters=sigma_iters, axis=0)
+            sigma_clip = {'sigma': sigma, 'sigma_lower': sigma_lower,
+                          'sigma_upper': sigma_upper, 'iters': sigma_iters}
 
             # Add to label so it is clear which overlay/component is which
             if sigma:
@@ -533,11 +552,14 @@ class CollapseCube(QDialog):
             if sigma_iters:
                 label += ' sigma_iters={}'.format(sigma_iters)
         else:
-            input_data = input_data # noop
+            sigma_clip = None
 
-        # Do calculation if we got this far
+        # Do calculation if we got this far. The spectra are clipped as the
+        # range [start_index, end_index) is collapsed.
         new_wavelengths, new_component = collapse_cube(input_data, data_name, self.data.coords.wcs,
-                                             operation, start_index, end_index)
+                                             operation, start_index, end_index,
+                                             prefix_sums=prefix_sums, sigma_clip=sigma_clip,
+                                             mask=region_mask)
 
         new_component_unit = self.data.get_component(data_name).units
 
@@ -692,28 +714,55 @@ class CollapseCube(QDialog):
             self.cancel_callback()
 
 
-def collapse_cube(data_component, data_name, wcs, operation, start_index, end_index):
+def collapse_cube(data_component, data_name, wcs, operation, start_index=0, end_index=None, n_workers=None,
+                  prefix_sums=False, sigma_clip=None, mask=None):
     """
+    Collapse the spectral range [start_index, end_index) of a cube, one
+    spatial tile at a time in n_workers threads (see collapse_engine).
+    With prefix_sums, the sums and means are taken from the cumulative
+    sums of the component (built the first time it is collapsed), which
+    makes collapsing other ranges of the same component almost free.
 
     :param data_component:  Component from the data object
     :param wcs:
-    :param operation:
-    :param start:
-    :param end:
-    :return:
+    :param operation: key of operations
+    :param start_index: first spectral index collapsed
+    :param end_index: spectral index after the last one collapsed, the end if None
+    :param n_workers: number of threads, one per core if None
+    :param prefix_sums: use the prefix sum index of data_component, if the
+                        index fits in the memory of the indexes (see
+                        collapse_engine.PREFIX_SUMS), otherwise it is
+                        collapsed a tile at a time
+    :param sigma_clip: arguments of collapse_engine.sigma_clip_spectra (e.g.
+                       {'sigma': 3}) to sigma clip the spectra of the range,
+                       which are then collapsed ignoring the clipped values
+    :param mask: 2D boolean array of the spaxels collapsed (e.g. of a spatial
+                 region), NaN elsewhere: only its bounding box is read. Or 3D
+                 mask of the voxels collapsed (e.g. utils.arrays.SubsetMask),
+                 the other values are ignored
+    :return: wavelengths of the range, collapsed numpy.ndarray
     """
 
-    # Grab spectral-cube
-    import spectral_cube
-
-    # Create a spectral cube instance
-    cube = spectral_cube.SpectralCube(data_component, wcs=wcs)
-
-    # Do collapsing of the cube
-    sub_cube = cube[start_index:end_index]
-    calculated = sub_cube.apply_numpy_function(operations[operation], axis=0)
-
-    wavelengths = sub_cube.spectral_axis
+    # The range collapsed, with the same meaning of None and negative indexes
+    # as a slice
+    start_index, end_index, _ = slice(start_index, end_index).indices(data_component.shape[0])
+    end_index = max(end_index, start_index)
+
+    calculated = None
+    if prefix_sums and sigma_clip is None and mask is None:
+        index = PREFIX_SUMS.get(data_component)
+        if index is not None:
+            calculated = index.collapse(operations[operation], start_index, end_index)
+
+    # Do collapsing of the cube. The component may be stored as integers,
+    # the tiles are converted to floating point as they are read.
+    if calculated is None:
+        calculated = collapse_array(data_component, operations[operation], start_index, end_index,
+                                    n_workers=n_workers, sigma_clip=sigma_clip, mask=mask)
+
+    spectral_wcs = wcs.sub([WCSSUB_SPECTRAL])
+    wavelengths = u.Quantity(spectral_wcs.wcs_pix2world(np.arange(start_index, end_index), 0)[0],
+                             spectral_wcs.wcs.cunit[0])
 
     # Send collapsed cube back to cubeviz
     return wavelengths, calculated
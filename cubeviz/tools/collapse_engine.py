@@ -0,0 +1,522 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Collapse of cubes along the spectral axis, one spatial tile at a time.
+
+The spectral range collapsed is split into tiles of whole spectra (bands of
+rows, or parts of a row for very long spectra) of at most TILE_BYTES, which
+are read and reduced independently in a pool of threads: numpy releases
+the GIL in the reductions, and the tiles of lazily loaded cubes are read
+from the file in parallel. Only the tiles being reduced are in memory,
+whatever the size of the cube.
+
+Each spectrum is reduced on its own, so the result is the same as that of
+the operation on the whole range.
+
+The sums and means of the spectral ranges of a component can also be taken
+from an index of its cumulative sums (see `PrefixSumIndex`), built the
+first time the component is collapsed and then shared by the collapses over
+any range (see `PREFIX_SUMS`), each costing a subtraction of two planes.
+The indexes of all the components share a memory budget, a quarter of the
+physical memory by default (see `prefix_sum_max_bytes`): a component whose
+index alone is larger is not indexed, and is collapsed tile by tile.
+
+Sigma clipping (see `sigma_clip_spectra`) is done on each tile of the range
+collapsed, as it is read, rather than on the whole cube beforehand.
+"""
+import os
+import logging
+import weakref
+import warnings
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ..utils.arrays import as_float
+from .smoothing_engine import default_workers
+
+__all__ = ['TILE_BYTES', 'plan_tiles', 'nanmedian', 'sigma_clip_spectra', 'collapse_array',
+           'bounding_box',
+           'PrefixSumIndex', 'PrefixSumCache', 'PREFIX_SUMS', 'prefix_sum_max_bytes',
+           'CUBEVIZ_PREFIX_SUM_MEMORY']
+
+log = logging.getLogger('cubeviz_collapse_engine')
+log.setLevel(logging.WARNING)
+
+# Size of the tiles of the cube reduced at once (in float64 values)
+TILE_BYTES = 16 * 1024 ** 2
+
+# Environment variable setting the memory used by the prefix sum indexes of
+# all the components together, in MB (see `prefix_sum_max_bytes`)
+CUBEVIZ_PREFIX_SUM_MEMORY = 'CUBEVIZ_PREFIX_SUM_MEMORY'
+
+# By default the indexes use this fraction of the physical memory, and at
+# least PREFIX_SUM_MIN_BYTES (also used if the memory is not known)
+PREFIX_SUM_MEMORY_FRACTION = 0.25
+PREFIX_SUM_MIN_BYTES = 256 * 1024 ** 2
+
+
+def prefix_sum_max_bytes():
+    """
+    Memory the prefix sum indexes of all the components can use: the value
+    (in MB) of the CUBEVIZ_PREFIX_SUM_MEMORY environment variable if set,
+    otherwise PREFIX_SUM_MEMORY_FRACTION of the physical memory.
+
+    :return: int, in bytes
+    """
+    value = os.environ.get(CUBEVIZ_PREFIX_SUM_MEMORY, '')
+    if value:
+        try:
+            return max(int(float(value) * 1024 ** 2), 0)
+        except ValueError:
+            log.warning('Invalid {}={!r}, using the default memory for the prefix '
+                        'sums'.format(CUBEVIZ_PREFIX_SUM_MEMORY, value))
+
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return PREFIX_SUM_MIN_BYTES
+    return max(int(memory * PREFIX_SUM_MEMORY_FRACTION), PREFIX_SUM_MIN_BYTES)
+
+
+def plan_tiles(shape, tile_bytes=TILE_BYTES, chunks=None):
+    """
+    Split the spatial axes of a cube into tiles of whole spectra.
+
+    :param shape: shape of the part of the cube collapsed (spectral axis first)
+    :param tile_bytes: size of the tiles, in float64 values
+    :param chunks: shape of the blocks the cube is stored in (e.g. the
+                   compression tiles, see `~cubeviz.data_factories.lazy.LazyArray`),
+                   the bands of rows are then aligned on them
+    :return: list of (slice of the rows, slice of the columns)
+    """
+    nz, ny, nx = shape
+    row_bytes = max(8 * nz * nx, 1)
+
+    if row_bytes <= tile_bytes:
+        rows = max(tile_bytes // row_bytes, 1)
+        if chunks is not None and len(chunks) == 3 and rows > chunks[1]:
+            rows -= rows % chunks[1]
+        return [(slice(y, min(y + rows, ny)), slice(None)) for y in range(0, ny, rows)]
+
+    columns = max(tile_bytes // max(8 * nz, 1), 1)
+    return [(slice(y, y + 1), slice(x, min(x + columns, nx)))
+            for y in range(ny) for x in range(0, nx, columns)]
+
+
+def nanmedian(data, axis=0):
+    """
+    Median along ``axis`` ignoring the NaN values (and the masked values of
+    masked arrays), NaN where there are none, as `numpy.nanmedian`.
+
+    `numpy.nanmedian` computes the median of each spectrum in a Python loop
+    for long spectra; here the values are sorted (the NaN values last) and
+    the middle ones of the values that are not NaN are taken for all the
+    spectra at once.
+
+    :param data: array-like
+    :param axis: axis along which the median is computed
+    :return: numpy.ndarray
+    """
+    if isinstance(data, np.ma.MaskedArray):
+        data = data.astype(np.float64).filled(np.nan)
+    data = np.sort(as_float(data), axis=axis)
+
+    counts = np.sum(~np.isnan(data), axis=axis, keepdims=True)
+    lower = np.take_along_axis(data, np.maximum((counts - 1) // 2, 0), axis=axis)
+    upper = np.take_along_axis(data, counts // 2, axis=axis)
+
+    result = np.squeeze((lower + upper) / 2, axis=axis)
+    result[np.squeeze(counts, axis=axis) == 0] = np.nan
+    return result
+
+
+# The reductions ignoring the NaN values of those that do not
+NAN_FUNCTIONS = {
+    np.sum: np.nansum,
+    np.mean: np.nanmean,
+    np.median: nanmedian,
+    np.std: np.nanstd,
+    np.max: np.nanmax,
+    np.min: np.nanmin,
+}
+
+
+def sigma_clip_spectra(data, sigma=3., sigma_lower=None, sigma_upper=None, iters=5):
+    """
+    Sigma clip each spectrum of ``data``, as
+    ``astropy.stats.sigma_clip(data, axis=0)`` with its default median and
+    standard deviation: the values further than ``sigma`` standard
+    deviations below or above the median of their spectrum are clipped,
+    and the statistics computed again without them, until no value is
+    clipped or for ``iters`` iterations.
+
+    The clipped (and masked) values are set to NaN in a copy of ``data``
+    rather than masked, and each iteration only computes the statistics of
+    the spectra that had values clipped in the previous one.
+
+    :param data: array-like, spectral axis first
+    :param sigma: number of standard deviations of the clipping limits
+    :param sigma_lower: number of standard deviations of the lower limit, ``sigma`` if None
+    :param sigma_upper: number of standard deviations of the upper limit, ``sigma`` if None
+    :param iters: maximum number of iterations, until no value is clipped if None
+    :return: numpy.ndarray, float64, NaN where clipped
+    """
+    sigma_lower = sigma if sigma_lower is None else sigma_lower
+    sigma_upper = sigma if sigma_upper is None else sigma_upper
+
+    if isinstance(data, np.ma.MaskedArray):
+        result = data.astype(np.float64).filled(np.nan)
+    else:
+        result = np.array(data, dtype=np.float64)
+    shape = result.shape
+    result = result.reshape(shape[0], -1)
+
+    # Spectra whose values changed in the last iteration
+    columns = np.arange(result.shape[1])
+    iteration = 0
+    while len(columns) > 0 and (iters is None or iteration < iters):
+        values = result[:, columns]
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            center = nanmedian(values, axis=0)
+            deviation = np.nanstd(values, axis=0)
+            clipped = ((values < center - deviation * sigma_lower) |
+                       (values > center + deviation * sigma_upper))
+
+        values[clipped] = np.nan
+        result[:, columns] = values
+        columns = columns[clipped.any(axis=0)]
+        iteration += 1
+
+    return result.reshape(shape)
+
+
+def collapse_array(data, function, start_index=0, end_index=None, n_workers=None,
+                   tile_bytes=TILE_BYTES, sigma_clip=None, mask=None):
+    """
+    Apply ``function`` along the spectral axis of
+    ``data[start_index:end_index]``, one spatial tile at a time in
+    ``n_workers`` threads.
+
+    :param data: array-like, 3D (spectral axis first), e.g. a lazily loaded
+                 or a masked array
+    :param function: reduction called as ``function(values, axis=0)``, e.g.
+                     `numpy.nansum` (see ``operations`` in
+                     `~cubeviz.tools.collapse_cube`)
+    :param start_index: first spectral index collapsed
+    :param end_index: spectral index after the last one collapsed, the end if None
+    :param n_workers: number of threads, `default_workers` if None
+    :param tile_bytes: size of the tiles, in float64 values
+    :param sigma_clip: if not None, the spectra of each tile are sigma clipped
+                       with these arguments of `sigma_clip_spectra` (e.g.
+                       ``{'sigma': 3}``) and reduced ignoring the clipped
+                       values (e.g. with `numpy.nansum` for `numpy.sum`)
+    :param mask: if not None, 2D boolean array of the spectra collapsed (e.g.
+                 those of a spatial region), the others are NaN: only the
+                 tiles of its bounding box are read, and only the spectra
+                 in the mask are reduced. Or a 3D boolean array-like of the
+                 voxels collapsed (e.g. a `~cubeviz.utils.arrays.SubsetMask`
+                 of a spectral range), read a tile at a time: the other
+                 values are ignored, and the spectra without any are NaN
+    :return: numpy.ndarray, 2D (float64, NaN where masked arrays are masked)
+    """
+    voxels = None
+    if mask is not None and np.ndim(mask) == 3:
+        voxels, mask = mask, None
+
+    # The values NaN in a reduction that does not ignore them give NaN
+    propagate_nan = voxels is not None and sigma_clip is None and function in NAN_FUNCTIONS
+    if sigma_clip is not None or voxels is not None:
+        function = NAN_FUNCTIONS.get(function, function)
+
+    start, stop, _ = slice(start_index, end_index).indices(data.shape[0])
+    box = bounding_box(mask) if mask is not None else tuple(slice(0, n) for n in data.shape[1:])
+    out = np.empty(data.shape[1:]) if mask is None else np.full(data.shape[1:], np.nan)
+    if box is None:
+        return out
+
+    shape = (max(stop - start, 0), box[0].stop - box[0].start, box[1].stop - box[1].start)
+    tiles = [tuple(_within(part, box_part) for part, box_part in zip(tile, box))
+             for tile in plan_tiles(shape, tile_bytes=tile_bytes,
+                                    chunks=getattr(data, 'chunks', None))]
+
+    def collapse_tile(tile):
+        inside = None if mask is None else mask[tile]
+        if inside is not None and not inside.any():
+            return
+
+        values = as_float(data[(slice(start, stop),) + tile])
+        if inside is not None:
+            values = values[:, inside]
+        if voxels is not None:
+            # The values outside of the mask are ignored, as clipped ones
+            selected = np.asarray(voxels[(slice(start, stop),) + tile], dtype=bool)
+            values = np.ma.filled(values, np.nan)
+            nan = (np.isnan(values) & selected).any(axis=0) if propagate_nan else None
+            values = np.where(selected, values, np.nan)
+        if sigma_clip is not None:
+            values = sigma_clip_spectra(values, **sigma_clip)
+
+        if voxels is None:
+            result = np.ma.filled(function(values, axis=0), np.nan)
+        else:
+            with np.errstate(invalid='ignore'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                result = np.ma.filled(function(values, axis=0), np.nan)
+            result[~selected.any(axis=0)] = np.nan
+            if nan is not None:
+                result[nan] = np.nan
+
+        if inside is None:
+            out[tile] = result
+        else:
+            out[tile][inside] = result
+
+    _run_tiles(collapse_tile, tiles, n_workers)
+    return out
+
+
+def bounding_box(mask):
+    """
+    The smallest box holding the True values of a 2D mask.
+
+    :param mask: 2D boolean array
+    :return: (slice of the rows, slice of the columns), or None if the mask is empty
+    """
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    columns = np.flatnonzero(np.any(mask, axis=0))
+    if len(rows) == 0:
+        return None
+    return slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1)
+
+
+def _within(part, box_part):
+    # The slice of the cube of the slice ``part`` of a box
+    start, stop, _ = part.indices(box_part.stop - box_part.start)
+    return slice(box_part.start + start, box_part.start + stop)
+
+
+def _run_tiles(function, tiles, n_workers):
+    if n_workers is None:
+        n_workers = default_workers()
+
+    if n_workers < 2 or len(tiles) < 2:
+        for tile in tiles:
+            function(tile)
+        return
+
+    log.debug('Reducing {} tiles in {} threads'.format(len(tiles), n_workers))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for future in [executor.submit(function, tile) for tile in tiles]:
+            future.result()
+
+
+class PrefixSumIndex(object):
+    """
+    Cumulative sums along the spectral axis of a cube, from which the sum
+    (or mean) of the values of any spectral range is the difference of two
+    planes: an O(ny nx) rather than O(nz ny nx) collapse.
+
+    The sums ignore the NaN values, and the cumulative number of NaN values
+    tells which sums would be NaN and how many values are averaged.
+    Cubes with infinite values are not indexed (`collapse` returns None).
+
+    The index is built (a tile at a time, see `collapse_array`) the first
+    time it is used.
+
+    :param data: array-like, 3D (spectral axis first), or a weak reference
+                 to it (the indexes of `PrefixSumCache` do not keep their arrays)
+    :param n_workers: number of threads building the index, `default_workers` if None
+    :param tile_bytes: size of the tiles read at once, in float64 values
+    """
+
+    # The reductions that can be computed from the index
+    functions = (np.sum, np.mean, np.nansum, np.nanmean)
+
+    def __init__(self, data, n_workers=None, tile_bytes=TILE_BYTES):
+        self._data = data
+        self._shape = tuple((data() if isinstance(data, weakref.ref) else data).shape)
+        self._n_workers = n_workers
+        self._tile_bytes = tile_bytes
+        self._lock = threading.Lock()
+        self._sums = None
+        self._nan_counts = None
+        self._finite = True
+
+    @staticmethod
+    def index_bytes(shape):
+        """Memory used by the index of a cube of the given shape."""
+        return 12 * (shape[0] + 1) * int(np.prod(shape[1:]))
+
+    @property
+    def is_built(self):
+        return self._sums is not None
+
+    def build(self):
+        """
+        Compute the cumulative sums and NaN counts, if not done yet.
+        """
+        with self._lock:
+            if self._sums is not None:
+                return
+
+            data = self._data() if isinstance(self._data, weakref.ref) else self._data
+            if data is None:
+                raise ValueError('The array of the index no longer exists')
+
+            nz, ny, nx = self._shape
+            sums = np.zeros((nz + 1, ny, nx))
+            nan_counts = np.zeros((nz + 1, ny, nx), dtype=np.int32)
+            finite = []
+
+            def index_tile(tile):
+                values = as_float(data[(slice(None),) + tile])
+                nan = np.isnan(values)
+                finite.append(not np.isinf(values).any())
+                np.cumsum(np.where(nan, 0, values), axis=0, out=sums[(slice(1, None),) + tile])
+                np.cumsum(nan, axis=0, out=nan_counts[(slice(1, None),) + tile])
+
+            tiles = plan_tiles(self._shape, tile_bytes=self._tile_bytes,
+                               chunks=getattr(data, 'chunks', None))
+            _run_tiles(index_tile, tiles, self._n_workers)
+
+            self._finite = all(finite)
+            self._sums, self._nan_counts = sums, nan_counts
+            self._data = None
+
+    def collapse(self, function, start_index=0, end_index=None):
+        """
+        Collapse ``data[start_index:end_index]`` with one of `functions`.
+
+        :param function: numpy.sum, numpy.mean, numpy.nansum or numpy.nanmean
+        :param start_index: first spectral index collapsed
+        :param end_index: spectral index after the last one collapsed, the end if None
+        :return: numpy.ndarray, 2D, or None if the index can not be used
+        """
+        if function not in self.functions:
+            return None
+        self.build()
+        if not self._finite:
+            return None
+
+        start, stop, _ = slice(start_index, end_index).indices(self._shape[0])
+        stop = max(stop, start)
+        total = self._sums[stop] - self._sums[start]
+        nan_count = self._nan_counts[stop] - self._nan_counts[start]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if function is np.sum or function is np.mean:
+                total[nan_count > 0] = np.nan
+                if function is np.mean:
+                    total /= stop - start
+            elif function is np.nanmean:
+                total /= (stop - start) - nan_count
+        return total
+
+
+class PrefixSumCache(object):
+    """
+    The `PrefixSumIndex` of the components (their arrays), within a total
+    of ``max_bytes`` of indexes for all the components: the least recently
+    used ones are dropped to make room for new ones.
+
+    The index of an array is created the ``min_uses``-th time it is asked
+    for, and built when first used, which reads the whole cube. Arrays
+    whose index alone is larger than ``max_bytes`` (about 12 bytes per
+    value of the cube), and arrays that can not be weakly referenced, are
+    not indexed. An index is dropped when its array is no longer used, and
+    `invalidate` drops those of modified components.
+
+    :param max_bytes: memory used by the indexes of all the components,
+                      `prefix_sum_max_bytes` if None
+    :param min_uses: number of requests for an array before its index is created
+    """
+
+    def __init__(self, max_bytes=None, min_uses=1):
+        self._max_bytes = prefix_sum_max_bytes() if max_bytes is None else max_bytes
+        self._min_uses = min_uses
+        self._lock = threading.Lock()
+
+        # id(array) -> [weak reference to the array, PrefixSumIndex or None, requests]
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        """Number of indexes."""
+        return sum(entry[1] is not None for entry in self._entries.values())
+
+    @property
+    def max_bytes(self):
+        """Memory the indexes can use, the least recently used are dropped when it is lowered."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._evict(None)
+
+    @property
+    def nbytes(self):
+        """Memory used by the indexes."""
+        return sum(PrefixSumIndex.index_bytes(entry[1]._shape)
+                   for entry in self._entries.values() if entry[1] is not None)
+
+    def get(self, data):
+        """
+        The index of ``data``, created (but not built) if it was asked for
+        ``min_uses`` times.
+
+        :param data: array-like, 3D (spectral axis first)
+        :return: PrefixSumIndex, or None if its index would be too large or
+                 it was not asked for often enough yet
+        """
+        if PrefixSumIndex.index_bytes(data.shape) > self._max_bytes:
+            log.debug('Not indexing an array of shape {}: its prefix sums are larger than '
+                      'the {} bytes of the indexes'.format(data.shape, self._max_bytes))
+            return None
+
+        key = id(data)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0]() is not data:
+                try:
+                    reference = weakref.ref(data, lambda ref: self._discard(key, ref))
+                except TypeError:
+                    return None
+                entry = self._entries[key] = [reference, None, 0]
+
+            self._entries.move_to_end(key)
+            entry[2] += 1
+            if entry[1] is None and entry[2] >= self._min_uses:
+                entry[1] = PrefixSumIndex(entry[0])
+                self._evict(key)
+            return entry[1]
+
+    def _evict(self, keep):
+        # Drop the least recently used indexes until they fit in max_bytes
+        for key in list(self._entries):
+            if self.nbytes <= self._max_bytes:
+                break
+            if key != keep and self._entries[key][1] is not None:
+                del self._entries[key]
+
+    def _discard(self, key, reference):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is reference:
+                del self._entries[key]
+
+    def invalidate(self, data=None):
+        """
+        Drop the index of ``data``, or all the indexes if None.
+        """
+        with self._lock:
+            if data is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(id(data), None)
+
+
+PREFIX_SUMS = PrefixSumCache()
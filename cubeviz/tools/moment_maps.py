@@ -1,3 +1,5 @@
+import numpy as np
+
 from qtpy.QtCore import Qt
 from qtpy import QtGui
 from qtpy.QtWidgets import (QDialog, QComboBox, QPushButton,
@@ -90,9 +92,12 @@ class MomentMapsGUI(QDialog):
     def do_calculation(self, order, data_name):
         # Grab spectral-cube
         import spectral_cube
-        cube = spectral_cube.SpectralCube(self.data[data_name], wcs=self.data.coords.wcs)
+        # The cube keeps the dtype of the component: computing the moment a
+        # slice at a time converts only one plane at a time to floating point
+        # instead of making a float64 copy of the whole cube.
+        cube = spectral_cube.SpectralCube(np.asanyarray(self.data[data_name]), wcs=self.data.coords.wcs)
 
-        cube_moment = cube.moment(order=order, axis=0)
+        cube_moment = cube.moment(order=order, axis=0, how='slice')
 
         self.label = '{}-moment-{}'.format(data_name, order)
 
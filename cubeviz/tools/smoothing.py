@@ -1,20 +1,25 @@
+import threading
+
 import numpy as np
-from scipy import ndimage
 
 from astropy import convolution
 
 from glue.core import Data, Subset, Component
-from glue.core.coordinates import coordinates_from_header, WCSCoordinates
+from glue.core.coordinates import WCSCoordinates
 from glue.core.exceptions import IncompatibleAttribute
 from glue.utils.qt import update_combobox
 
-from spectral_cube import SpectralCube, BooleanArrayMask
+from ..utils.arrays import as_float, AllValidMask, SubsetMask
+from ..utils.preview_cache import PREVIEW_PREFETCH
+from .smoothing_engine import (SmoothingSpec, BLOCKS_PER_WORKER, default_workers, select_method,
+                               error_spec, plan_batch, smooth_plane, smooth_array, smooth_batch)
 
 from qtpy.QtCore import Qt, Signal, QThread
 from qtpy.QtWidgets import (
     QDialog, QApplication, QPushButton, QProgressBar,
     QLabel, QWidget, QDockWidget, QHBoxLayout, QVBoxLayout,
-    QComboBox, QMessageBox, QLineEdit, QRadioButton
+    QComboBox, QMessageBox, QLineEdit, QRadioButton, QCheckBox,
+    QListWidget, QAbstractItemView, QSpinBox
 )
 
 
@@ -52,15 +57,22 @@ class WorkerThread(QThread):
 
 class SmoothCube(object):
     """
-    SmoothCube is a wrapper for SpectralCube. It is designed to
+    SmoothCube smooths glue Data. It is designed to
     operate in CubeViz and glue.
     It saves a registry of available kernels and executes
-    smoothing operations. It has the ability to use QThreads
-    when working in gui mode.
+    smoothing operations, a block of the cube at a time in
+    n_workers processes (see smoothing_engine). It has the
+    ability to use QThreads when working in gui mode.
+    In batch mode (component_ids, kernels and/or error_component_ids
+    set) several components are smoothed with several kernels in a
+    single pass over the cube, the uncertainties of the
+    error_component_ids being propagated rather than smoothed.
     """
 
     def __init__(self, data=None, smoothing_axis=None, kernel_type=None, kernel_size=None,
-                 component_id=None, output_label=None, output_as_component=False, parent=None):
+                 component_id=None, output_label=None, output_as_component=False, parent=None,
+                 n_workers=None, out_of_core=False, output_directory=None,
+                 component_ids=None, kernels=None, error_component_ids=None):
         self.data = data  # Glue data to be smoothed
         self.smoothing_axis = smoothing_axis  # spectral vs spatial
         self.kernel_type = kernel_type  # Type of kernel, a key in kernel_registry
@@ -70,6 +82,14 @@ class SmoothCube(object):
         self.output_label = output_label  # Output label
         self.output_as_component = output_as_component  # Add output component to self.data
         self.kernel_registry = self.load_kernel_registry()  # A list of kernels and params
+        self.n_workers = n_workers  # Number of smoothing processes, one per core if None
+        self.out_of_core = out_of_core  # Memory map the output to a file rather than hold it in memory
+        self.output_directory = output_directory  # Directory of the memory mapped output, tempdir if None
+
+        # Batch mode
+        self.component_ids = component_ids  # Components to smooth, [component_id] if None
+        self.kernels = kernels  # (smoothing_axis, kernel_type, kernel_size) of each smoothing, saved ones if None
+        self.error_component_ids = error_component_ids or []  # Uncertainties to propagate through the kernels
 
         self.parent = parent  # If gui is going to be used, parent of new gui
 
@@ -78,7 +98,7 @@ class SmoothCube(object):
         self.is_active = False  # Is thread active
         self.abort_window = None  # Abort window gui
         self.thread = None # QThread
-        self.thread_cube = None  # Input SpectralCube
+        self.thread_groups = None  # Blocks of the cube smoothed by the thread (see plan_batch)
         self.thread_result = None  # Temporary storage for thread output
 
     @staticmethod
@@ -95,6 +115,9 @@ class SmoothCube(object):
                 axis: Available axes. Each must have a kernel.
                 spatial: 2D astropy.convolution.kernel else None.
                 spectral: 1D astropy.convolution.kernel else None.
+                separable: True if the 2D kernel is the product of 1D
+                           kernels, so that it can be applied as two
+                           1D convolutions (optional).
 
         :return: kernel_registry
         """
@@ -105,14 +128,16 @@ class SmoothCube(object):
                     "size_dimension": "Width",
                     "axis": ["spatial", "spectral"],
                     "spatial": convolution.Box2DKernel,
-                    "spectral": convolution.Box1DKernel},
+                    "spectral": convolution.Box1DKernel,
+                    "separable": True},
             "gaussian": {"name": "Gaussian",
                          "unit_label": "Spaxel",
                          "size_prompt": "Standard Deviation of Kernel:",
                          "size_dimension": "Sigma",
                          "axis": ["spatial", "spectral"],
                          "spatial": convolution.Gaussian2DKernel,
-                         "spectral": convolution.Gaussian1DKernel},
+                         "spectral": convolution.Gaussian1DKernel,
+                         "separable": True},
             "trapezoid": {"name": "Trapezoid",
                           "unit_label": "Spaxel",
                           "size_prompt": "Width of Kernel:",
@@ -150,12 +175,77 @@ class SmoothCube(object):
     def get_kernel_registry(self):
         return self.kernel_registry
 
-    def get_kernel(self):
+    def get_kernel(self, smoothing_axis=None, kernel_type=None, kernel_size=None):
         """
-        Gets an kernel using the saved parameters
+        Gets an kernel using the saved parameters (or the ones given)
         :return: astropy.convolution.kernel
         """
-        return self.kernel_registry[self.kernel_type][self.smoothing_axis](self.kernel_size)
+        smoothing_axis = smoothing_axis or self.smoothing_axis
+        kernel_type = kernel_type or self.kernel_type
+        kernel_size = self.kernel_size if kernel_size is None else kernel_size
+        return self.kernel_registry[kernel_type][smoothing_axis](kernel_size)
+
+    def get_smoothing_spec(self, smoothing_axis=None, kernel_type=None, kernel_size=None):
+        """
+        Gets the smoothing_engine description of the saved parameters (or the ones given)
+        :return: smoothing_engine.SmoothingSpec
+        """
+        smoothing_axis = smoothing_axis or self.smoothing_axis
+        kernel_type = kernel_type or self.kernel_type
+        kernel_size = self.kernel_size if kernel_size is None else kernel_size
+        if "median" == kernel_type:
+            return SmoothingSpec(smoothing_axis, "median", None, int(kernel_size))
+        separable = self.kernel_registry[kernel_type].get("separable", False)
+        kernel = self.get_kernel(smoothing_axis, kernel_type, kernel_size)
+        return SmoothingSpec(smoothing_axis, "convolve", kernel.array, None, separable=separable)
+
+    def is_batch(self):
+        """True if several components or kernels are smoothed"""
+        return bool(self.component_ids or self.kernels or self.error_component_ids)
+
+    def get_component_ids(self):
+        """
+        Components smoothed: component_ids (or component_id) followed by
+        error_component_ids.
+        :return: list
+        """
+        component_ids = [self.component_id] if self.component_ids is None else self.component_ids
+        component_ids = [c for c in component_ids
+                         if c is not None and c not in self.error_component_ids]
+        component_ids += list(self.error_component_ids)
+        if len(component_ids) == 0:
+            raise Exception("component_id was not provided.")
+        return component_ids
+
+    def get_batch(self):
+        """
+        Smoothings done by smooth_batch: each component with each kernel.
+        :return: list of (component_id, smoothing_axis, kernel_type, kernel_size, is_error)
+        """
+        kernels = self.kernels or [(self.smoothing_axis, self.kernel_type, self.kernel_size)]
+        return [(component_id, smoothing_axis, kernel_type, kernel_size,
+                 component_id in self.error_component_ids)
+                for component_id in self.get_component_ids()
+                for smoothing_axis, kernel_type, kernel_size in kernels]
+
+    def get_batch_specs(self):
+        """
+        smoothing_engine description of each smoothing of get_batch
+        :return: list of smoothing_engine.SmoothingSpec
+        """
+        specs = []
+        for component_id, smoothing_axis, kernel_type, kernel_size, is_error in self.get_batch():
+            spec = self.get_smoothing_spec(smoothing_axis, kernel_type, kernel_size)
+            if is_error:
+                spec = error_spec(spec)
+            specs.append(spec)
+        return specs
+
+    def get_n_workers(self):
+        """Number of smoothing processes"""
+        if self.n_workers is None:
+            return default_workers()
+        return self.n_workers
 
     def get_kernel_size_prompt(self, kernel_type=None):
         """kernel_type -> size_prompt"""
@@ -213,71 +303,67 @@ class SmoothCube(object):
         raise Exception("WCS information was not provided.")
 
     def get_glue_mask(self):
-        """Function make/extract mask of glue Data"""
+        """
+        Function make/extract mask of glue Data. The mask is lazy: the
+        subset masks are evaluated a block at a time and the mask of
+        a Data (all valid) is never allocated.
+        :return: SubsetMask or AllValidMask
+        """
         if isinstance(self.data, Subset):
             try:
-                mask = self.data.to_mask()
-                return mask
+                # Check that the subset applies to the data on one voxel
+                self.data.to_mask((slice(0, 1),) * self.data.ndim)
+                return SubsetMask(self.data)
             except IncompatibleAttribute:
                 pass
-        d = self.data[self.component_id]
-        mask = np.empty_like(d)
-        mask.fill(True)
-        mask = mask.astype(bool)
-        return mask
-
-    def data_to_cube(self):
-        """Glue Data -> SpectralCube"""
-        if self.component_id is None:
-            raise Exception("component_id was not provided.")
-        wcs = self.get_glue_wcs()
-        data_array = self.data[self.component_id]
-        mask = BooleanArrayMask(
-            mask=self.get_glue_mask(),
-            wcs=wcs)
-        self.component_unit = self.data.get_component(self.component_id).units
-        return SpectralCube(data=data_array, wcs=wcs, mask=mask)
+        return AllValidMask(self.data.shape)
 
     def cube_to_data(self, cube,
                      output_label=None,
                      output_component_id=None):
         """
-        Convert SpectralCube to final output.
+        Convert the smoothed array to final output.
         self.output_as_component is checked here.
         if self.output_as_component:
             add new component to self.data
         else:
             create new data and return it.
-        :param cube: SpectralCube
+        :param cube: numpy.ndarray
         :param output_label: Name of new Data.
         :param output_component_id: label of new component
         :return:
         """
         original_data = self.data
-        new_component = Component(cube._data.copy(), self.component_unit)
+        new_component = Component(cube, self.component_unit)
         if self.output_as_component:
             original_data.add_component(new_component, output_component_id)
             return None
         else:
             new_data = Data(label=output_label)
-            new_data.coords = coordinates_from_header(cube.header)
+            new_data.coords = WCSCoordinates(wcs=self.get_glue_wcs())
             new_data.add_component(new_component, output_component_id)
             return new_data
 
-    def unique_output_component_id(self):
-        unit_label = self.kernel_registry[self.kernel_type]["unit_label"].lower()
-        if self.kernel_size == 1:
-            kernel_size_text = "{0}_{1}".format(self.kernel_size, unit_label)
+    def unique_output_component_id(self, component_id=None, smoothing_axis=None,
+                                   kernel_type=None, kernel_size=None):
+        component_id = component_id or self.component_id
+        smoothing_axis = smoothing_axis or self.smoothing_axis
+        kernel_type = kernel_type or self.kernel_type
+        kernel_size = self.kernel_size if kernel_size is None else kernel_size
+
+        unit_label = self.kernel_registry[kernel_type]["unit_label"].lower()
+        if kernel_size == 1:
+            kernel_size_text = "{0}_{1}".format(kernel_size, unit_label)
         else:
-            kernel_size_text = "{0}_{1}s".format(self.kernel_size, unit_label)
+            kernel_size_text = "{0}_{1}s".format(kernel_size, unit_label)
 
         name_tail = "_Smoothed(" + ", ".join([
-                                            self.kernel_type_to_name(self.kernel_type),
-                                            self.smoothing_axis.title(),
+                                            self.kernel_type_to_name(kernel_type),
+                                            smoothing_axis.title(),
                                             kernel_size_text]) + ")"
 
-        if self.output_label is None:
-            output_component_id = self.component_id + name_tail
+        if self.output_label is None or self.is_batch():
+            output_component_id = str(component_id) + name_tail
         else:
             output_component_id = self.output_label
 
@@ -299,15 +385,22 @@ class SmoothCube(object):
         return output_component_id
 
     def output_data_name(self):
-        unit_label = self.kernel_registry[self.kernel_type]["unit_label"].lower()
-        if self.kernel_size == 1:
-            kernel_size_text = "{0}_{1}".format(self.kernel_size, unit_label)
+        if self.kernels is not None and len(self.kernels) > 1:
+            if self.output_label is None:
+                return self.data.label + "_Smoothed"
+            return self.output_label
+
+        smoothing_axis, kernel_type, kernel_size = (self.kernels or [(
+            self.smoothing_axis, self.kernel_type, self.kernel_size)])[0]
+        unit_label = self.kernel_registry[kernel_type]["unit_label"].lower()
+        if kernel_size == 1:
+            kernel_size_text = "{0}_{1}".format(kernel_size, unit_label)
         else:
-            kernel_size_text = "{0}_{1}s".format(self.kernel_size, unit_label)
+            kernel_size_text = "{0}_{1}s".format(kernel_size, unit_label)
 
         name_tail = "_Smoothed(" + ", ".join([
-                                            self.kernel_type_to_name(self.kernel_type),
-                                            self.smoothing_axis.title(),
+                                            self.kernel_type_to_name(kernel_type),
+                                            smoothing_axis.title(),
                                             kernel_size_text]) + ")"
 
         if self.output_label is None:
@@ -315,35 +408,90 @@ class SmoothCube(object):
         else:
             return self.output_label
 
+    def smooth_array(self, update_function=None, blocks=None):
+        """
+        Smooth the component using the saved parameters.
+        :param update_function: function called after each block is smoothed
+        :param blocks: list of smoothing_engine.Block, planned for
+                       self.n_workers if None
+        :return: numpy.ndarray
+        """
+        if self.component_id is None:
+            raise Exception("component_id was not provided.")
+        self.component_unit = self.data.get_component(self.component_id).units
+        return smooth_array(self.data[self.component_id], self.get_smoothing_spec(),
+                            mask=self.get_glue_mask(), n_workers=self.get_n_workers(),
+                            update_function=update_function, blocks=blocks,
+                            memmap=self.out_of_core, directory=self.output_directory)
+
+    def smooth_batch(self, update_function=None, groups=None):
+        """
+        Do all the smoothings of get_batch in one pass over the cube,
+        reading each block of each component once.
+        :param update_function: function called after each block is smoothed
+        :param groups: blocks of the smoothings (see smoothing_engine.plan_batch),
+                       planned for self.n_workers if None
+        :return: list of numpy.ndarray, in the order of get_batch
+        """
+        component_ids = self.get_component_ids()
+        self.component_unit = self.data.get_component(component_ids[0]).units
+        jobs = [(component_ids.index(smoothing[0]), spec)
+                for smoothing, spec in zip(self.get_batch(), self.get_batch_specs())]
+        return smooth_batch([self.data[c] for c in component_ids], jobs,
+                            mask=self.get_glue_mask(), n_workers=self.get_n_workers(),
+                            update_function=update_function, groups=groups,
+                            memmap=self.out_of_core, directory=self.output_directory)
+
+    def batch_to_data(self, arrays, output_as_component=None):
+        """
+        Output of smooth_batch: add each array as a new component of
+        self.data, or of a new Data if not output_as_component.
+        :param arrays: list of numpy.ndarray, in the order of get_batch
+        :param output_as_component: self.output_as_component if None
+        :return: (glue.core.Data or None, list of the new component ids)
+        """
+        if output_as_component is None:
+            output_as_component = self.output_as_component
+        new_data = None
+        if not output_as_component:
+            new_data = Data(label=self.output_data_name())
+            new_data.coords = WCSCoordinates(wcs=self.get_glue_wcs())
+
+        output_component_ids = []
+        for smoothing, array in zip(self.get_batch(), arrays):
+            component_id, smoothing_axis, kernel_type, kernel_size, is_error = smoothing
+            new_component = Component(array, self.data.get_component(component_id).units)
+            output_component_id = self.unique_output_component_id(
+                component_id, smoothing_axis, kernel_type, kernel_size)
+            if new_data is None:
+                self.data.add_component(new_component, output_component_id)
+            else:
+                new_data.add_component(new_component, output_component_id)
+            output_component_ids.append(output_component_id)
+        return new_data, output_component_ids
+
     def smooth_cube(self, preview=False):
         """
-        Main (serial) smoothing function that follows the following steps:
-        1) Convert data to SpectralCube
-        2) Obtain Kernel using saved parameters (if applicable)
-        3) Smooth cube
-        4) Generate name based on saved parameters
-        5) Output component or Data
+        Main (non-threaded) smoothing function that follows the following steps:
+        1) Obtain Kernel using saved parameters (if applicable)
+        2) Smooth cube, a block at a time
+        3) Generate name based on saved parameters
+        4) Output component or Data
         :return: glue.core.Data or None
         """
-        cube = self.data_to_cube()
+        if self.is_batch():
+            arrays = self.smooth_batch()
+            if preview:
+                return arrays
+            return self.batch_to_data(arrays)[0]
 
-        if "median" == self.kernel_type:
-            if "spatial" == self.smoothing_axis:
-                new_cube = cube.spatial_smooth_median(self.kernel_size)
-            else:
-                new_cube = cube.spectral_smooth_median(self.kernel_size)
-        else:
-            kernel = self.get_kernel()
-            if "spatial" == self.smoothing_axis:
-                new_cube = cube.spatial_smooth(kernel)
-            else:
-                new_cube = cube.spectral_smooth(kernel)
+        new_cube = self.smooth_array()
 
         if self.output_as_component:
             output_component_id = self.unique_output_component_id()
             output = self.cube_to_data(new_cube, output_component_id=output_component_id)
         elif preview:
-            return cube._data.copy()
+            return new_cube
         else:
             output_label = self.output_data_name()
             output = self.cube_to_data(new_cube,
@@ -356,17 +504,15 @@ class SmoothCube(object):
         """
         Prepares data and starts worker thread.
         Overall steps accomplished:
-            1) Convert data to SpectralCube and start thread
+            1) Split the cube into blocks and start thread
         """
-        cube = self.data_to_cube()
+        shape = self.data[self.get_component_ids()[0]].shape
+        n_blocks = self.get_n_workers() * BLOCKS_PER_WORKER
+        self.thread_groups = plan_batch(shape, self.get_batch_specs(), n_blocks)
 
-        # Handshake b/w SpectralCube and AbortWindow
-        if "spectral" == self.smoothing_axis:
-            self.abort_window.init_pb(0, cube.shape[1]*cube.shape[2])
-        else:
-            self.abort_window.init_pb(0, cube.shape[0])
+        # Handshake b/w smoothing_engine and AbortWindow
+        self.abort_window.init_pb(0, sum(len(blocks) for _, blocks in self.thread_groups))
 
-        self.thread_cube = cube
         self.thread = WorkerThread(self, self.parent)
         self.thread.start()
 
@@ -377,29 +523,13 @@ class SmoothCube(object):
             2) Obtain Kernel using saved parameters (if applicable)
             3) Smooth cube
         :return: bool: True if output is added to self.thread_result
-        :raises: Exception: if output is not an instance of SpectralCube
         """
         success = True
 
-        cube = self.thread_cube
         update_function = self.abort_window.update_pb
-        if "median" == self.kernel_type:
-            if "spatial" == self.smoothing_axis:
-                new_cube = cube.spatial_smooth_median(self.kernel_size, update_function=update_function)
-            else:
-                new_cube = cube.spectral_smooth_median(self.kernel_size, update_function=update_function)
-        else:
-            kernel = self.get_kernel()
-            if "spatial" == self.smoothing_axis:
-                new_cube = cube.spatial_smooth(kernel, update_function=update_function)
-            else:
-                new_cube = cube.spectral_smooth(kernel, update_function=update_function)
-
-        if isinstance(new_cube, SpectralCube):
-            self.thread_result = new_cube
-            return success
-        else:
-            raise Exception("Unexpected return type from SpectralCube.")
+        self.thread_result = self.smooth_batch(update_function=update_function,
+                                               groups=self.thread_groups)
+        return success
 
     def thread_callback(self):
         """
@@ -408,9 +538,8 @@ class SmoothCube(object):
             4) Generate name based on saved parameters
             5) Output as component ONLY
         """
-        output_component_id = self.unique_output_component_id()
-        output = self.cube_to_data(self.thread_result, output_component_id=output_component_id)
-        self.abort_window.smoothing_done(output_component_id)
+        output, output_component_ids = self.batch_to_data(self.thread_result, output_as_component=True)
+        self.abort_window.smoothing_done(", ".join(output_component_ids))
 
     def thread_error_handler(self, exception):
         self.abort_window.print_error(exception)
@@ -421,11 +550,34 @@ class SmoothCube(object):
         ex = SelectSmoothing(self.data, self.parent)
 
     def preview_smoothing(self, data):
-        if "median" == self.kernel_type:
-            return ndimage.filters.median_filter(data, self.kernel_size)
-        else:
-            kernel = self.get_kernel()
-            return convolution.convolve(data, kernel, normalize_kernel=True)
+        return self.get_preview_function()(data)
+
+    def get_preview_function(self):
+        """
+        Single-slice smoothing function for the preview with the current
+        parameters. The kernel is computed here, so the function keeps
+        smoothing with them in the prefetch thread when the parameters
+        change. Its cache_key identifies the parameters, so that the
+        viewers can cache the smoothed slices.
+        :return: function
+        """
+        spec = self.get_smoothing_spec()
+
+        # The method (and the FFT of large kernels) of each shape of slices,
+        # chosen once for the slices of the viewers and the prefetch thread
+        plans = {}
+        lock = threading.Lock()
+
+        def preview_function(data):
+            data = as_float(data)
+            with lock:
+                if data.shape not in plans:
+                    plans[data.shape] = select_method(spec, data.shape)
+                plane_spec = plans[data.shape]
+            return smooth_plane(data, plane_spec)
+
+        preview_function.cache_key = (self.kernel_type, self.smoothing_axis, self.kernel_size)
+        return preview_function
 
     def get_preview_title(self):
         title = "Smoothing Preview: "
@@ -541,10 +693,7 @@ class AbortWindow(QDialog):
     def print_error(self, exception):
         """Print error message"""
 
-        if "signal only works in main thread" in str(exception):
-            message = "Smoothing Failed!\n\n" + "Please update your SpectralCube package"
-        else:
-            message = "Smoothing Failed!\n\n" + str(exception)
+        message = "Smoothing Failed!\n\n" + str(exception)
 
         self.show_error_message(message, "Error", self)
         self.clean_up()
@@ -561,6 +710,9 @@ class SelectSmoothing(QDialog):
     """
     SelectSmoothing launches a GUI and executes smoothing.
     Any output is added to the input data as a new component.
+    In batch mode several components are smoothed with several
+    (comma separated) kernel sizes at once, and the uncertainties
+    of an error component are propagated.
     """
 
     def __init__(self, data, parent=None, smooth_cube=None,
@@ -658,9 +810,37 @@ class SelectSmoothing(QDialog):
         if self.allow_preview:
             self.component_combo.currentIndexChanged.connect(self.update_preview_button)
 
+        # Batch mode: several components, selected in a list
+        self.component_list = QListWidget()
+        self.component_list.setSelectionMode(QAbstractItemView.MultiSelection)
+        self.component_list.addItems([label for label, cid in labeldata])
+        self.component_list.setMaximumWidth(150)
+        self.component_list.hide()
+
         hbl4 = QHBoxLayout()
         hbl4.addWidget(self.component_prompt)
         hbl4.addWidget(self.component_combo)
+        hbl4.addWidget(self.component_list)
+
+        # LINE 4b: Batch mode and error component drop down
+        self.batch_check = QCheckBox("Batch (comma separated sizes, several components)")
+        self.batch_check.toggled.connect(self.batch_mode_changed)
+
+        hbl_batch = QHBoxLayout()
+        hbl_batch.addWidget(self.batch_check)
+
+        self.error_prompt = QLabel("Error Component:")
+        self.error_prompt.setWordWrap(True)
+        self.error_prompt.setMinimumWidth(150)
+        self.error_combo = QComboBox()
+        update_combobox(self.error_combo, [("None", None)] + labeldata)
+        self.error_combo.setMaximumWidth(150)
+        self.error_prompt.hide()
+        self.error_combo.hide()
+
+        hbl_error = QHBoxLayout()
+        hbl_error.addWidget(self.error_prompt)
+        hbl_error.addWidget(self.error_combo)
 
         # Line 5: Preview Message
         message = "Info: Smoothing previews are displayed on " \
@@ -671,6 +851,20 @@ class SelectSmoothing(QDialog):
         hbl5 = QHBoxLayout()
         hbl5.addWidget(self.preview_message)
 
+        # LINE 5b: Number of slices smoothed ahead of the previewed one
+        self.prefetch_prompt = QLabel("Preview Prefetch (slices):")
+        self.prefetch_prompt.setWordWrap(True)
+        self.prefetch_prompt.setMinimumWidth(150)
+        self.prefetch_spin = QSpinBox()
+        self.prefetch_spin.setRange(0, 20)
+        self.prefetch_spin.setValue(PREVIEW_PREFETCH)
+        self.prefetch_spin.setToolTip("Slices on each side of the previewed one "
+                                      "smoothed ahead of time, 0 to only smooth the one shown")
+
+        hbl_prefetch = QHBoxLayout()
+        hbl_prefetch.addWidget(self.prefetch_prompt)
+        hbl_prefetch.addWidget(self.prefetch_spin)
+
         # LINE 6: preview ok cancel buttons
         self.previewButton = QPushButton("Preview Slice")
         self.previewButton.clicked.connect(self.call_preview)
@@ -697,7 +891,11 @@ class SelectSmoothing(QDialog):
         vbl.addLayout(hbl2)
         vbl.addLayout(hbl3)
         vbl.addLayout(hbl4)
+        vbl.addLayout(hbl_batch)
+        vbl.addLayout(hbl_error)
         vbl.addLayout(hbl5)
+        if self.allow_preview:
+            vbl.addLayout(hbl_prefetch)
         vbl.addLayout(hbl6)
 
         self.setLayout(vbl)
@@ -750,6 +948,37 @@ class SelectSmoothing(QDialog):
         self.combo.clear()
         self.combo.addItems(self.options[self.current_axis])
 
+    def batch_mode_changed(self, checked):
+        """Switch between one component and kernel size and batch mode"""
+        self.component_combo.setVisible(not checked)
+        self.component_list.setVisible(checked)
+        self.error_prompt.setVisible(checked)
+        self.error_combo.setVisible(checked)
+
+    def get_kernel_sizes(self):
+        """
+        Kernel sizes entered: one, or several comma separated ones in batch mode
+        :return: list of int (median) or float
+        :raises: ValueError if a size is not a number
+        """
+        texts = [self.k_size.text()]
+        if self.batch_check.isChecked():
+            texts = [text for text in self.k_size.text().split(",") if text.strip()]
+        if self.current_kernel_type == "median":
+            return [int(text) for text in texts]
+        return [float(text) for text in texts]
+
+    def get_batch_components(self):
+        """
+        Components selected in batch mode and the error component (or None)
+        :return: (list of str, str or None)
+        """
+        component_ids = [str(item.text()) for item in self.component_list.selectedItems()]
+        error_component_id = self.error_combo.currentData()
+        if error_component_id is not None:
+            error_component_id = str(error_component_id)
+        return component_ids, error_component_id
+
     def input_validation(self):
         """
         Check if input will break Smoothing
@@ -764,10 +993,7 @@ class SelectSmoothing(QDialog):
             success = False
         else:
             try:
-                if self.current_kernel_type == "median":
-                    k_size = int(self.k_size.text())
-                else:
-                    k_size = float(self.k_size.text())
+                k_size = min(self.get_kernel_sizes())
                 if k_size <= 0:
                     self.k_size.setStyleSheet(red)
                     success = False
@@ -780,6 +1006,19 @@ class SelectSmoothing(QDialog):
                 self.k_size.setStyleSheet(red)
                 success = False
 
+        # Check 2: batch mode components
+        if self.batch_check.isChecked():
+            component_ids, error_component_id = self.get_batch_components()
+            if len(component_ids) == 0 and error_component_id is None:
+                self.component_list.setStyleSheet(red)
+                success = False
+            else:
+                self.component_list.setStyleSheet("")
+            if error_component_id is not None and self.current_kernel_type == "median":
+                info = QMessageBox.critical(self, "Error",
+                                            "Errors can not be propagated through a median filter")
+                success = False
+
         return success
 
     def call_main(self):
@@ -812,13 +1051,22 @@ class SelectSmoothing(QDialog):
             self.smooth_cube.data = self.data
         self.smooth_cube.smoothing_axis = self.current_axis
         self.smooth_cube.kernel_type = self.current_kernel_type
-        if self.current_kernel_type == "median":
-            self.smooth_cube.kernel_size = int(self.k_size.text())
-        else:
-            self.smooth_cube.kernel_size = float(self.k_size.text())
+        kernel_sizes = self.get_kernel_sizes()
+        self.smooth_cube.kernel_size = kernel_sizes[0]
         self.smooth_cube.component_id = str(self.component_combo.currentText())
         self.smooth_cube.output_as_component = True
 
+        if self.batch_check.isChecked():
+            component_ids, error_component_id = self.get_batch_components()
+            self.smooth_cube.component_ids = component_ids
+            self.smooth_cube.kernels = [(self.current_axis, self.current_kernel_type, kernel_size)
+                                        for kernel_size in kernel_sizes]
+            self.smooth_cube.error_component_ids = [] if error_component_id is None else [error_component_id]
+        else:
+            self.smooth_cube.component_ids = None
+            self.smooth_cube.kernels = None
+            self.smooth_cube.error_component_ids = []
+
         if self.is_preview_active:
             self.parent.end_smoothing_preview()
             self.is_preview_active = False
@@ -851,15 +1099,13 @@ class SelectSmoothing(QDialog):
             self.smooth_cube.parent = self.parent
         self.smooth_cube.smoothing_axis = self.current_axis
         self.smooth_cube.kernel_type = self.current_kernel_type
-        if self.current_kernel_type == "median":
-            self.smooth_cube.kernel_size = int(self.k_size.text())
-        else:
-            self.smooth_cube.kernel_size = float(self.k_size.text())
+        self.smooth_cube.kernel_size = self.get_kernel_sizes()[0]  # The first size in batch mode
 
-        preview_function = self.smooth_cube.preview_smoothing
+        preview_function = self.smooth_cube.get_preview_function()
         preview_title = self.smooth_cube.get_preview_title()
         component_id = self.component_combo.currentData()
-        self.parent.start_smoothing_preview(preview_function, component_id, preview_title)
+        self.parent.start_smoothing_preview(preview_function, component_id, preview_title,
+                                            prefetch=self.prefetch_spin.value())
 
         self.is_preview_active = True
         self.preview_message.show()
@@ -0,0 +1,1059 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Block-wise smoothing of cubes, in parallel worker processes.
+
+For a spatial kernel each slice is smoothed on its own and for a spectral
+kernel each spectrum is smoothed on its own, so the cube is split into blocks
+of slices (spatial kernels) or of spaxel rows (spectral kernels) that are
+smoothed independently. When there are fewer slices than blocks, the slices
+are split along their rows instead, with a halo of the kernel half-width on
+each side so that the rows at the edges of a block see their neighbours.
+
+The blocks are read in this process and sent to the worker processes, which
+send back the smoothed blocks, only a few blocks being in flight at a time.
+The workers are started once and kept for the next smoothings, and small
+cubes are smoothed in this process (see `PARALLEL_MIN_BYTES`). The smoothed
+blocks are written straight into the output array, which is held in memory
+unless it is given (e.g. a `numpy.memmap`) or memory mapped to a temporary
+file, so that smoothing a cube out of core does not hold more than the input
+and a few blocks in memory. The results are the same as those of the
+spectral-cube smoothing methods used before: the masked voxels are NaN and
+are interpolated over by the convolutions.
+
+Kernels with many elements are applied by FFT (see `select_method`), which
+costs the same whatever the size of the kernel. The transform of the kernel
+is computed once for the whole cube (see `FFTPlan`) and the slices or
+spectra of a block are transformed together. Separable spatial kernels
+(Gaussian and box) are applied as two 1D convolutions over all the slices of
+a block at once (see `SeparablePlan`), which costs O(k) rather than O(k^2)
+per pixel for a kernel of width k. Likewise, the other spectral kernels are
+applied to all the spectra of a block at once (see `SpectralPlan`) rather
+than one spaxel at a time.
+
+The median filters (see `MedianPlan`) ignore the NaN values: each pixel is
+the median of the values that are not NaN in its window. Large spatial
+windows are filtered with histograms of the ranks of the values (see
+`histogram_medians`), whose cost per window grows with the square root of
+the number of values in the rows it covers rather than with the number of
+values in the window. Smaller windows and the spectra are filtered by scipy
+where they have no NaN values, the spectra being joined end to end so that
+scipy filters them all in a single pass, and the values of the few windows
+with NaN values are sorted. The windows with only NaN values are skipped.
+
+Several smoothings (e.g. of the flux and of its uncertainties, or with
+several kernel sizes) can be done in one pass with `smooth_batch`, which
+reads each block of the inputs once. The uncertainties are propagated
+through the convolutions (see `ErrorPlan`) rather than smoothed.
+"""
+import os
+import sys
+import logging
+import weakref
+import tempfile
+import threading
+import multiprocessing
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from scipy import ndimage
+from scipy.fftpack import next_fast_len
+from astropy import convolution
+
+from ..utils.arrays import as_float, is_all_valid
+
+__all__ = ['SmoothingSpec', 'Block', 'TemporaryArray', 'FFTPlan', 'SeparablePlan', 'SpectralPlan',
+           'MedianPlan', 'ErrorPlan', 'histogram_medians', 'default_workers', 'shutdown_workers', 'separable_factors', 'error_spec',
+           'select_method', 'plan_blocks', 'plan_batch', 'smooth_plane', 'smooth_block', 'smooth_array',
+           'smooth_batch']
+
+log = logging.getLogger('cubeviz_smoothing_engine')
+log.setLevel(logging.WARNING)
+
+# The smoothing runs in a thread of the GUI, and a process forked from a
+# process with several threads can be left with locks held by the other
+# threads, so the workers are not forked from this process. Where it is
+# available they are forked from a fork server, which imports this module
+# (and the application) once, rather than each worker importing them as new
+# interpreters do. ProcessPoolExecutor only takes the start method from
+# Python 3.7, before which the blocks are smoothed in this process.
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    WORKER_START_METHOD = 'forkserver'
+else:
+    WORKER_START_METHOD = 'spawn'
+PARALLEL_WORKERS = sys.version_info >= (3, 7)
+
+# Cubes smaller than this (in bytes, as float64) are smoothed in this
+# process, which takes less time than sending their blocks to the workers.
+PARALLEL_MIN_BYTES = 64 * 1024 ** 2
+
+# Number of blocks per worker, so that the workers stay busy until the end
+# and an abort does not have to wait for large blocks to finish.
+BLOCKS_PER_WORKER = 4
+
+# Number of kernel elements, by number of dimensions of the kernel, from
+# which convolutions are done by FFT rather than directly. The direct
+# convolution costs one operation per kernel element and pixel, the FFT a few
+# times the logarithm of the number of pixels (twice that with NaN values).
+FFT_MIN_KERNEL_SIZE = {1: 31, 2: 121}
+
+# Width above which separable kernels are also applied by FFT, which is
+# then faster than the two 1D convolutions.
+SEPARABLE_MAX_WIDTH = 49
+
+# Size of the slices (or spectra) convolved at once by FFT or as separable
+# kernels (in complex values, the size of the transforms)
+CHUNK_BYTES = 32 * 1024 ** 2
+
+# Width of the spatial median filters from which the windows are filtered
+# with histograms (see `histogram_medians`) rather than by scipy and by
+# sorting the windows with NaN values, whose costs grow with the number of
+# values in the window.
+MEDIAN_HISTOGRAM_MIN_SIZE = 13
+
+SmoothingSpec = namedtuple('SmoothingSpec', ['axis', 'method', 'kernel', 'size', 'separable', 'plan'])
+SmoothingSpec.__new__.__defaults__ = (False, None)
+SmoothingSpec.__doc__ = """
+What to smooth the cube with.
+
+:param axis: "spatial" or "spectral"
+:param method: "convolve", "fft", "separable", "spectral", "median" or "error"
+:param kernel: kernel array (2D for spatial, 1D for spectral) for the convolutions
+:param size: width of the median filter for "median"
+:param separable: whether the (2D) kernel is separable
+:param plan: FFTPlan for "fft", SeparablePlan for "separable", SpectralPlan for "spectral",
+             MedianPlan for "median", ErrorPlan for "error"
+"""
+
+Block = namedtuple('Block', ['source', 'target', 'trim'])
+Block.__doc__ = """
+A block of the cube.
+
+:param source: slices of the input read for the block, including the halo
+:param target: slices of the output written from the block
+:param trim: slices of the smoothed block (without the halo) that are written
+"""
+
+
+def default_workers():
+    """Number of worker processes used by default (one per core)."""
+    return os.cpu_count() or 1
+
+
+class TemporaryArray(object):
+    """
+    Array memory mapped to a temporary file, for the outputs smoothed out of
+    core.
+
+    :param shape: shape of the array
+    :param dtype: dtype of the array
+    :param directory: directory of the file, the default temporary directory if None
+    """
+
+    def __init__(self, shape, dtype=np.float64, directory=None):
+        fd, self._filename = tempfile.mkstemp(prefix='cubeviz_', suffix='.dat', dir=directory)
+        os.close(fd)
+        self._array = np.memmap(self._filename, mode='w+', shape=tuple(shape), dtype=np.dtype(dtype))
+
+    @property
+    def array(self):
+        return self._array
+
+    def close(self):
+        """Unmap the array and remove its file."""
+        self._array = None
+        _remove(self._filename)
+
+    def detach(self):
+        """
+        Return the array. Its file is removed right away where mapped files
+        can be removed (POSIX), else once the array is no longer used.
+
+        :return: numpy.memmap
+        """
+        array, self._array = self._array, None
+        array.flush()
+        try:
+            os.remove(self._filename)
+        except OSError:
+            weakref.finalize(array, _remove, self._filename)
+        return array
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+_pool_lock = threading.Lock()
+_pool = None  # (number of workers, ProcessPoolExecutor) shared by the smoothings
+
+
+def _get_pool(n_workers):
+    """
+    The pool of ``n_workers`` worker processes, started on first use and
+    kept for the next smoothings.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool[0] != n_workers:
+            _pool[1].shutdown(wait=False)
+            _pool = None
+        if _pool is None:
+            context = multiprocessing.get_context(WORKER_START_METHOD)
+            if WORKER_START_METHOD == 'forkserver':
+                context.set_forkserver_preload(['__main__', __name__])
+            _pool = (n_workers, ProcessPoolExecutor(max_workers=n_workers, mp_context=context))
+        return _pool[1]
+
+
+def shutdown_workers(wait=True):
+    """
+    Stop the worker processes, which are started again by the next smoothing
+    done in parallel.
+
+    :param wait: whether to wait for the blocks being smoothed
+    """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool[1].shutdown(wait=wait)
+
+
+def _tolerance(kernel):
+    # Below this sum of the (normalized) kernel over the values that are not
+    # NaN, the kernel only covers NaN values: half the smallest kernel
+    # element, well above the round-off of the convolutions.
+    nonzero = np.abs(kernel[kernel != 0])
+    return max(0.5 * nonzero.min(), 1e-12)
+
+
+def _interpolate_nan(values, convolve, tolerance):
+    """
+    Convolve ``values`` with ``convolve``, interpolating over the NaN values
+    as `astropy.convolution.convolve` does.
+    """
+    nan = np.isnan(values)
+    if not nan.any():
+        return convolve(values)
+
+    top = convolve(np.where(nan, 0, values))
+    bottom = 1 - convolve(nan.astype(np.float64))
+    empty = bottom < tolerance
+    bottom[empty] = 1
+    top /= bottom
+    top[empty] = np.nan
+    return top
+
+
+class FFTPlan(object):
+    """
+    Convolution by FFT with the same results as
+    `astropy.convolution.convolve` with ``normalize_kernel=True``, the
+    default ``boundary='fill'`` (with zeros) and ``nan_treatment='interpolate'``.
+
+    The transform of the kernel is computed once, for the shape of the
+    slices (or spectra) of the cube.
+
+    The NaN values are interpolated over by dividing the convolution of the
+    data (with the NaN values set to zero) by the sum of the kernel over the
+    values that are not NaN, which is the sum of the kernel (one) less the
+    convolution of the NaN values. The pixels outside of the slice count as
+    values of zero, as they do in astropy. Where the kernel only covers NaN
+    values the result is NaN.
+
+    :param kernel: kernel array
+    :param shape: shape of the smoothed axes, i.e. of a slice for a 2D
+                  kernel or the length of a spectrum for a 1D kernel
+    """
+
+    def __init__(self, kernel, shape):
+        kernel = np.asarray(kernel, dtype=np.float64)
+        kernel = kernel / kernel.sum()
+
+        self._shape = tuple(shape)
+        self._kernel_shape = kernel.shape
+        self._fft_shape = tuple(next_fast_len(n + k - 1) for n, k in zip(self._shape, kernel.shape))
+        self._kernel_fft = np.fft.rfftn(kernel, self._fft_shape, axes=tuple(range(kernel.ndim)))
+        self._tolerance = _tolerance(kernel)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    def _convolve(self, values, axes):
+        ndim = len(axes)
+        kernel_fft = self._kernel_fft.reshape(self._kernel_fft.shape +
+                                              (1,) * (values.ndim - ndim - axes[0]))
+        full = np.fft.irfftn(np.fft.rfftn(values, self._fft_shape, axes=axes) * kernel_fft,
+                             self._fft_shape, axes=axes)
+        same = [slice(None)] * values.ndim
+        for axis, n, k in zip(axes, self._shape, self._kernel_shape):
+            same[axis] = slice(k // 2, k // 2 + n)
+        return full[tuple(same)]
+
+    def apply(self, values, axes):
+        """
+        Convolve the slices (or spectra) of ``values`` with the kernel.
+
+        :param values: numpy.ndarray, with NaN values for the masked voxels
+        :param axes: the axes of ``values`` that are smoothed (the last
+                     ones, or the first one)
+        :return: numpy.ndarray
+        """
+        return _interpolate_nan(values, lambda array: self._convolve(array, axes), self._tolerance)
+
+
+class SeparablePlan(object):
+    """
+    Convolution by a separable 2D kernel as two 1D convolutions, along the
+    rows and then the columns, with the same results as
+    `astropy.convolution.convolve` (see `FFTPlan`).
+
+    :param rows: 1D kernel along the rows (i.e. the first axis of the 2D kernel)
+    :param columns: 1D kernel along the columns
+    """
+
+    shape = None
+
+    def __init__(self, rows, columns):
+        self._rows = np.asarray(rows, dtype=np.float64) / np.sum(rows)
+        self._columns = np.asarray(columns, dtype=np.float64) / np.sum(columns)
+        self._tolerance = _tolerance(np.outer(self._rows, self._columns))
+
+    def _convolve(self, values, axes):
+        values = ndimage.convolve1d(values, self._columns, axis=axes[1], mode='constant')
+        return ndimage.convolve1d(values, self._rows, axis=axes[0], mode='constant')
+
+    def apply(self, values, axes):
+        """
+        Convolve the slices of ``values`` with the kernel.
+
+        :param values: numpy.ndarray, with NaN values for the masked voxels
+        :param axes: the two axes of ``values`` that are smoothed
+        :return: numpy.ndarray
+        """
+        return _interpolate_nan(values, lambda array: self._convolve(array, axes), self._tolerance)
+
+
+class SpectralPlan(object):
+    """
+    Convolution of all the spectra of a block at once by a 1D kernel, with
+    the same results as `astropy.convolution.convolve` (see `FFTPlan`).
+
+    :param kernel: 1D kernel array
+    """
+
+    shape = None
+
+    def __init__(self, kernel):
+        self._kernel = np.asarray(kernel, dtype=np.float64) / np.sum(kernel)
+        self._tolerance = _tolerance(self._kernel)
+
+    def _convolve(self, values, axes):
+        return ndimage.convolve1d(values, self._kernel, axis=axes[0], mode='constant')
+
+    def apply(self, values, axes):
+        """
+        Convolve the spectra of ``values`` with the kernel.
+
+        :param values: numpy.ndarray, with NaN values for the masked voxels
+        :param axes: the spectral axis of ``values``, in a tuple
+        :return: numpy.ndarray
+        """
+        return _interpolate_nan(values, lambda array: self._convolve(array, axes), self._tolerance)
+
+
+def _median_1d(values, size, axis):
+    """
+    Median filter along ``axis`` with scipy's reflect mode, as a single 1D
+    filter of all the rows joined end to end, each padded by its reflection.
+    """
+    moved = np.moveaxis(values, axis, -1)
+    shape = moved.shape
+    rows = moved.reshape(-1, shape[-1])
+
+    before = size // 2
+    padded = np.pad(rows, ((0, 0), (before, size - 1 - before)), mode='symmetric')
+    filtered = ndimage.median_filter(padded.ravel(), size).reshape(padded.shape)
+
+    result = filtered[:, before:before + shape[-1]].reshape(shape)
+    return np.moveaxis(result, -1, axis)
+
+
+def histogram_medians(values, size, positions, rows=True):
+    """
+    Medians of the values that are not NaN in the windows at ``positions``,
+    with scipy's reflect mode (the upper median for an even number of values).
+
+    The windows of a row of ``values`` cover a band of ``size`` rows (or a
+    single row if not ``rows``), whose p values are sorted once. The ranks
+    of the values are counted in sqrt(p) bins by column, and summed along
+    the row, so that the number of values of each bin in a window is the
+    difference of two of these sums. The bin of the median is then split
+    into ranks by checking which of its sqrt(p) ranks are in the columns of
+    the window. Each window thus costs O(sqrt(p)), whatever its size.
+
+    :param values: numpy.ndarray, 3D, of rows of values along its last axis
+    :param size: width of the windows
+    :param positions: (index, row, column) arrays of the windows, the
+                      windows being centred on ``values[positions]``
+    :param rows: whether the windows are ``size`` rows high (2D windows of
+                 the last two axes), else a single row (1D windows)
+    :return: numpy.ndarray, the median of each window (NaN if it only has NaN values)
+    """
+    n, h, w = values.shape
+    height = size if rows else 1
+    before = size // 2
+    padding = (before, size - 1 - before)
+    padded = np.pad(values, ((0, 0), padding if rows else (0, 0), padding), mode='symmetric')
+    width = padded.shape[2]
+    n_values = height * width
+    bin_size = int(np.ceil(np.sqrt(n_values)))
+    n_bins = -(-n_values // bin_size)
+
+    # The windows by band of rows, as many bands at a time as fit in CHUNK_BYTES
+    band = positions[0] * h + positions[1]
+    order = np.argsort(band, kind='mergesort')
+    bands, starts = np.unique(band[order], return_index=True)
+    starts = np.append(starts, len(order))
+    band_bytes = 8 * (4 * n_values + 3 * (width + 1) * n_bins)
+    step = max(CHUNK_BYTES // band_bytes, 1)
+
+    medians = np.empty(len(order))
+    offsets = np.arange(height)
+    for first in range(0, len(bands), step):
+        chunk = bands[first:first + step]
+        n_bands = len(chunk)
+        windows = order[starts[first]:starts[first + n_bands]]
+        local = np.repeat(np.arange(n_bands), np.diff(starts[first:first + n_bands + 1]))
+        columns = positions[2][windows]
+
+        values_of_bands = padded[(chunk // h)[:, None], (chunk % h)[:, None] + offsets].reshape(n_bands, -1)
+        sorted_ranks = np.argsort(values_of_bands, axis=1)  # NaN values last
+        sorted_values = np.take_along_axis(values_of_bands, sorted_ranks, axis=1)
+
+        # The column of the value of each rank (-1 past the last rank)
+        rank_columns = np.full((n_bands, n_bins * bin_size), -1, dtype=np.intp)
+        rank_columns[:, :n_values] = sorted_ranks % width
+
+        # Sums of the values of each bin, and of those that are not NaN, along the row
+        bins = np.empty((n_bands, n_values), dtype=np.intp)
+        bins[np.arange(n_bands)[:, None], sorted_ranks] = np.arange(n_values) // bin_size
+        index = (np.arange(n_bands)[:, None] * width + np.arange(n_values) % width) * n_bins + bins
+        counts = np.bincount(index.ravel(), minlength=n_bands * width * n_bins)
+        cumulative = np.zeros((n_bands, width + 1, n_bins), dtype=np.int32)
+        np.cumsum(counts.reshape(n_bands, width, n_bins), axis=1, out=cumulative[:, 1:])
+        valid = np.zeros((n_bands, width + 1), dtype=np.int32)
+        np.cumsum(np.sum(~np.isnan(values_of_bands).reshape(n_bands, height, width), axis=1),
+                  axis=1, out=valid[:, 1:])
+
+        # The bin of the median of each window, and its rank in the bin
+        count = valid[local, columns + size] - valid[local, columns]
+        target = count // 2
+        below = np.cumsum(cumulative[local, columns + size] - cumulative[local, columns], axis=1)
+        median_bin = np.minimum(np.sum(below <= target[:, None], axis=1), n_bins - 1)
+        target -= np.where(median_bin > 0, below[np.arange(len(windows)), median_bin - 1], 0)
+
+        ranks = median_bin[:, None] * bin_size + np.arange(bin_size)
+        inside = rank_columns[local[:, None], ranks] - columns[:, None]
+        inside = (inside >= 0) & (inside < size)
+        rank = median_bin * bin_size + np.sum(np.cumsum(inside, axis=1) <= target[:, None], axis=1)
+
+        result = sorted_values[local, np.minimum(rank, n_values - 1)]
+        result[count == 0] = np.nan
+        medians[windows] = result
+
+    return medians
+
+
+class MedianPlan(object):
+    """
+    Median filter of the slices (or spectra) of a block, ignoring the NaN
+    values. Without NaN values the results are those of
+    `scipy.ndimage.median_filter` (with its default ``mode='reflect'``),
+    i.e. the upper median for windows of an even number of values.
+
+    From a width of MEDIAN_HISTOGRAM_MIN_SIZE, the slices are filtered with
+    `histogram_medians`. Otherwise, and for the spectra, the windows without
+    NaN values are filtered by scipy over the part of the block that they
+    cover, and the values of the other windows (which have at most
+    MEDIAN_HISTOGRAM_MIN_SIZE**2 values in a slice) are sorted. The windows
+    that only have NaN values are NaN.
+
+    :param size: width of the window
+    """
+
+    shape = None
+
+    def __init__(self, size):
+        self._size = int(size)
+
+    def _median(self, values, rows):
+        if not rows:
+            return _median_1d(values, self._size, -1)
+        # scipy is faster slice by slice than with a (1, size, size) window
+        result = np.empty(values.shape)
+        for ii in range(values.shape[0]):
+            result[ii] = ndimage.median_filter(values[ii], self._size)
+        return result
+
+    def _sorted_medians(self, values, positions, rows):
+        """
+        Medians of the values that are not NaN in the windows at
+        ``positions``, sorting the values of each window.
+        """
+        size = self._size
+        before = size // 2
+        padding = (before, size - 1 - before)
+        padded = np.pad(values, ((0, 0), padding if rows else (0, 0), padding), mode='symmetric')
+
+        medians = np.empty(len(positions[0]))
+        step = max(CHUNK_BYTES // (8 * size ** (2 if rows else 1)), 1)
+        for start in range(0, len(medians), step):
+            index, row, column = (p[start:start + step] for p in positions)
+            # The values of the windows, one column per window element
+            if rows:
+                offsets = np.indices((size, size)).reshape(2, -1)
+                windows = padded[index[:, None], row[:, None] + offsets[0], column[:, None] + offsets[1]]
+            else:
+                windows = padded[index[:, None], row[:, None], column[:, None] + np.arange(size)]
+            windows.sort(axis=1)
+            counts = np.sum(~np.isnan(windows), axis=1)
+            result = windows[np.arange(len(windows)), counts // 2]
+            result[counts == 0] = np.nan
+            medians[start:start + step] = result
+        return medians
+
+    def _median_box(self, values, windows, rows):
+        """
+        Filter by scipy the bounding box of ``windows``, read with a margin
+        of the half-width of the window.
+
+        :return: (box, filtered values of the box)
+        """
+        before, after = self._size // 2, self._size - 1 - self._size // 2
+        box, margin, trim = [slice(None)], [slice(None)], [slice(None)]
+        for axis in (1, 2) if rows else (2,):
+            used = np.nonzero(np.any(windows, axis=tuple(a for a in range(3) if a != axis)))[0]
+            start, stop = used[0], used[-1] + 1
+            read_start, read_stop = max(start - before, 0), min(stop + after, values.shape[axis])
+            box.append(slice(start, stop))
+            margin.append(slice(read_start, read_stop))
+            trim.append(slice(start - read_start, stop - read_start))
+        if not rows:
+            box.insert(1, slice(None))
+            margin.insert(1, slice(None))
+            trim.insert(1, slice(None))
+        return tuple(box), self._median(values[tuple(margin)], rows)[tuple(trim)]
+
+    def apply(self, values, axes):
+        """
+        Median filter the slices (or spectra) of ``values``.
+
+        :param values: numpy.ndarray, with NaN values for the masked voxels
+        :param axes: the axes of ``values`` that are smoothed
+        :return: numpy.ndarray
+        """
+        # The rows of values along the last axis, with 2D windows of the
+        # last two axes or 1D windows of the last one
+        rows = len(axes) == 2
+        moved = np.moveaxis(values, axes, range(-len(axes), 0))
+        shape = moved.shape
+        moved = moved.reshape((-1,) + (shape[-2:] if rows else (1, shape[-1])))
+
+        nan = np.isnan(moved)
+        size = self._size
+        histogram = rows and size >= MEDIAN_HISTOGRAM_MIN_SIZE
+        if not nan.any() and not histogram:
+            result = self._median(moved, rows)
+        else:
+            # Number of NaN values in each window
+            n_nan = nan.astype(np.float64)
+            for axis in (1, 2) if rows else (2,):
+                n_nan = ndimage.uniform_filter1d(n_nan, size, axis=axis, mode='reflect')
+            n_nan = np.rint(n_nan * size ** len(axes))
+
+            result = np.full(moved.shape, np.nan)
+            windows = n_nan < size ** len(axes)  # The windows with values that are not NaN
+            full = n_nan == 0
+            if not histogram and full.any():
+                # The windows without NaN values do not depend on what replaces them
+                box, filtered = self._median_box(np.where(nan, 0, moved), full, rows)
+                full = full[box]
+                result[box][full] = filtered[full]
+                windows[box] &= ~full
+
+            positions = np.nonzero(windows)
+            if histogram:
+                result[positions] = histogram_medians(moved, size, positions)
+            else:
+                result[positions] = self._sorted_medians(moved, positions, rows)
+
+        return np.moveaxis(result.reshape(shape), range(-len(axes), 0), axes)
+
+
+def _convolve(spec, values, axes):
+    """
+    Convolve ``values`` with a convolution SmoothingSpec planned by
+    `select_method`, whatever the shape of ``values``.
+    """
+    plan = spec.plan
+    if plan is not None and plan.shape not in (None, tuple(values.shape[axis] for axis in axes)):
+        # A band of rows of the slices, planned for the whole slices
+        spec = select_method(spec._replace(method='convolve', plan=None), values.shape)
+        plan = spec.plan
+    if plan is not None:
+        return plan.apply(values, axes)
+
+    # Small 2D kernels that are not separable
+    if values.ndim == 2:
+        return convolution.convolve(values, spec.kernel, normalize_kernel=True)
+    result = np.empty(values.shape)
+    for ii in range(values.shape[0]):
+        result[ii] = convolution.convolve(values[ii], spec.kernel, normalize_kernel=True)
+    return result
+
+
+class ErrorPlan(object):
+    """
+    Propagation of uncertainties (standard deviations) through a
+    convolution. A smoothed value is the sum of the values w_i x_i, the
+    weights w_i being the kernel normalized over the values that are not NaN
+    (and those outside the cube, which are zeros), so its uncertainty is the
+    square root of the sum of the w_i**2 sigma_i**2, for independent values.
+
+    :param spec: SmoothingSpec of the convolution
+    :param shape: shape of the cube (or slice) smoothed
+    """
+
+    shape = None
+
+    def __init__(self, spec, shape):
+        kernel = np.asarray(spec.kernel, dtype=np.float64)
+        kernel = kernel / kernel.sum()
+        squared = kernel ** 2
+        self._scale = squared.sum()
+        self._tolerance = _tolerance(kernel)
+
+        spec = spec._replace(method='convolve', plan=None)
+        self._kernel = select_method(spec._replace(kernel=kernel), shape)
+        self._squared = select_method(spec._replace(kernel=squared / self._scale), shape)
+
+    def apply(self, values, axes):
+        """
+        Propagate the uncertainties of the slices (or spectra) of ``values``.
+
+        :param values: numpy.ndarray, with NaN values for the masked voxels
+        :param axes: the axes of ``values`` that are smoothed
+        :return: numpy.ndarray
+        """
+        # The sum of the w_i**2 sigma_i**2 with the squared kernel normalized
+        # over the values that are not NaN, as the convolutions do
+        variance = _convolve(self._squared, values ** 2, axes)
+
+        nan = np.isnan(values)
+        if nan.any():
+            # Normalize it over the values that are not NaN with the kernel
+            # rather than with the squared kernel
+            invalid = nan.astype(np.float64)
+            weight = 1 - _convolve(self._kernel, invalid, axes)
+            squared_weight = 1 - _convolve(self._squared, invalid, axes)
+            empty = weight < self._tolerance
+            weight[empty] = 1
+            variance *= squared_weight / weight ** 2
+            variance[empty] = np.nan
+
+        return np.sqrt(np.maximum(variance * self._scale, 0))
+
+
+def separable_factors(kernel, rtol=1e-10):
+    """
+    The 1D kernels whose outer product is a 2D kernel.
+
+    :param kernel: 2D kernel array
+    :param rtol: tolerance, relative to the largest kernel element
+    :return: (rows, columns) 1D kernel arrays, or None if the kernel is not separable
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    kernel = kernel / kernel.sum()
+    rows, columns = kernel.sum(axis=1), kernel.sum(axis=0)
+    if np.abs(np.outer(rows, columns) - kernel).max() > rtol * np.abs(kernel).max():
+        return None
+    return rows, columns
+
+
+def error_spec(spec):
+    """
+    SmoothingSpec propagating the uncertainties of the values smoothed with
+    a convolution SmoothingSpec (see `ErrorPlan`).
+
+    :param spec: SmoothingSpec
+    :return: SmoothingSpec
+    :raises: ValueError for median filters
+    """
+    if spec.method == 'median':
+        raise ValueError("Uncertainties can only be propagated through convolution kernels, "
+                         "not median filters.")
+    if spec.method == 'error':
+        return spec
+    return spec._replace(method='error', plan=None)
+
+
+def select_method(spec, shape):
+    """
+    Choose how to apply a convolution kernel: as two 1D convolutions for
+    separable kernels (up to SEPARABLE_MAX_WIDTH), to all the spectra at
+    once for small spectral kernels, directly for other small kernels and by
+    FFT for the others.
+
+    :param spec: SmoothingSpec
+    :param shape: shape of the cube (or slice) smoothed
+    :return: SmoothingSpec, with the method "fft", "separable" or
+             "spectral" and its plan if one of them is used
+    """
+    if spec.method == 'median':
+        return spec._replace(plan=MedianPlan(spec.size))
+    if spec.method == 'error' and spec.plan is None:
+        return spec._replace(plan=ErrorPlan(spec, shape))
+    if spec.method != 'convolve':
+        return spec
+
+    kernel = np.asarray(spec.kernel)
+    if spec.separable and kernel.ndim == 2 and max(kernel.shape) <= SEPARABLE_MAX_WIDTH:
+        factors = separable_factors(kernel)
+        if factors is not None:
+            log.debug('Convolving with a separable kernel of shape {}'.format(kernel.shape))
+            return spec._replace(method='separable', plan=SeparablePlan(*factors))
+
+    if kernel.size < FFT_MIN_KERNEL_SIZE[kernel.ndim]:
+        if kernel.ndim == 1:
+            return spec._replace(method='spectral', plan=SpectralPlan(kernel))
+        return spec
+
+    # The smoothed axes: the last two of a cube or slice for a 2D kernel, the
+    # first of a cube or spectrum for a 1D kernel
+    if kernel.ndim == 2:
+        plan_shape = tuple(shape)[-2:]
+    else:
+        plan_shape = tuple(shape)[:1]
+
+    log.debug('Convolving by FFT with a kernel of shape {}'.format(kernel.shape))
+    return spec._replace(method='fft', plan=FFTPlan(kernel, plan_shape))
+
+
+def _split(length, n_blocks):
+    n_blocks = max(min(n_blocks, length), 1)
+    edges = np.linspace(0, length, n_blocks + 1).round().astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _halo(spec):
+    if spec.method == 'median':
+        return spec.size // 2
+    return np.shape(spec.kernel)[0] // 2
+
+
+def plan_blocks(shape, spec, n_blocks):
+    """
+    Split a cube into (about) ``n_blocks`` blocks that can be smoothed
+    independently.
+
+    :param shape: shape of the cube (spectral axis first)
+    :param spec: SmoothingSpec
+    :param n_blocks: number of blocks wanted
+    :return: list of Block
+    """
+    full = slice(None)
+
+    if spec.axis == 'spectral':
+        # Each spectrum is independent: blocks of rows of spaxels
+        return [Block(source=(full, slice(a, b), full), target=(full, slice(a, b), full),
+                      trim=(full, full, full))
+                for a, b in _split(shape[1], n_blocks)]
+
+    if shape[0] >= n_blocks or shape[1] < 2:
+        # Each slice is independent: blocks of slices
+        return [Block(source=(slice(a, b), full, full), target=(slice(a, b), full, full),
+                      trim=(full, full, full))
+                for a, b in _split(shape[0], n_blocks)]
+
+    # Few slices: split the slices into bands of rows, each read with a halo
+    # of the kernel half-height so that the band edges are smoothed as in the
+    # whole slice.
+    halo = _halo(spec)
+    blocks = []
+    n_bands = max(n_blocks // max(shape[0], 1), 1)
+    for z0, z1 in _split(shape[0], shape[0]):
+        for a, b in _split(shape[1], n_bands):
+            start, stop = max(a - halo, 0), min(b + halo, shape[1])
+            blocks.append(Block(source=(slice(z0, z1), slice(start, stop), full),
+                                target=(slice(z0, z1), slice(a, b), full),
+                                trim=(full, slice(a - start, b - start), full)))
+    return blocks
+
+
+def plan_batch(shape, specs, n_blocks):
+    """
+    Split a cube into blocks for several smoothings: the spatial and the
+    spectral smoothings are done in two groups, each with its own blocks
+    (with the halo of the widest kernel of the group, if any).
+
+    :param shape: shape of the cube (spectral axis first)
+    :param specs: list of SmoothingSpec
+    :param n_blocks: number of blocks wanted for each group
+    :return: list of (indices of the specs of the group, list of Block)
+    """
+    groups = []
+    for axis in ('spatial', 'spectral'):
+        indices = [ii for ii, spec in enumerate(specs) if spec.axis == axis]
+        if indices:
+            widest = max((specs[ii] for ii in indices), key=_halo)
+            groups.append((indices, plan_blocks(shape, widest, n_blocks)))
+    return groups
+
+
+def smooth_plane(plane, spec):
+    """
+    Smooth a single slice with a spatial SmoothingSpec.
+
+    :param plane: numpy.ndarray, 2D, with the masked pixels set to NaN
+    :param spec: SmoothingSpec
+    :return: numpy.ndarray
+    """
+    if spec.plan is None:
+        spec = select_method(spec, plane.shape)
+    if spec.plan is not None and spec.plan.shape in (None, plane.shape):
+        return spec.plan.apply(plane, axes=(0, 1))
+    return convolution.convolve(plane, spec.kernel, normalize_kernel=True)
+
+
+def smooth_block(block, spec, out=None):
+    """
+    Smooth a block of a cube.
+
+    :param block: numpy.ndarray, 3D, with the masked voxels set to NaN
+    :param spec: SmoothingSpec
+    :param out: array to write the result to, else a new array is returned
+    :return: numpy.ndarray
+    """
+    if out is None:
+        out = np.empty(block.shape, dtype=np.float64)
+
+    if spec.method == 'fft' and spec.axis == 'spatial' and spec.plan.shape != block.shape[1:]:
+        # A band of rows of the slices, planned for the whole slices
+        spec = spec._replace(method='convolve', plan=None)
+    if spec.plan is None:
+        spec = select_method(spec, block.shape)
+
+    if spec.plan is not None:
+        _planned_block(block, spec, out)
+    else:
+        # Small 2D kernels that are not separable
+        for ii in range(block.shape[0]):
+            out[ii] = convolution.convolve(block[ii], spec.kernel, normalize_kernel=True)
+
+    return out
+
+
+def _planned_block(block, spec, out):
+    """
+    Smooth a block with the plan of ``spec``, as many slices (spatial) or
+    rows of spaxels (spectral) at a time as fit in CHUNK_BYTES.
+    """
+    plan = spec.plan
+    if spec.axis == 'spatial':
+        axes, batch_axis = (1, 2), 0
+    else:
+        axes, batch_axis = (0,), 1
+
+    item_bytes = 16 * int(np.prod([n for ii, n in enumerate(block.shape) if ii != batch_axis]))
+    step = max(CHUNK_BYTES // max(item_bytes, 1), 1)
+
+    index = [slice(None)] * block.ndim
+    for start in range(0, block.shape[batch_axis], step):
+        index[batch_axis] = slice(start, start + step)
+        out[tuple(index)] = plan.apply(block[tuple(index)], axes)
+
+    if spec.axis == 'spectral':
+        # The spectra without any valid value are left as they are
+        empty = np.all(np.isnan(block), axis=0)
+        out[:, empty] = block[:, empty]
+
+
+def _read_block(data, mask, source):
+    # The blocks are only read by the smoothing, so the values are copied
+    # only to set the masked voxels to NaN.
+    if is_all_valid(mask):
+        return np.asarray(as_float(data[source]), dtype=np.float64)
+    values = np.array(as_float(data[source]), dtype=np.float64)
+    values[~np.asarray(mask[source], dtype=bool)] = np.nan
+    return values
+
+
+def _smooth_into(values, spec, block, out):
+    if block.source == block.target:
+        smooth_block(values, spec, out=out[block.target])
+    else:
+        out[block.target] = smooth_block(values, spec)[block.trim]
+
+
+def _smooth_task(tasks, values, block):
+    """
+    Worker process task: smooth one block of the inputs with each of the
+    SmoothingSpec of ``tasks``.
+
+    :param tasks: list of (index of the input, SmoothingSpec)
+    :param values: dict of the block of each input, with NaN values for the masked voxels
+    :param block: Block
+    :return: list of numpy.ndarray, the part of each smoothed block written to ``block.target``
+    """
+    return [smooth_block(values[source], spec)[block.trim] for source, spec in tasks]
+
+
+def smooth_array(data, spec, mask=None, n_workers=None, update_function=None, blocks=None,
+                 out=None, memmap=False, directory=None):
+    """
+    Smooth a cube, a block at a time, in ``n_workers`` processes.
+
+    ``update_function`` is called after each block and may raise an
+    exception (e.g. `~cubeviz.tools.smoothing.AbortException`) to stop the
+    smoothing; the blocks that have not started are then cancelled and the
+    exception is raised again.
+
+    The blocks are written into ``out`` if it is given. Otherwise they are
+    written into a new array, held in memory or, if ``memmap`` is True,
+    memory mapped to a temporary file (removed once the array is no longer
+    used).
+
+    :param data: array-like, 3D (spectral axis first)
+    :param spec: SmoothingSpec
+    :param mask: boolean array-like, True for the valid voxels, or None (e.g.
+                 a `~cubeviz.utils.arrays.SubsetMask`, read a block at a time)
+    :param n_workers: number of processes, `default_workers` if None. With a
+                      single worker, for cubes smaller than
+                      `PARALLEL_MIN_BYTES` (or before Python 3.7, see
+                      `PARALLEL_WORKERS`) the blocks are smoothed in this process.
+    :param update_function: function called after each block, or None
+    :param blocks: list of Block, from `plan_blocks` if None
+    :param out: array of the shape of ``data`` to write to, or None
+    :param memmap: whether a new output array is memory mapped
+    :param directory: directory of the memory mapped files, the default
+                      temporary directory if None
+    :return: numpy.ndarray (float64), ``out`` if it is given
+    """
+    groups = None if blocks is None else [([0], blocks)]
+    outs = None if out is None else [out]
+    return smooth_batch([data], [(0, spec)], mask=mask, n_workers=n_workers,
+                        update_function=update_function, groups=groups, outs=outs,
+                        memmap=memmap, directory=directory)[0]
+
+
+def smooth_batch(arrays, jobs, mask=None, n_workers=None, update_function=None, groups=None,
+                 outs=None, memmap=False, directory=None):
+    """
+    Do several smoothings of one or more cubes of the same shape in one
+    pass: each block of each cube is read once, and smoothed with all the
+    SmoothingSpec of the jobs on that cube. See `smooth_array` for the
+    progress, abort and output handling.
+
+    :param arrays: list of array-like, 3D (spectral axis first)
+    :param jobs: list of (index in ``arrays``, SmoothingSpec), e.g. with an
+                 `error_spec` for the uncertainties of a cube
+    :param mask: boolean array-like, True for the valid voxels of all the cubes, or None
+    :param n_workers: number of processes, `default_workers` if None
+    :param update_function: function called after each block, or None
+    :param groups: blocks for the jobs, from `plan_batch` if None
+    :param outs: list of arrays (or None) to write the output of each job to, or None
+    :param memmap: whether the new output arrays are memory mapped
+    :param directory: directory of the memory mapped files, the default
+                      temporary directory if None
+    :return: list of numpy.ndarray (float64), one per job
+    """
+    shape = tuple(arrays[0].shape)
+    for data in arrays:
+        if tuple(data.shape) != shape:
+            raise ValueError("The cubes have different shapes: {} and {}".format(data.shape, shape))
+    specs = [select_method(spec, shape) for _, spec in jobs]
+
+    if n_workers is None:
+        n_workers = default_workers()
+    if groups is None:
+        groups = plan_batch(shape, specs, n_workers * BLOCKS_PER_WORKER)
+    parallel = (PARALLEL_WORKERS and n_workers > 1 and sum(len(blocks) for _, blocks in groups) > 1 and
+                8 * int(np.prod(shape)) >= PARALLEL_MIN_BYTES)
+
+    outs = list(outs) if outs is not None else [None] * len(jobs)
+    targets = [None] * len(jobs)
+    for ii, out in enumerate(outs):
+        if out is not None and tuple(out.shape) != shape:
+            raise ValueError("The output has the shape {}, not {}".format(out.shape, shape))
+        if out is None and memmap:
+            targets[ii] = TemporaryArray(shape, directory=directory)
+            outs[ii] = targets[ii].array
+        elif out is None:
+            outs[ii] = np.empty(shape, dtype=np.float64)
+
+    try:
+        if parallel:
+            _smooth_parallel(arrays, jobs, specs, mask, n_workers, update_function, groups, outs)
+        else:
+            for indices, blocks in groups:
+                for block in blocks:
+                    values = {}
+                    for ii in indices:
+                        source = jobs[ii][0]
+                        if source not in values:
+                            values[source] = _read_block(arrays[source], mask, block.source)
+                        _smooth_into(values[source], specs[ii], block, outs[ii])
+                    if update_function is not None:
+                        update_function()
+    except BaseException:
+        for target in targets:
+            if target is not None:
+                target.close()
+        raise
+
+    return [out if target is None else target.detach() for out, target in zip(outs, targets)]
+
+
+def _smooth_parallel(arrays, jobs, specs, mask, n_workers, update_function, groups, outs):
+    # The blocks are read here and sent to the workers, which send back the
+    # smoothed blocks. Only one block more than there are workers is in
+    # flight at a time, so that little more than the inputs and the outputs
+    # is held in memory.
+    executor = _get_pool(n_workers)
+    queue = deque((indices, block) for indices, blocks in groups for block in blocks)
+    log.debug('Smoothing {} blocks in {} processes'.format(len(queue), n_workers))
+
+    pending = {}
+    try:
+        while queue or pending:
+            while queue and len(pending) <= n_workers:
+                indices, block = queue.popleft()
+                values = {}
+                for ii in indices:
+                    source = jobs[ii][0]
+                    if source not in values:
+                        values[source] = _read_block(arrays[source], mask, block.source)
+                tasks = [(jobs[ii][0], specs[ii]) for ii in indices]
+                pending[executor.submit(_smooth_task, tasks, values, block)] = (indices, block)
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                indices, block = pending.pop(future)
+                for ii, result in zip(indices, future.result()):
+                    outs[ii][block.target] = result
+                if update_function is not None:
+                    update_function()
+    except BrokenProcessPool:
+        # A worker died: start new ones for the next smoothing
+        shutdown_workers(wait=False)
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
@@ -6,6 +6,7 @@ import numpy as np
 
 from qtpy import QtCore
 from glue.core import roi
+from glue.core.subset import RangeSubsetState
 from cubeviz.tools.collapse_cube import CollapseCube
 
 from ...tests.helpers import (toggle_viewer, select_viewer, left_click,
@@ -158,7 +159,8 @@ def test_regions(qtbot, cubeviz_layout):
     # Calculate what we expect
     np_data = cubeviz_layout._data[DATA_LABELS[0]]
     mask = cubeviz_layout._data.subsets[0].to_mask()
-    np_data_sum = np.sum(np_data[start_index:end_index]*mask[start_index:end_index], axis=0)
+    # The spaxels outside of the region are excluded (NaN)
+    np_data_sum = np.where(mask[start_index], np.sum(np_data[start_index:end_index], axis=0), np.nan)
 
     # Get the result
     collapse_component_id = [str(x) for x in cubeviz_layout._data.container_2d.component_ids() if str(x).startswith('018.DATA-collap')][0]
@@ -172,4 +174,38 @@ def test_regions(qtbot, cubeviz_layout):
     print('combo box selected {}'.format(cc.ui.operation_combobox.currentText()))
     print('np_data_sum {}'.format(np_data_sum))
     print('np_result {}'.format(np_result))
-    assert np.allclose(np_data_sum, np_result, atol=1.0)
+    assert np.allclose(np_data_sum, np_result, atol=1.0, equal_nan=True)
+
+
+def test_spectral_range_subset(qtbot, cubeviz_layout):
+    # A subset of a spectral range selects voxels: only its values in the
+    # range collapsed are summed, the spectra without any are NaN
+    data = cubeviz_layout._data
+    dc = cubeviz_layout.session.application.data_collection
+    dc.new_subset_group(subset_state=RangeSubsetState(899.5, 1000.5, data.pixel_component_ids[0]),
+                        label='spectral range')
+
+    cc = create_collapsed_cube(cubeviz_layout)
+
+    start_index = 700
+    end_index = 1300
+
+    cc.ui.data_combobox.setCurrentIndex(0)
+    cc.ui.operation_combobox.setCurrentIndex(0)
+    cc.ui.spatial_region_combobox.setCurrentIndex(cc.ui.spatial_region_combobox.findText('spectral range'))
+    cc.ui.region_combobox.setCurrentIndex(1) # indices
+    cc.ui.start_input.setText('{}'.format(start_index))
+    cc.ui.end_input.setText('{}'.format(end_index))
+    cc.ui.sigma_combobox.setCurrentIndex(0)
+    qtbot.mouseClick(cc.ui.calculate_button, QtCore.Qt.LeftButton)
+
+    np_data = np.asarray(data[DATA_LABELS[0]])
+    expected = np.sum(np_data[900:1001], axis=0)
+
+    collapse_component_id = [str(x) for x in data.container_2d.component_ids()
+                             if str(x).startswith('018.DATA-collapse-Sum')][-1]
+    np_result = data.container_2d[collapse_component_id]
+
+    dc.remove_subset_group(dc.subset_groups[-1])
+
+    assert np.allclose(np_result, expected, atol=1.0, equal_nan=True)
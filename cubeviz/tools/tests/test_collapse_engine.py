@@ -0,0 +1,231 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import warnings
+
+import pytest
+import numpy as np
+from astropy.wcs import WCS
+
+from cubeviz.tools.collapse_cube import operations, collapse_cube
+from cubeviz.tools.collapse_engine import (collapse_array, nanmedian, plan_tiles, PrefixSumIndex,
+                                           PrefixSumCache, sigma_clip_spectra, bounding_box,
+                                           prefix_sum_max_bytes, PREFIX_SUM_MIN_BYTES)
+
+
+@pytest.fixture
+def cube():
+    rng = np.random.RandomState(0)
+    data = rng.randn(40, 13, 11)
+    data[rng.rand(*data.shape) < 0.1] = np.nan
+    data[:, 2, 3] = np.nan
+    return data
+
+
+@pytest.mark.parametrize("operation", list(operations))
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_operations(cube, operation, n_workers):
+    # Small tiles, so that the cube is split into parts of rows
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = operations[operation](cube[5:30], axis=0)
+        result = collapse_array(cube, operations[operation], 5, 30, n_workers=n_workers,
+                                tile_bytes=8 * 25 * 4)
+    np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
+
+
+def test_nanmedian():
+    rng = np.random.RandomState(1)
+    data = rng.randn(700, 4, 5)
+    data[rng.rand(*data.shape) < 0.3] = np.nan
+    data[:, 0, 0] = np.nan
+    data[:-1, 1, 1] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        np.testing.assert_array_equal(nanmedian(data), np.nanmedian(data, axis=0))
+
+    # Masked values are ignored
+    masked = np.ma.masked_greater(np.arange(24.).reshape(6, 2, 2), 15)
+    np.testing.assert_array_equal(nanmedian(masked), np.ma.median(masked, axis=0))
+
+
+def test_plan_tiles():
+    # Bands of rows, aligned on the chunks of the cube, or parts of rows
+    tiles = plan_tiles((10, 30, 20), tile_bytes=8 * 10 * 20 * 7, chunks=(1, 3, 20))
+    assert [t[0] for t in tiles] == [slice(y, min(y + 6, 30)) for y in range(0, 30, 6)]
+    tiles = plan_tiles((10, 2, 20), tile_bytes=8 * 10 * 8)
+    assert len(tiles) == 2 * 3 and tiles[1] == (slice(0, 1), slice(8, 16))
+
+
+@pytest.mark.parametrize("start_index, end_index", [(5, None), (0, -10), (-20, 35)])
+def test_collapse_cube_range(cube, start_index, end_index):
+    # The open and negative ends of the range are those of a slice
+    wcs = WCS(naxis=3)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN', 'WAVE']
+    wcs.wcs.cunit = ['deg', 'deg', 'um']
+    wcs.wcs.cdelt = [1e-4, 1e-4, 1e-3]
+    wcs.wcs.crval = [1., 1., 1.]
+    wcs.wcs.crpix = [1., 1., 1.]
+
+    wavelengths, result = collapse_cube(cube, 'cube', wcs, 'Sum', start_index, end_index, n_workers=1)
+    expected = np.sum(cube[start_index:end_index], axis=0)
+    assert len(wavelengths) == len(cube[start_index:end_index])
+    np.testing.assert_allclose(wavelengths.to_value('um'), 1. + 1e-3 * np.arange(40)[start_index:end_index])
+    np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
+
+@pytest.mark.parametrize("function", PrefixSumIndex.functions)
+def test_prefix_sums(cube, function):
+    index = PrefixSumIndex(cube, tile_bytes=8 * 41 * 11 * 3)
+    assert not index.is_built
+    for start, end in [(0, 40), (5, 30), (12, 13), (39, None)]:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected = function(cube[start:end], axis=0)
+        np.testing.assert_allclose(index.collapse(function, start, end), expected,
+                                   rtol=1e-10, atol=1e-12, equal_nan=True)
+    assert index.is_built
+
+    assert index.collapse(np.median, 0, 10) is None
+    cube[3, 4, 5] = np.inf
+    assert PrefixSumIndex(cube).collapse(function, 0, 10) is None
+
+
+def test_prefix_sum_cache(cube):
+    size = PrefixSumIndex.index_bytes(cube.shape)
+    cache = PrefixSumCache(max_bytes=2 * size, min_uses=1)
+    index = cache.get(cube)
+    assert cache.get(cube) is index
+    cache.invalidate(cube)
+    assert cache.get(cube) is not index
+
+    # The least recently used indexes are dropped, and those of deleted arrays
+    first, second = cube.copy(), cube.copy()
+    first_index = cache.get(first)
+    cache.get(cube)
+    cache.get(second)
+    assert len(cache) == 2
+    assert cache.get(first) is not first_index
+    del second
+    assert len(cache) == 1
+    assert cache.get(np.zeros((100, 13, 11))) is None
+    assert cache.nbytes <= 2 * size
+
+    # The index can be created when the array is asked for again, and is
+    # built when first used
+    cache = PrefixSumCache(max_bytes=2 * size, min_uses=2)
+    assert cache.get(cube) is None
+    assert len(cache) == 0
+    index = cache.get(cube)
+    assert index is not None and not index.is_built
+    assert cache.get(cube) is index
+
+    # Lowering the memory drops the indexes that no longer fit
+    cache.max_bytes = size - 1
+    assert len(cache) == 0 and cache.get(cube) is None
+
+
+def test_prefix_sum_max_bytes(monkeypatch):
+    monkeypatch.setenv('CUBEVIZ_PREFIX_SUM_MEMORY', '10')
+    assert prefix_sum_max_bytes() == 10 * 1024 ** 2
+    assert PrefixSumCache().max_bytes == 10 * 1024 ** 2
+    monkeypatch.setenv('CUBEVIZ_PREFIX_SUM_MEMORY', 'many')
+    assert prefix_sum_max_bytes() >= PREFIX_SUM_MIN_BYTES
+    monkeypatch.delenv('CUBEVIZ_PREFIX_SUM_MEMORY')
+    assert prefix_sum_max_bytes() >= PREFIX_SUM_MIN_BYTES
+
+
+def clip_spectrum(values, sigma_lower, sigma_upper, iters):
+    values = values.copy()
+    iteration = 0
+    while iters is None or iteration < iters:
+        center, deviation = np.nanmedian(values), np.nanstd(values)
+        clipped = (values < center - deviation * sigma_lower) | (values > center + deviation * sigma_upper)
+        if not clipped.any():
+            break
+        values[clipped] = np.nan
+        iteration += 1
+    return values
+
+
+@pytest.mark.parametrize(("sigma_lower", "sigma_upper", "iters"),
+                         [(None, None, 5), (1., 2., None), (1.5, None, 1)])
+def test_sigma_clip(cube, sigma_lower, sigma_upper, iters):
+    cube[3, 4, 5] = 100.
+    cube[7:9, 1, 1] = -50.
+    original = cube.copy()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.empty_like(cube)
+        for y in range(cube.shape[1]):
+            for x in range(cube.shape[2]):
+                expected[:, y, x] = clip_spectrum(cube[:, y, x], sigma_lower or 2., sigma_upper or 2.,
+                                                  iters)
+
+        result = sigma_clip_spectra(cube, sigma=2., sigma_lower=sigma_lower,
+                                    sigma_upper=sigma_upper, iters=iters)
+        np.testing.assert_array_equal(result, expected)
+        np.testing.assert_array_equal(cube, original)
+        assert np.isnan(result[3, 4, 5])
+
+        # Collapsing the clipped range ignores the clipped values
+        clip = {'sigma': 2., 'sigma_lower': sigma_lower, 'sigma_upper': sigma_upper, 'iters': iters}
+        collapsed = collapse_array(cube, np.mean, 10, 30, tile_bytes=8 * 20 * 4, sigma_clip=clip)
+        expected = np.nanmean(sigma_clip_spectra(cube[10:30], **clip), axis=0)
+    np.testing.assert_allclose(collapsed, expected, rtol=1e-12, equal_nan=True)
+
+
+@pytest.mark.parametrize("operation", ['Sum', 'Maximum (ignore NaNs)'])
+def test_region(cube, operation):
+    mask = np.zeros(cube.shape[1:], dtype=bool)
+    mask[3:7, 2:9] = True
+    mask[4, 4] = False
+    assert bounding_box(mask) == (slice(3, 7), slice(2, 9))
+    assert bounding_box(np.zeros_like(mask)) is None
+
+    class CountingArray(object):
+        # Records the spaxels read
+        def __init__(self, data):
+            self.data = data
+            self.shape = data.shape
+            self.read = np.zeros(data.shape[1:], dtype=bool)
+
+        def __getitem__(self, view):
+            self.read[view[1:]] = True
+            return self.data[view]
+
+    function = operations[operation]
+    data = CountingArray(cube)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.where(mask, function(cube[5:30], axis=0), np.nan)
+        result = collapse_array(data, function, 5, 30, tile_bytes=8 * 25 * 5, mask=mask)
+    np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
+    assert not data.read[~np.pad(np.ones((4, 7), dtype=bool), ((3, 6), (2, 2)))].any()
+
+    assert np.isnan(collapse_array(cube, function, mask=np.zeros_like(mask))).all()
+
+
+class ViewMask(object):
+    # 3D mask only read with views, as a SubsetMask
+    def __init__(self, mask):
+        self._mask = mask
+        self.shape = mask.shape
+        self.ndim = mask.ndim
+
+    def __getitem__(self, view):
+        return self._mask[view]
+
+
+@pytest.mark.parametrize("operation", ['Sum', 'Mean (ignore NaNs)', 'Median', 'Maximum (ignore NaNs)'])
+def test_voxel_mask(cube, operation):
+    # A 3D mask (e.g. of a spectral range) is read a tile at a time and the
+    # values outside of it are ignored, the spectra without any are NaN
+    mask = np.zeros(cube.shape, dtype=bool)
+    mask[12:20] = True
+    mask[:, 0, :] = False
+
+    function = operations[operation]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = function(cube[12:20], axis=0)
+        expected[0] = np.nan
+        result = collapse_array(cube, function, 5, 30, tile_bytes=8 * 25 * 5, mask=ViewMask(mask))
+    np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
@@ -0,0 +1,218 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import pytest
+import numpy as np
+
+from scipy import ndimage
+from astropy import convolution
+
+from cubeviz.tools import smoothing_engine
+from cubeviz.tools.smoothing_engine import (BLOCKS_PER_WORKER, SmoothingSpec, error_spec, select_method, separable_factors,
+                                            histogram_medians, smooth_array, smooth_batch)
+
+
+@pytest.fixture
+def parallel(monkeypatch):
+    # Smooth the small test cubes in the worker processes too
+    monkeypatch.setattr(smoothing_engine, 'PARALLEL_MIN_BYTES', 0)
+
+
+@pytest.fixture
+def masked_cube():
+    rng = np.random.RandomState(0)
+    data = rng.randn(10, 30, 25)
+    mask = rng.rand(*data.shape) > 0.1
+    mask[:, 5:15, 5:15] = False
+    return data, mask
+
+
+def direct_convolution(data, mask, kernel, axis):
+    # What the spectral-cube smoothing methods return
+    expected = np.empty(data.shape)
+    filled = np.where(mask, data, np.nan)
+    if axis == "spatial":
+        for ii in range(data.shape[0]):
+            expected[ii] = convolution.convolve(filled[ii], kernel, normalize_kernel=True)
+    else:
+        # The spectra without valid values are left as they are (NaN)
+        for jj in range(data.shape[1]):
+            for ii in range(data.shape[2]):
+                spectrum = filled[:, jj, ii]
+                if np.any(np.isfinite(spectrum)):
+                    spectrum = convolution.convolve(spectrum, kernel, normalize_kernel=True)
+                expected[:, jj, ii] = spectrum
+    return expected
+
+
+@pytest.mark.parametrize("axis, kernel", [("spatial", convolution.Gaussian2DKernel(3)),
+                                          ("spatial", convolution.AiryDisk2DKernel(4)),
+                                          ("spectral", convolution.Gaussian1DKernel(5))])
+def test_fft_matches_direct(masked_cube, axis, kernel):
+    data, mask = masked_cube
+    spec = SmoothingSpec(axis, "convolve", kernel.array, None)
+    assert select_method(spec, data.shape).method == "fft"
+
+    result = smooth_array(data, spec, mask=mask, n_workers=1)
+    np.testing.assert_allclose(result, direct_convolution(data, mask, kernel, axis), atol=1e-10)
+
+
+@pytest.mark.parametrize("kernel", [convolution.Gaussian2DKernel(2), convolution.Box2DKernel(4)])
+def test_separable_matches_2d(masked_cube, kernel):
+    data, mask = masked_cube
+    spec = SmoothingSpec("spatial", "convolve", kernel.array, None, separable=True)
+    assert select_method(spec, data.shape).method == "separable"
+
+    result = smooth_array(data, spec, mask=mask, n_workers=1)
+    np.testing.assert_allclose(result, direct_convolution(data, mask, kernel, "spatial"), atol=1e-10)
+
+
+def test_not_separable():
+    assert separable_factors(convolution.Gaussian2DKernel(2).array) is not None
+    assert separable_factors(convolution.Tophat2DKernel(3).array) is None
+
+
+@pytest.mark.parametrize("kernel", [convolution.Box1DKernel(5), convolution.Trapezoid1DKernel(3),
+                                    convolution.Gaussian1DKernel(1)])
+def test_spectral_matches_direct(masked_cube, kernel):
+    data, mask = masked_cube
+    spec = SmoothingSpec("spectral", "convolve", kernel.array, None)
+    assert select_method(spec, data.shape).method == "spectral"
+
+    ticks = []
+    result = smooth_array(data, spec, mask=mask, n_workers=1, update_function=lambda: ticks.append(1))
+    np.testing.assert_allclose(result, direct_convolution(data, mask, kernel, "spectral"), atol=1e-10)
+    # Progress is reported once per block of spaxels
+    assert 1 < len(ticks) < data.shape[1] * data.shape[2]
+
+
+@pytest.mark.parametrize("axis", ["spatial", "spectral"])
+@pytest.mark.parametrize("size", [2, 3, 5, 13])
+def test_median(axis, size):
+    # Without NaN values, the same as scipy on each slice or spectrum
+    data = np.random.RandomState(1).randn(8, 12, 10)
+    expected = np.empty(data.shape)
+    if axis == "spatial":
+        for ii in range(data.shape[0]):
+            expected[ii] = ndimage.median_filter(data[ii], size)
+    else:
+        for jj in range(data.shape[1]):
+            for ii in range(data.shape[2]):
+                expected[:, jj, ii] = ndimage.median_filter(data[:, jj, ii], size)
+
+    result = smooth_array(data, SmoothingSpec(axis, "median", None, size), n_workers=1)
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("axis", ["spatial", "spectral"])
+def test_median_ignores_nan(axis):
+    data = np.random.RandomState(1).randn(8, 12, 10)
+    data[:, 2:5, 2:5] = np.nan
+    data[3, 7, 7] = np.nan
+
+    result = smooth_array(data, SmoothingSpec(axis, "median", None, 3), n_workers=1)
+
+    # The upper median of the values that are not NaN
+    if axis == "spatial":
+        window = data[3, 6:9, 6:9]
+    else:
+        window = data[2:5, 7, 7]
+    window = np.sort(window[np.isfinite(window)])
+    assert result[3, 7, 7] == window[len(window) // 2]
+
+    assert np.isnan(result[:, 3, 3]).all()
+    assert np.isfinite(result[:, 6:, 6:]).all()
+
+
+@pytest.mark.parametrize("rows", [True, False])
+@pytest.mark.parametrize("size", [1, 4, 13])
+def test_histogram_medians(rows, size):
+    rng = np.random.RandomState(3)
+    data = np.round(rng.randn(3, 16, 14), 1)
+    data[rng.rand(*data.shape) < 0.2] = np.nan
+    data[:, :5] = np.nan
+    positions = np.nonzero(np.ones(data.shape, dtype=bool))
+
+    # The upper median of the values that are not NaN, by sorting each window
+    before = size // 2
+    padding = (before, size - 1 - before)
+    padded = np.pad(data, ((0, 0), padding if rows else (0, 0), padding), mode='symmetric')
+    expected = []
+    for index, row, column in zip(*positions):
+        window = padded[index, row:row + (size if rows else 1), column:column + size]
+        window = np.sort(window[np.isfinite(window)])
+        expected.append(window[len(window) // 2] if len(window) else np.nan)
+
+    np.testing.assert_array_equal(histogram_medians(data, size, positions, rows=rows), expected)
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_output(masked_cube, tmpdir, n_workers, parallel):
+    data, mask = masked_cube
+    spec = SmoothingSpec("spatial", "convolve", convolution.Gaussian2DKernel(2).array, None, separable=True)
+    expected = smooth_array(data, spec, mask=mask, n_workers=1)
+
+    # A new output is held in memory unless it is memory mapped
+    result = smooth_array(data, spec, mask=mask, n_workers=n_workers)
+    assert not isinstance(result, np.memmap)
+    np.testing.assert_array_equal(result, expected)
+
+    # A new memory mapped output, whose file is removed once it is unused
+    result = smooth_array(data, spec, mask=mask, n_workers=n_workers, memmap=True, directory=str(tmpdir))
+    assert isinstance(result, np.memmap)
+    np.testing.assert_array_equal(result, expected)
+    del result
+    assert tmpdir.listdir() == []
+
+    # Given outputs are written to, in memory or memory mapped
+    out = np.zeros(data.shape)
+    assert smooth_array(data, spec, mask=mask, n_workers=n_workers, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+    out = np.memmap(str(tmpdir.join('out.dat')), mode='w+', shape=data.shape, dtype=np.float64)
+    assert smooth_array(data, spec, mask=mask, n_workers=n_workers, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize("kernel, separable", [(convolution.Gaussian2DKernel(1), True),
+                                               (convolution.Tophat2DKernel(2), False),
+                                               (convolution.Gaussian2DKernel(3), False)])
+def test_error_propagation(kernel, separable):
+    rng = np.random.RandomState(2)
+    sigma = rng.rand(2, 12, 10) + 0.5
+    mask = rng.rand(*sigma.shape) > 0.2
+
+    # The convolution is linear: its weights are the convolutions of unit impulses
+    expected = np.zeros(sigma.shape)
+    for index in zip(*np.nonzero(mask)):
+        impulse = np.where(mask[index[0]], 0., np.nan)
+        impulse[index[1:]] = 1
+        weights = convolution.convolve(impulse, kernel, normalize_kernel=True)
+        expected[index[0]] += weights ** 2 * sigma[index] ** 2
+    expected = np.sqrt(expected)
+    expected[np.isnan(smooth_array(sigma, SmoothingSpec("spatial", "convolve", kernel.array, None),
+                                   mask=mask, n_workers=1))] = np.nan
+
+    spec = error_spec(SmoothingSpec("spatial", "convolve", kernel.array, None, separable=separable))
+    result = smooth_array(sigma, spec, mask=mask, n_workers=1)
+    np.testing.assert_allclose(result, expected, atol=1e-10)
+
+    with pytest.raises(ValueError):
+        error_spec(SmoothingSpec("spatial", "median", None, 3))
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_batch(masked_cube, n_workers, parallel):
+    # The same results as one smoothing at a time
+    data, mask = masked_cube
+    specs = [SmoothingSpec("spatial", "convolve", convolution.Box2DKernel(3).array, None, separable=True),
+             SmoothingSpec("spatial", "median", None, 3),
+             SmoothingSpec("spectral", "convolve", convolution.Gaussian1DKernel(1).array, None)]
+    jobs = [(0, spec) for spec in specs] + [(1, error_spec(specs[0])), (1, error_spec(specs[2]))]
+    arrays = [data, np.abs(data)]
+
+    ticks = []
+    results = smooth_batch(arrays, jobs, mask=mask, n_workers=n_workers,
+                           update_function=lambda: ticks.append(1))
+    for (index, spec), result in zip(jobs, results):
+        np.testing.assert_array_equal(result, smooth_array(arrays[index], spec, mask=mask, n_workers=1))
+    # One tick per block of each axis, not per smoothing
+    assert len(ticks) == 2 * n_workers * BLOCKS_PER_WORKER
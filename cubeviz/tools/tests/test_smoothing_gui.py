@@ -7,7 +7,8 @@ import numpy as np
 
 from qtpy import QtCore
 from glue.core import roi
-from cubeviz.tools.smoothing import SelectSmoothing
+from cubeviz.tools.smoothing import SelectSmoothing, SmoothCube
+from cubeviz.tools.smoothing_engine import smooth_array
 
 from ...tests.helpers import (toggle_viewer, select_viewer, left_click,
                       left_button_press, right_button_press, enter_slice_text,
@@ -53,19 +54,59 @@ def test_smoothing_spatial(qtbot, smoothing_gui, cubeviz_layout, x):
         return
     np_result = np.asarray(cubeviz_layout._data[smoothing_component_id])
 
-    # Get expected results
-    cube = sm.smooth_cube.data_to_cube()
-    if "median" == sm.smooth_cube.kernel_type:
-        if "spatial" == sm.smooth_cube.smoothing_axis:
-            new_cube = cube.spatial_smooth_median(sm.smooth_cube.kernel_size)
-        else:
-            new_cube = cube.spectral_smooth_median(sm.smooth_cube.kernel_size)
-    else:
-        kernel = sm.smooth_cube.get_kernel()
-        if "spatial" == sm.smooth_cube.smoothing_axis:
-            new_cube = cube.spatial_smooth(kernel)
-        else:
-            new_cube = cube.spectral_smooth(kernel)
-    expected_result = new_cube._data
+    # Get expected results, smoothing the component in this process
+    smooth_cube = sm.smooth_cube
+    data = np.asarray(cubeviz_layout._data[smooth_cube.component_id], dtype=np.float64)
+    expected_result = smooth_array(data, smooth_cube.get_smoothing_spec(),
+                                   mask=smooth_cube.get_glue_mask(), n_workers=1)
 
     assert np.allclose(np_result, expected_result, rtol=0.01, equal_nan=True)
+
+
+@pytest.mark.parametrize("axis, kernel_type", [("spatial", "gaussian"), ("spectral", "box"),
+                                               ("spatial", "median")])
+def test_smoothing_parallel(cubeviz_layout, axis, kernel_type):
+    # The blocks smoothed in worker processes are stitched back into the same cube
+    data = cubeviz_layout._data
+    results = []
+    for n_workers in [1, 2]:
+        smooth_cube = SmoothCube(data=data, smoothing_axis=axis, kernel_type=kernel_type,
+                                 kernel_size=3, component_id=DATA_LABELS[0], n_workers=n_workers)
+        results.append(smooth_cube.smooth_cube(preview=True))
+
+    assert np.allclose(results[0], results[1], equal_nan=True)
+
+
+def test_smoothing_batch(cubeviz_layout):
+    # Each kernel and component in one pass, the NOISE propagated through the kernels
+    data = cubeviz_layout._data
+    kernels = [("spatial", "box", 3), ("spectral", "gaussian", 2)]
+    smooth_cube = SmoothCube(data=data, component_ids=[DATA_LABELS[0]], kernels=kernels,
+                             error_component_ids=[DATA_LABELS[1]], n_workers=1)
+    results = smooth_cube.smooth_cube(preview=True)
+    assert len(results) == 4
+
+    for (component_id, axis, kernel_type, kernel_size, is_error), result in zip(smooth_cube.get_batch(), results):
+        assert is_error == (component_id == DATA_LABELS[1])
+        if not is_error:
+            expected = SmoothCube(data=data, smoothing_axis=axis, kernel_type=kernel_type, kernel_size=kernel_size,
+                                  component_id=component_id, n_workers=1).smooth_cube(preview=True)
+            assert np.allclose(result, expected, equal_nan=True)
+        else:
+            # Smoothing averages the noise down
+            noise = np.asarray(data[component_id])
+            assert np.nanmedian(result) < np.nanmedian(noise)
+
+
+def test_smoothing_preview_prefetch(cubeviz_layout):
+    # The slices smoothed ahead of the previewed one are set in the dialog
+    sm = SelectSmoothing(cubeviz_layout._data, parent=cubeviz_layout, allow_preview=True)
+    sm.k_size.setText("3")
+    sm.prefetch_spin.setValue(4)
+    sm.preview()
+    try:
+        for view in cubeviz_layout.cube_views[:2]:
+            states = [layer.state for layer in view.widget().layers if hasattr(layer.state, 'preview_prefetch')]
+            assert states and all(state.preview_prefetch == 4 for state in states)
+    finally:
+        sm.cancel()
@@ -0,0 +1,120 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Helpers for the arrays handed to the analysis tools.
+"""
+import numpy as np
+
+__all__ = ['as_float', 'AllValidMask', 'SubsetMask', 'is_all_valid', 'is_spatial_subset']
+
+
+def as_float(data):
+    """
+    Return ``data`` as a floating point numpy array (masked arrays stay
+    masked).
+
+    Components can be stored with their native dtype (e.g. integer DQ
+    planes) and some are only read from the file when accessed, so the tools
+    call this on the chunk they work on rather than the data being stored as
+    floating point. Floating point data is returned without a copy.
+
+    :param data: array-like
+    :return: numpy.ndarray
+    """
+    data = np.asanyarray(data)
+    if data.dtype.kind == 'f':
+        return data
+    return data.astype(np.float64)
+
+
+class AllValidMask(object):
+    """
+    Mask of a cube in which every voxel is valid, without allocating it.
+
+    Indexing it returns a read-only boolean array broadcast from a single
+    value, so the tools can read it a chunk at a time like any other mask
+    (see also `is_all_valid` to skip it altogether).
+
+    :param shape: shape of the cube
+    """
+
+    dtype = np.dtype(bool)
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, view):
+        return np.broadcast_to(np.True_, self.shape)[view]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.ones(self.shape, dtype=dtype or bool)
+
+
+class SubsetMask(object):
+    """
+    Mask of a glue subset, evaluated only for the chunks that are read
+    (with ``subset.to_mask(view)``) rather than for the whole cube.
+
+    :param subset: glue.core.Subset
+    """
+
+    dtype = np.dtype(bool)
+
+    def __init__(self, subset):
+        self._subset = subset
+        self.shape = tuple(subset.data.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, view):
+        if not isinstance(view, tuple):
+            view = (view,)
+        return self._subset.to_mask(view)
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self._subset.to_mask()
+        return mask if dtype is None else mask.astype(dtype)
+
+
+def is_all_valid(mask):
+    """
+    Whether a mask (True for the valid values) is known to be valid
+    everywhere without reading it: None or an `AllValidMask`.
+    """
+    return mask is None or isinstance(mask, AllValidMask)
+
+
+def is_spatial_subset(subset):
+    """
+    Whether the mask of a glue subset of a cube (spectral axis first) is the
+    same in every slice: its state only selects regions (or ranges) of the
+    spatial pixel coordinates, as the ROIs drawn in the image viewers do.
+    Subsets of a spectral range or of values are not spatial.
+
+    :param subset: glue.core.Subset
+    :return: bool
+    """
+    from glue.core.subset import CompositeSubsetState, RoiSubsetState, RangeSubsetState
+
+    # Component ids compare with == into subset states, hence `is`
+    spatial = subset.data.pixel_component_ids[1:]
+
+    def is_spatial(attribute):
+        return any(attribute is component_id for component_id in spatial)
+
+    def is_spatial_state(state):
+        if isinstance(state, CompositeSubsetState):
+            return is_spatial_state(state.state1) and (state.state2 is None or
+                                                       is_spatial_state(state.state2))
+        if isinstance(state, RoiSubsetState):
+            return is_spatial(state.xatt) and is_spatial(state.yatt)
+        if isinstance(state, RangeSubsetState):
+            return is_spatial(state.att)
+        return False
+
+    return is_spatial_state(subset.subset_state)
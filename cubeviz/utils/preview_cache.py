@@ -0,0 +1,124 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Least recently used cache of the slices shown by the previews (e.g. the
+smoothing preview), which can also compute slices ahead of time in a
+background thread.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['PreviewCache', 'PREVIEW_PREFETCH']
+
+log = logging.getLogger('cubeviz_preview_cache')
+log.setLevel(logging.WARNING)
+
+# Number of slices on each side of the one shown computed ahead of time by
+# default, so that moving through the slices shows them at once
+PREVIEW_PREFETCH = 2
+
+
+class PreviewCache(object):
+    """
+    Cache of up to ``max_size`` preview slices.
+
+    The keys identify what a slice was computed from (e.g. the component,
+    the slice index and the smoothing parameters), so a slice is never
+    returned for other parameters; `clear` drops everything, including the
+    slices being prefetched, when the data itself changes.
+
+    :param max_size: number of slices kept
+    """
+
+    def __init__(self, max_size=32):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._pending = set()
+        self._generation = 0
+        self._executor = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key):
+        """
+        The slice stored for ``key``, or None.
+        """
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        """
+        Store the slice for ``key``, dropping the least recently used slices
+        if there are more than ``max_size``.
+        """
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self._max_size:
+            self._items.popitem(last=False)
+
+    def prefetch(self, key, function):
+        """
+        Compute ``function()`` in a background thread and store it for
+        ``key``, unless it is already stored or being computed. Errors are
+        logged and ignored (the slice is then computed when it is shown).
+
+        :param key: key of the slice
+        :param function: function without arguments returning the slice
+        """
+        with self._lock:
+            if key in self._items or key in self._pending:
+                return
+            self._pending.add(key)
+            generation = self._generation
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            executor = self._executor
+
+        executor.submit(self._compute, key, function, generation)
+
+    def _compute(self, key, function, generation):
+        try:
+            value = function()
+        except Exception as e:
+            log.debug('Could not prefetch {}: {}'.format(key, e))
+            value = None
+
+        with self._lock:
+            self._pending.discard(key)
+            # Slices computed before a clear may come from the old data
+            if value is not None and generation == self._generation:
+                self._put(key, value)
+
+    def clear(self):
+        """
+        Drop all the slices, and those being prefetched.
+        """
+        with self._lock:
+            self._items.clear()
+            self._pending.clear()
+            self._generation += 1
+
+    def close(self):
+        """
+        Drop all the slices and stop the thread prefetching them (a new one
+        is started by the next `prefetch`).
+        """
+        self.clear()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
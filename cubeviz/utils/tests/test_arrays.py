@@ -0,0 +1,61 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import numpy as np
+
+from ..arrays import AllValidMask, SubsetMask, is_all_valid, is_spatial_subset
+
+
+class FakeSubset(object):
+    """Subset whose mask records the views it is evaluated on"""
+
+    def __init__(self, mask):
+        self._mask = mask
+        self.data = mask
+        self.views = []
+
+    def to_mask(self, view=None):
+        self.views.append(view)
+        return self._mask if view is None else self._mask[view]
+
+
+def test_all_valid_mask():
+    mask = AllValidMask((4, 5, 6))
+    assert is_all_valid(mask) and is_all_valid(None)
+    assert mask[1:3, :, 2].shape == (2, 5)
+    assert mask[1:3, :, 2].all()
+    assert np.asarray(mask).shape == (4, 5, 6)
+
+
+def test_subset_mask():
+    values = np.random.RandomState(0).rand(4, 5, 6) > 0.5
+    subset = FakeSubset(values)
+    mask = SubsetMask(subset)
+    assert not is_all_valid(mask)
+
+    # Only the chunk read is evaluated
+    np.testing.assert_array_equal(mask[2], values[2])
+    np.testing.assert_array_equal(mask[1:3, 2:], values[1:3, 2:])
+    assert subset.views == [(2,), (slice(1, 3), slice(2, None))]
+    np.testing.assert_array_equal(np.asarray(mask), values)
+
+
+def test_is_spatial_subset():
+    from glue.core import Data
+    from glue.core.roi import RectangularROI
+    from glue.core.subset import RoiSubsetState, RangeSubsetState, InequalitySubsetState
+
+    data = Data(flux=np.ones((4, 5, 6)), label='cube')
+    spectral, y, x = data.pixel_component_ids
+
+    region = data.new_subset(RoiSubsetState(x, y, RectangularROI(1, 3, 1, 3)))
+    assert is_spatial_subset(region)
+    region.subset_state = region.subset_state & RangeSubsetState(0, 2, x)
+    assert is_spatial_subset(region)
+    region.subset_state = ~region.subset_state
+    assert is_spatial_subset(region)
+
+    # Spectral ranges and value thresholds select voxels
+    assert not is_spatial_subset(data.new_subset(RangeSubsetState(0, 2, spectral)))
+    values = InequalitySubsetState(data.id['flux'], 0.5, np.greater)
+    assert not is_spatial_subset(data.new_subset(values))
+    region.subset_state = region.subset_state | RangeSubsetState(0, 2, spectral)
+    assert not is_spatial_subset(region)
@@ -0,0 +1,50 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import time
+
+from ..preview_cache import PreviewCache
+
+
+def test_preview_cache_lru():
+    cache = PreviewCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # 'b' is the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_preview_cache_prefetch():
+    cache = PreviewCache()
+    cache.prefetch('a', lambda: 1)
+    cache.prefetch('b', lambda: 1 / 0)
+
+    for _ in range(100):
+        if 'a' in cache:
+            break
+        time.sleep(0.01)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+
+
+def test_preview_cache_close():
+    cache = PreviewCache()
+    cache.prefetch('a', lambda: 1)
+    executor = cache._executor
+    cache.close()
+    assert len(cache) == 0
+    assert cache._executor is None
+    assert executor._shutdown
+
+    # Prefetching again starts a new thread
+    cache.prefetch('b', lambda: 2)
+    for _ in range(100):
+        if 'b' in cache:
+            break
+        time.sleep(0.01)
+    assert cache.get('b') == 2
+    cache.close()